@@ -0,0 +1 @@
+ALTER TABLE card DROP CONSTRAINT IF EXISTS card_amount_check;
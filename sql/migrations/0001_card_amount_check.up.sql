@@ -0,0 +1,8 @@
+-- migrate: no-transaction
+-- the balance of a card can never go below zero. the constraint is added
+-- NOT VALID first, which only blocks the table for a moment, and the cards
+-- already there are checked after that without blocking purchases
+
+ALTER TABLE card DROP CONSTRAINT IF EXISTS card_amount_check;
+ALTER TABLE card ADD CONSTRAINT card_amount_check CHECK (amount >= 0) NOT VALID;
+ALTER TABLE card VALIDATE CONSTRAINT card_amount_check;
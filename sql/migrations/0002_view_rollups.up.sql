@@ -0,0 +1,151 @@
+-- per-day play counters and per-month genre rollups of every consumer, kept
+-- up to date by a statement-level trigger on view. they replace the per-row
+-- update_top10 trigger of sql/create_trigger.sql, which rebuilt the TOP 10
+-- from 30 days of views on every play. the counters are seeded from the
+-- views already recorded, which blocks new plays until it commits
+
+CREATE TABLE view_daily_count (
+	consumer_person_users_id BIGINT,
+	song_ismn		 BIGINT,
+	day			 DATE,
+	views			 BIGINT NOT NULL,
+	PRIMARY KEY(consumer_person_users_id,song_ismn,day)
+);
+
+CREATE TABLE consumer_monthly_genre (
+	consumer_person_users_id BIGINT,
+	month			 DATE,
+	genre			 VARCHAR(512),
+	play_count		 BIGINT NOT NULL,
+	PRIMARY KEY(consumer_person_users_id,month,genre)
+);
+
+ALTER TABLE view_daily_count ADD CONSTRAINT view_daily_count_fk1 FOREIGN KEY (consumer_person_users_id) REFERENCES consumer(person_users_id);
+ALTER TABLE view_daily_count ADD CONSTRAINT view_daily_count_fk2 FOREIGN KEY (song_ismn) REFERENCES song(ismn);
+ALTER TABLE consumer_monthly_genre ADD CONSTRAINT consumer_monthly_genre_fk1 FOREIGN KEY (consumer_person_users_id) REFERENCES consumer(person_users_id);
+
+DROP TRIGGER IF EXISTS update_top10 ON view;
+DROP FUNCTION IF EXISTS update_top10();
+
+-- rebuilds the TOP 10 playlist of one consumer from its daily counters
+CREATE or REPLACE FUNCTION refresh_top10(consumer_id BIGINT) RETURNS VOID AS $$
+
+DECLARE
+	top10_playlist_id BIGINT;
+
+BEGIN
+	-- the row lock serializes concurrent refreshes of the same playlist
+	SELECT id INTO top10_playlist_id
+	FROM playlist
+	WHERE is_private is NULL AND consumer_person_users_id = consumer_id
+	FOR UPDATE;
+
+	IF top10_playlist_id IS NULL THEN
+		INSERT INTO playlist (name, is_private, consumer_person_users_id) VALUES ('TOP 10', NULL, consumer_id) RETURNING id into top10_playlist_id;
+	END IF;
+
+	DELETE FROM playlist_song
+	WHERE playlist_id = top10_playlist_id;
+
+	INSERT INTO playlist_song (playlist_id, song_ismn)
+	SELECT top10_playlist_id, song_ismn
+	FROM view_daily_count
+	WHERE consumer_person_users_id = consumer_id
+	AND day >= (now() - INTERVAL '30 days')::date
+	GROUP BY song_ismn
+	ORDER BY SUM(views) DESC, song_ismn
+	LIMIT 10;
+END;
+$$ LANGUAGE plpgsql;
+
+-- applies the views inserted by one statement as deltas to the daily
+-- counters and the monthly genre rollups, and refreshes the TOP 10 of the
+-- consumers involved. rows are locked in key order, so statements sharing
+-- consumers wait for each other instead of deadlocking
+CREATE or REPLACE FUNCTION update_view_counters() RETURNS TRIGGER AS $$
+
+BEGIN
+	INSERT INTO view_daily_count (consumer_person_users_id, song_ismn, day, views)
+	SELECT consumer_person_users_id, song_ismn, date_view::date, COUNT(*)
+	FROM new_views
+	GROUP BY consumer_person_users_id, song_ismn, date_view::date
+	ORDER BY consumer_person_users_id, song_ismn, date_view::date
+	ON CONFLICT (consumer_person_users_id, song_ismn, day)
+	DO UPDATE SET views = view_daily_count.views + EXCLUDED.views;
+
+	INSERT INTO consumer_monthly_genre (consumer_person_users_id, month, genre, play_count)
+	SELECT new_views.consumer_person_users_id, date_trunc('month', new_views.date_view)::date, song.genre, COUNT(*)
+	FROM new_views
+	JOIN song ON song.ismn = new_views.song_ismn
+	GROUP BY new_views.consumer_person_users_id, date_trunc('month', new_views.date_view)::date, song.genre
+	ORDER BY new_views.consumer_person_users_id, date_trunc('month', new_views.date_view)::date, song.genre
+	ON CONFLICT (consumer_person_users_id, month, genre)
+	DO UPDATE SET play_count = consumer_monthly_genre.play_count + EXCLUDED.play_count;
+
+	PERFORM refresh_top10(consumer_person_users_id)
+	FROM (SELECT DISTINCT consumer_person_users_id FROM new_views ORDER BY consumer_person_users_id) AS consumers;
+
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_view_counters
+AFTER INSERT on view
+REFERENCING NEW TABLE AS new_views
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_view_counters();
+
+-- meant to run periodically (e.g. daily from cron): drops counters that left
+-- the 30 day window and rebuilds the TOP 10 of consumers that had plays in it
+CREATE or REPLACE FUNCTION refresh_top10s() RETURNS VOID AS $$
+
+BEGIN
+	DELETE FROM view_daily_count
+	WHERE day < (now() - INTERVAL '30 days')::date;
+
+	PERFORM refresh_top10(consumers.consumer_person_users_id)
+	FROM (
+		SELECT p.consumer_person_users_id
+		FROM playlist p
+		WHERE p.is_private is NULL
+		AND EXISTS (SELECT 1 FROM playlist_song ps WHERE ps.playlist_id = p.id)
+		ORDER BY p.consumer_person_users_id
+	) AS consumers;
+END;
+$$ LANGUAGE plpgsql;
+
+-- recomputes the daily counters and monthly rollups from the view table,
+-- blocking new views while it runs. safe to run again at any time. the
+-- monthly rollups of months without plays in view (archived) are kept
+CREATE or REPLACE FUNCTION rebuild_view_rollups() RETURNS VOID AS $$
+
+DECLARE
+	first_month DATE;
+
+BEGIN
+	LOCK TABLE view IN SHARE MODE;
+
+	SELECT date_trunc('month', MIN(date_view))::date INTO first_month FROM view;
+
+	DELETE FROM view_daily_count;
+	DELETE FROM consumer_monthly_genre WHERE month >= first_month;
+
+	INSERT INTO view_daily_count (consumer_person_users_id, song_ismn, day, views)
+	SELECT consumer_person_users_id, song_ismn, date_view::date, COUNT(*)
+	FROM view
+	WHERE date_view >= (now() - INTERVAL '30 days')::date
+	GROUP BY consumer_person_users_id, song_ismn, date_view::date;
+
+	INSERT INTO consumer_monthly_genre (consumer_person_users_id, month, genre, play_count)
+	SELECT view.consumer_person_users_id, date_trunc('month', view.date_view)::date, song.genre, COUNT(*)
+	FROM view
+	JOIN song ON song.ismn = view.song_ismn
+	GROUP BY view.consumer_person_users_id, date_trunc('month', view.date_view)::date, song.genre;
+
+	PERFORM refresh_top10(consumer_person_users_id)
+	FROM (SELECT DISTINCT consumer_person_users_id FROM view_daily_count ORDER BY consumer_person_users_id) AS consumers;
+END;
+$$ LANGUAGE plpgsql;
+
+-- seeds the counters and rollups from views recorded before they existed
+SELECT rebuild_view_rollups();
@@ -0,0 +1,5 @@
+-- migrate: no-transaction
+-- the extensions are left installed, other objects may use them
+
+DROP INDEX CONCURRENTLY IF EXISTS song_title_trgm_idx;
+DROP FUNCTION IF EXISTS search_text(text);
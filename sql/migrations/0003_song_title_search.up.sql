@@ -0,0 +1,14 @@
+-- migrate: no-transaction
+-- trigram search of song titles, without case and accents. the index is
+-- built without blocking new songs. if the build fails, drop the INVALID
+-- index it leaves behind and run the migration again
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS unaccent;
+
+-- lower case, accent free form of a text, used to index and search song titles
+CREATE or REPLACE FUNCTION search_text(text) RETURNS text AS '
+	SELECT lower(public.unaccent(''public.unaccent'', $1))
+' LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS song_title_trgm_idx ON song USING GIN (search_text(title) gin_trgm_ops);
@@ -0,0 +1 @@
+DROP TABLE refresh_token;
@@ -0,0 +1,12 @@
+-- refresh tokens, exchanged for new access tokens without the password.
+-- only a hash of each token is kept
+
+CREATE TABLE refresh_token (
+	token_hash CHAR(64),
+	expires	 TIMESTAMP NOT NULL,
+	revoked	 BOOL NOT NULL DEFAULT FALSE,
+	users_id	 BIGINT NOT NULL,
+	PRIMARY KEY(token_hash)
+);
+
+ALTER TABLE refresh_token ADD CONSTRAINT refresh_token_fk1 FOREIGN KEY (users_id) REFERENCES users(id);
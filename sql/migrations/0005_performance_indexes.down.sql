@@ -0,0 +1,9 @@
+-- migrate: no-transaction
+
+DROP INDEX CONCURRENTLY IF EXISTS comment_song_idx;
+DROP INDEX CONCURRENTLY IF EXISTS song_album_album_idx;
+DROP INDEX CONCURRENTLY IF EXISTS artist_song_song_idx;
+DROP INDEX CONCURRENTLY IF EXISTS plan_name_update_idx;
+DROP INDEX CONCURRENTLY IF EXISTS subscription_consumer_end_idx;
+DROP INDEX CONCURRENTLY IF EXISTS view_date_song_idx;
+DROP INDEX CONCURRENTLY IF EXISTS view_consumer_date_idx;
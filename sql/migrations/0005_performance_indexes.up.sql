@@ -0,0 +1,24 @@
+-- migrate: no-transaction
+-- indexes of the hot predicates, built without blocking writes. if a build
+-- fails, drop the INVALID index it leaves behind and run the migration again
+
+-- plays of a consumer in a period (TOP 10, reports)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS view_consumer_date_idx ON view (consumer_person_users_id, date_view);
+
+-- plays of a period, by song (rollup rebuilds, analytics)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS view_date_song_idx ON view (date_view, song_ismn);
+
+-- active subscription of a consumer
+CREATE INDEX CONCURRENTLY IF NOT EXISTS subscription_consumer_end_idx ON subscription (consumer_person_users_id, end_date);
+
+-- current price of a plan
+CREATE INDEX CONCURRENTLY IF NOT EXISTS plan_name_update_idx ON plan (name, last_update);
+
+-- artists of a song, the primary key starts with the artist
+CREATE INDEX CONCURRENTLY IF NOT EXISTS artist_song_song_idx ON artist_song (song_ismn);
+
+-- songs of an album, the primary key starts with the song
+CREATE INDEX CONCURRENTLY IF NOT EXISTS song_album_album_idx ON song_album (album_id);
+
+-- comments of a song
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comment_song_idx ON comment (song_ismn);
@@ -0,0 +1,41 @@
+-- back to a single view table with the plays of the attached partitions.
+-- partitions archived in view_archive are left there
+
+ALTER TABLE view RENAME TO view_partitioned;
+ALTER INDEX view_pkey RENAME TO view_partitioned_pkey;
+ALTER INDEX view_consumer_date_idx RENAME TO view_partitioned_consumer_date_idx;
+ALTER INDEX view_date_song_idx RENAME TO view_partitioned_date_song_idx;
+ALTER SEQUENCE view_id_seq OWNED BY NONE;
+
+CREATE TABLE view (
+	id			 BIGINT NOT NULL DEFAULT nextval('view_id_seq'),
+	date_view		 TIMESTAMP NOT NULL,
+	song_ismn		 BIGINT NOT NULL,
+	consumer_person_users_id BIGINT NOT NULL,
+	PRIMARY KEY(id)
+);
+
+ALTER SEQUENCE view_id_seq OWNED BY view.id;
+
+INSERT INTO view (id, date_view, song_ismn, consumer_person_users_id)
+SELECT id, date_view, song_ismn, consumer_person_users_id
+FROM view_partitioned;
+
+DROP TABLE view_partitioned;
+
+ALTER TABLE view ADD CONSTRAINT view_fk1 FOREIGN KEY (song_ismn) REFERENCES song(ismn);
+ALTER TABLE view ADD CONSTRAINT view_fk2 FOREIGN KEY (consumer_person_users_id) REFERENCES consumer(person_users_id);
+
+-- indexes of migration 0005
+CREATE INDEX view_consumer_date_idx ON view (consumer_person_users_id, date_view);
+CREATE INDEX view_date_song_idx ON view (date_view, song_ismn);
+
+CREATE TRIGGER update_view_counters
+AFTER INSERT on view
+REFERENCING NEW TABLE AS new_views
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_view_counters();
+
+DROP FUNCTION maintain_view_partitions(INTEGER, INTEGER);
+DROP FUNCTION create_view_partitions(DATE, DATE);
+DROP FUNCTION create_view_partition(DATE);
@@ -0,0 +1,142 @@
+-- monthly range partitions of view, so queries on date_view only read the
+-- months they need and old months can be archived. the plays of the old
+-- table are copied in this transaction, which blocks new plays until it
+-- commits: run it with the server stopped or when plays are few.
+--
+-- the app runs maintain_view_partitions() on start and every hour, so the
+-- partitions of the coming months exist. plays of a month that still has
+-- no partition go to the default partition, view_default, and are moved to
+-- the partition of their month once it is created
+
+CREATE SCHEMA IF NOT EXISTS view_archive;
+
+-- creates the partition of the month of a day, if it does not exist, with
+-- the plays of that month that are in the default partition
+CREATE or REPLACE FUNCTION create_view_partition(day DATE) RETURNS VOID AS $$
+
+DECLARE
+	first_day DATE := date_trunc('month', day)::date;
+	next_first_day DATE := (date_trunc('month', day) + INTERVAL '1 month')::date;
+	partition_name TEXT := 'view_y' || to_char(first_day, 'YYYY') || 'm' || to_char(first_day, 'MM');
+
+BEGIN
+	IF to_regclass(partition_name) IS NOT NULL THEN
+		RETURN;
+	END IF;
+
+	IF NOT EXISTS (SELECT 1 FROM view_default WHERE date_view >= first_day AND date_view < next_first_day) THEN
+		EXECUTE format(
+			'CREATE TABLE %I PARTITION OF view FOR VALUES FROM (%L) TO (%L)',
+			partition_name, first_day, next_first_day
+		);
+		RETURN;
+	END IF;
+
+	-- a partition can't be created while the default one has plays that
+	-- belong to it, they are moved first. the counters already have them
+	EXECUTE format('CREATE TABLE %I (LIKE view INCLUDING DEFAULTS)', partition_name);
+	EXECUTE format(
+		'WITH moved AS (DELETE FROM view_default WHERE date_view >= %L AND date_view < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+		first_day, next_first_day, partition_name
+	);
+	EXECUTE format(
+		'ALTER TABLE view ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+		partition_name, first_day, next_first_day
+	);
+END;
+$$ LANGUAGE plpgsql;
+
+-- creates the partitions of every month from one day to another
+CREATE or REPLACE FUNCTION create_view_partitions(from_day DATE, to_day DATE) RETURNS VOID AS $$
+
+DECLARE
+	month DATE := date_trunc('month', from_day)::date;
+
+BEGIN
+	WHILE month <= to_day LOOP
+		PERFORM create_view_partition(month);
+		month := (month + INTERVAL '1 month')::date;
+	END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- run periodically by the app (PARTITION_* in .env): creates the partitions
+-- of the next months_ahead months and, when keep_months is given, detaches
+-- the partitions of months older than that and moves them to the
+-- view_archive schema, from where they can be dumped and dropped. the
+-- monthly genre rollups of archived months are kept
+CREATE or REPLACE FUNCTION maintain_view_partitions(months_ahead INTEGER DEFAULT 3, keep_months INTEGER DEFAULT NULL) RETURNS VOID AS $$
+
+DECLARE
+	old_partition RECORD;
+
+BEGIN
+	PERFORM create_view_partitions(now()::date, (now() + make_interval(months => months_ahead))::date);
+
+	IF keep_months IS NULL THEN
+		RETURN;
+	END IF;
+
+	-- the TOP 10 playlists count the plays of the last 30 days
+	IF keep_months < 2 THEN
+		RAISE EXCEPTION 'keep_months must be at least 2';
+	END IF;
+
+	FOR old_partition IN
+		SELECT c.relname
+		FROM pg_inherits i
+		JOIN pg_class c ON c.oid = i.inhrelid
+		WHERE i.inhparent = 'view'::regclass
+		AND c.relname ~ '^view_y[0-9]{4}m[0-9]{2}$'
+		AND to_date(substring(c.relname FROM 7), 'YYYY"m"MM') < date_trunc('month', now() - make_interval(months => keep_months))
+	LOOP
+		EXECUTE format('ALTER TABLE view DETACH PARTITION %I', old_partition.relname);
+		EXECUTE format('ALTER TABLE %I SET SCHEMA view_archive', old_partition.relname);
+	END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- the old table is kept aside until its plays are copied
+ALTER TABLE view RENAME TO view_unpartitioned;
+ALTER INDEX view_pkey RENAME TO view_unpartitioned_pkey;
+ALTER INDEX view_consumer_date_idx RENAME TO view_unpartitioned_consumer_date_idx;
+ALTER INDEX view_date_song_idx RENAME TO view_unpartitioned_date_song_idx;
+ALTER SEQUENCE view_id_seq OWNED BY NONE;
+
+-- the partition key has to be part of the primary key
+CREATE TABLE view (
+	id			 BIGINT NOT NULL DEFAULT nextval('view_id_seq'),
+	date_view		 TIMESTAMP NOT NULL,
+	song_ismn		 BIGINT NOT NULL,
+	consumer_person_users_id BIGINT NOT NULL,
+	PRIMARY KEY(id,date_view)
+) PARTITION BY RANGE (date_view);
+
+ALTER SEQUENCE view_id_seq OWNED BY view.id;
+
+CREATE TABLE view_default PARTITION OF view DEFAULT;
+
+SELECT create_view_partitions(
+	LEAST(now(), (SELECT MIN(date_view) FROM view_unpartitioned))::date,
+	GREATEST(now() + INTERVAL '3 months', (SELECT MAX(date_view) FROM view_unpartitioned))::date
+);
+
+-- keys, indexes and the counters trigger come after the copy: the keys are
+-- validated in one pass and the counters already include these plays
+INSERT INTO view (id, date_view, song_ismn, consumer_person_users_id)
+SELECT id, date_view, song_ismn, consumer_person_users_id
+FROM view_unpartitioned;
+
+DROP TABLE view_unpartitioned;
+
+ALTER TABLE view ADD CONSTRAINT view_fk1 FOREIGN KEY (song_ismn) REFERENCES song(ismn);
+ALTER TABLE view ADD CONSTRAINT view_fk2 FOREIGN KEY (consumer_person_users_id) REFERENCES consumer(person_users_id);
+
+CREATE INDEX view_consumer_date_idx ON view (consumer_person_users_id, date_view);
+CREATE INDEX view_date_song_idx ON view (date_view, song_ismn);
+
+CREATE TRIGGER update_view_counters
+AFTER INSERT on view
+REFERENCING NEW TABLE AS new_views
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_view_counters();
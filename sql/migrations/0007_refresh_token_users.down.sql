@@ -0,0 +1,3 @@
+-- migrate: no-transaction
+
+DROP INDEX CONCURRENTLY IF EXISTS refresh_token_users_idx;
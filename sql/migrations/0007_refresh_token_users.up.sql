@@ -0,0 +1,5 @@
+-- migrate: no-transaction
+-- refresh tokens of a user, so the revoked and expired ones are pruned
+-- whenever the user is given a new one. built without blocking logins
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS refresh_token_users_idx ON refresh_token (users_id);
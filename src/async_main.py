@@ -0,0 +1,530 @@
+# =============================================
+# ============== Bases de Dados ===============
+# ============== LEI  2022/2023 ===============
+# =============================================
+#
+# Asyncio serving mode. The endpoints that mostly wait on PostgreSQL (play,
+# search, artist details, monthly report and token refresh) run as coroutines
+# over psycopg's AsyncConnection, so one process can hold thousands of them
+# in flight. Every other /dbproj route is handed to the Flask app in main,
+# which runs on the worker threads of the event loop.
+#
+# Run with: python async_main.py (BIND and WORKERS come from .env)
+
+import asyncio
+import contextlib
+import datetime
+import functools
+import jwt
+import json
+import psycopg
+import time
+from hypercorn.config import Config
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from hypercorn.run import run as run_hypercorn
+from psycopg_pool import AsyncConnectionPool
+from werkzeug.exceptions import HTTPException
+
+import main
+from main import StatusCodes, logger
+
+
+##########################################################
+# DATABASE ACCESS
+##########################################################
+
+
+db_pool = None
+
+
+async def open_db_pool():
+    # called once the event loop of the server is running
+    global db_pool
+
+    db_pool = AsyncConnectionPool(
+        kwargs={**main.db_connect_kwargs, "cursor_factory": main.TimedAsyncCursor},
+        min_size=main.pool_min_size,
+        max_size=main.pool_max_size,
+        timeout=main.pool_timeout,
+        max_lifetime=main.pool_max_lifetime,
+        check=AsyncConnectionPool.check_connection,
+        name="spotsong-async",
+        open=False,
+    )
+    await db_pool.open()
+
+
+async def close_db_pool():
+    if db_pool is not None:
+        await db_pool.close()
+
+
+@contextlib.asynccontextmanager
+async def db_connection():
+    # db_pool.connection(), counting the wait for a free connection
+    start = time.perf_counter()
+
+    async with db_pool.connection() as conn:
+        main.record_pool_wait(time.perf_counter() - start)
+        yield conn
+
+
+##########################################################
+# AUTHENTICATION
+##########################################################
+
+
+async def resolve_principal(user_id):
+    # same as main.resolve_principal, sharing its cache
+    principal = main.role_cache.get(user_id)
+
+    if principal is not None:
+        return principal
+
+    generation = main.role_cache.generation()
+
+    values = {"user_id": user_id}
+
+    async with db_connection() as conn:
+        cur = await main.queries.execute_async(conn, "principal", values)
+        row = await cur.fetchone()
+
+    principal = main.Principal(user_id, *row)
+    main.role_cache.set(user_id, principal, generation)
+
+    return principal
+
+
+def authenticated(role=None, denied="Invalid token"):
+    # same as main.authenticated, the endpoint gets the payload and the
+    # Principal as its first arguments
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(payload, *args, **kwargs):
+            if "token" not in payload:
+                return {
+                    "status": StatusCodes["api_error"],
+                    "results": "token value not in payload",
+                }
+
+            try:
+                user_id = main.decode_token(payload["token"])
+
+            except jwt.exceptions.ExpiredSignatureError:
+                return {
+                    "status": StatusCodes["api_error"],
+                    "results": "token invalido. tente autenticar novamente",
+                }
+
+            except jwt.exceptions.InvalidTokenError:
+                return {"status": StatusCodes["api_error"], "results": "Invalid token"}
+
+            principal = await resolve_principal(user_id)
+
+            if role is not None and not getattr(principal, f"is_{role}"):
+                return {"status": StatusCodes["api_error"], "results": denied}
+
+            return await endpoint(payload, principal, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+##########################################################
+# ENDPOINTS
+##########################################################
+
+
+# Refresh access token
+# PUT http://localhost:8080/dbproj/token
+async def refresh_access_token(payload):
+    logger.info("PUT /dbproj/token")
+
+    if "refresh_token" not in payload:
+        return {
+            "status": StatusCodes["api_error"],
+            "results": "refresh_token not in payload",
+        }
+
+    try:
+        values, refresh_token = main.rotate_refresh_token_values(payload["refresh_token"])
+
+        async with db_connection() as conn:
+            cur = await main.queries.execute_async(conn, "rotate_refresh_token", values)
+            row = await cur.fetchone()
+
+        if row is None:
+            return {
+                "status": StatusCodes["api_error"],
+                "results": "refresh token invalido. tente autenticar novamente",
+            }
+
+        response = {
+            "status": StatusCodes["success"],
+            "results": main.issue_access_token(row[0]),
+            "refresh_token": refresh_token,
+        }
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f"PUT /dbproj/token - error: {error}")
+        response = {"status": StatusCodes["internal_error"], "errors": str(error)}
+
+    return response
+
+
+# Search song
+# GET http://localhost:8080/dbproj/song/{keyword}
+@authenticated("consumer", denied="Token inválido.")
+async def search_song(payload, principal, keyword):
+    logger.info("GET /dbproj/song/{keyword}")
+
+    try:
+        try:
+            limit = main.page_size(payload)
+        except ValueError:
+            return {
+                "status": StatusCodes["api_error"],
+                "results": "invalid limit",
+            }
+
+        # the cursor holds the rank and id of the last song of the previous page
+        after_rank, after_song = None, 0
+        if "after" in payload:
+            try:
+                after_rank, after_song = main.decode_cursor(payload["after"])
+                after_rank, after_song = float(after_rank), int(after_song)
+            except (ValueError, TypeError, OverflowError):
+                return {
+                    "status": StatusCodes["api_error"],
+                    "results": "invalid after cursor",
+                }
+
+        # LIKE wildcards typed by the user are matched literally
+        pattern = (
+            keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        )
+
+        values = {
+            "keyword": keyword,
+            "pattern": pattern,
+            "after_rank": after_rank,
+            "after_song": after_song,
+            "limit": limit + 1,
+        }
+
+        async with db_connection() as conn:
+            cur = await main.queries.execute_async(conn, "search_song", values)
+            all = await cur.fetchall()
+
+        results, next_cursor = main.search_page(all, limit)
+
+        response = {
+            "status": StatusCodes["success"],
+            "results": results,
+            "next": next_cursor,
+        }
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f"GET /dbproj/song/{keyword} - error: {error}")
+        response = {"status": StatusCodes["internal_error"], "errors": str(error)}
+
+    return response
+
+
+# Detail artist
+# GET http://localhost:8080/dbproj/artist_info/{artist_id}
+@authenticated("consumer")
+async def detail_artist(payload, principal, artist_id):
+    logger.info("GET /dbproj/song/{artist_id}")
+
+    try:
+        if not artist_id.isdigit():
+            return {
+                "status": StatusCodes["api_error"],
+                "errors": "Nothing foud with that user id",
+            }
+
+        try:
+            limit = main.page_size(payload)
+        except ValueError:
+            return {
+                "status": StatusCodes["api_error"],
+                "results": "invalid limit",
+            }
+
+        # the cursor holds the id of the last song of the previous page
+        after_song = 0
+        if "after" in payload:
+            try:
+                after_song = int(main.decode_cursor(payload["after"]))
+            except (ValueError, TypeError, OverflowError):
+                return {
+                    "status": StatusCodes["api_error"],
+                    "results": "invalid after cursor",
+                }
+
+        async with db_connection() as conn:
+            profile = main.artist_cache.get(int(artist_id))
+
+            if profile is None:
+                generation = main.artist_cache.generation()
+
+                values = {"artist_id": int(artist_id)}
+                cur = await main.queries.execute_async(conn, "artist_profile", values)
+                profile = main.build_artist_profile(await cur.fetchall())
+
+                if profile is not None:
+                    main.artist_cache.set(int(artist_id), profile, generation)
+
+            if profile is None:
+                return {
+                    "status": StatusCodes["api_error"],
+                    "errors": "Nothing foud with that user id",
+                }
+
+            songs, albuns, playlist, next_cursor = main.artist_page(
+                profile, after_song, limit
+            )
+
+            if len(songs) > 0:
+                values = (songs, principal.user_id)
+                cur = await main.queries.execute_async(conn, "private_playlists", values)
+
+                for linha in await cur.fetchall():
+                    playlist[linha[0]] = None
+
+        results = {
+            "name": profile["name"],
+            "songs": songs,
+            "albuns": list(albuns),
+            "playlists": list(playlist),
+        }
+
+        response = {
+            "status": StatusCodes["success"],
+            "results": results,
+            "next": next_cursor,
+        }
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f"GET /dbproj/song/{artist_id} - error: {error}")
+        response = {"status": StatusCodes["internal_error"], "errors": str(error)}
+
+    return response
+
+
+# Play song
+# POST http://localhost:8080/dbproj/{song_ismn}
+@authenticated("consumer")
+async def add_view(payload, principal, song_id):
+    logger.debug(f"PUT /dbproj/{song_id} - payload: {payload}")
+
+    try:
+        if not main.is_song_id(song_id):
+            return {
+                "status": StatusCodes["api_error"],
+                "results": "Song is not in database",
+            }
+
+        if main.view_ingestion == "buffered" and not payload.get("sync", False):
+            view = (datetime.datetime.now(), int(song_id), principal.user_id)
+
+            # only waits on a thread when the queue is full
+            if main.view_buffer.queue.full():
+                queued = await asyncio.to_thread(
+                    main.view_buffer.put, view, main.view_enqueue_timeout
+                )
+            else:
+                queued = main.view_buffer.put(view, main.view_enqueue_timeout)
+
+            if not queued:
+                return {
+                    "status": StatusCodes["internal_error"],
+                    "errors": "Too many views being recorded. Try again later",
+                }
+
+            return {
+                "status": StatusCodes["success"],
+                "results": {"message": "Song view queued successfully"},
+            }
+
+        values = (datetime.datetime.now(), principal.user_id, song_id)
+
+        async with db_connection() as conn:
+            cur = await main.queries.execute_async(conn, "add_view", values)
+            res = await cur.fetchone()
+
+        if res is None:
+            return {
+                "status": StatusCodes["api_error"],
+                "results": "Song is not in database",
+            }
+
+        response = {
+            "status": StatusCodes["success"],
+            "results": {
+                "view_id": res[0],
+                "message": "Song view added successfully",
+            },
+        }
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f"PUT /dbproj/{song_id} - error: {error}")
+        response = {"status": StatusCodes["internal_error"], "errors": str(error)}
+
+    return response
+
+
+# Generate a monthly report
+# GET - http://localhost:8080/dbproj/report/year-month
+@authenticated("consumer", denied="Token inválido.")
+async def monthly_report(payload, principal, year, month):
+    logger.info("GET /dbproj/song/{year}{month}")
+
+    try:
+        init_date = datetime.datetime(int(year) - 1, int(month), 1).strftime("%Y-%m-%d")
+        end_date = datetime.datetime(int(year), int(month), 1).strftime("%Y-%m-%d")
+
+        values = (principal.user_id, init_date, end_date)
+
+        async with db_connection() as conn:
+            cur = await main.queries.execute_async(conn, "monthly_report", values)
+            all_data = await cur.fetchall()
+
+        response = {"status": StatusCodes["success"], "results": []}
+
+        for linha in all_data:
+            response["results"].append(
+                {"month": linha[0], "genre": linha[1], "playbacks": linha[2]}
+            )
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f"GET /dbproj/song/{year}{month} - error: {error}")
+        response = {"status": StatusCodes["internal_error"], "errors": str(error)}
+
+    return response
+
+
+##########################################################
+# SERVER
+##########################################################
+
+
+# endpoints served here, by the name of their Flask view in main
+endpoints = {
+    "api.refresh_access_token": refresh_access_token,
+    "api.search_song": search_song,
+    "api.detail_artist": detail_artist,
+    "api.add_view": add_view,
+    "api.monthly_report": monthly_report,
+}
+
+# routes are matched against the url map of the Flask app, so both modes
+# resolve a path to the same endpoint
+flask_app = main.create_app()
+
+url_adapter = flask_app.url_map.bind("localhost")
+
+wsgi_application = AsyncioWSGIMiddleware(flask_app)
+
+
+async def read_body(receive):
+    body = b""
+    more_body = True
+
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+    return body
+
+
+async def send_response(send, status, body, content_type):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type),
+                (b"content-length", str(len(body)).encode("ascii")),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+
+        if message["type"] == "lifespan.startup":
+            await open_db_pool()
+            main.partition_maintenance.start()
+            await send({"type": "lifespan.startup.complete"})
+
+        elif message["type"] == "lifespan.shutdown":
+            await close_db_pool()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    endpoint = None
+
+    if scope["type"] == "http":
+        try:
+            rule, arguments = url_adapter.match(
+                scope["path"], scope["method"], return_rule=True)
+            endpoint = endpoints.get(rule.endpoint)
+        except HTTPException:
+            pass
+
+    if endpoint is None:
+        return await wsgi_application(scope, receive, send)
+
+    try:
+        payload = json.loads(await read_body(receive))
+    except ValueError:
+        payload = None
+
+    # like flask.request.get_json(), which is what the threaded mode uses
+    if not isinstance(payload, dict):
+        return await send_response(send, 415, b"Unsupported Media Type", b"text/plain")
+
+    # the wrapped Flask routes are measured by the hooks of main
+    start = time.perf_counter()
+    usage = main.start_request_usage(rule.rule)
+
+    response = await endpoint(payload, **arguments)
+
+    main.request_metrics.observe(
+        rule.rule, scope["method"], response.get("status", 200),
+        time.perf_counter() - start, usage)
+
+    # same encoding as flask.jsonify
+    body = (flask_app.json.dumps(response) + "\n").encode("utf-8")
+    await send_response(send, 200, body, b"application/json")
+
+
+def run():
+    # hypercorn spawns the workers, each with its own event loop and pool.
+    # SIGTERM and SIGINT stop them once the requests in flight end (up to
+    # GRACEFUL_TIMEOUT), SIGHUP replaces them with new ones
+    config = Config()
+    config.application_path = "async_main:application"
+    config.bind = [main.server_bind]
+    config.workers = main.server_workers
+    config.graceful_timeout = main.server_graceful_timeout
+    config.accesslog = None
+
+    logger.info(f"API online (async): http://{main.server_bind}/dbproj")
+    run_hypercorn(config)
+
+
+if __name__ == "__main__":
+    run()
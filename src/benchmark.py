@@ -0,0 +1,375 @@
+# =============================================
+# ============== Bases de Dados ===============
+# ============== LEI  2022/2023 ===============
+# =============================================
+#
+# Database benchmarks, run against the database in .env (ideally filled by
+# generate_data.py). Measurements that change the schema or the data run in
+# a transaction that is rolled back, or delete the rows they created, so the
+# data is left as it was, but the tables involved are locked while they
+# run: use a test database, not the one serving the app.
+#
+#   views   insert throughput of plays, with the per-row update_top10
+#           trigger this project started with ("before") and with the
+#           statement-level update_view_counters trigger ("after")
+#   search  latency of song searches, with the LIKE '%keyword%' query this
+#           project started with ("before") and with the search_song query
+#           of the app and its trigram index ("after")
+#   signups throughput of parallel consumer signups, with the EXCLUSIVE
+#           locks on users and artist this project started with ("before")
+#           and with the ON CONFLICT inserts of add_user ("after")
+#
+# Run with:
+#   python benchmark.py views --plays 2000 --batches 1,100
+#   python benchmark.py search --keywords noite,coracao --runs 20 --explain
+#   python benchmark.py signups --signups 2000 --clients 1,16 --latency 0.5
+
+import argparse
+import datetime
+import os
+import random
+import statistics
+import threading
+import time
+import uuid
+from dotenv import load_dotenv
+
+import psycopg
+
+load_dotenv()
+
+# sql/create_trigger.sql is the per-row update_top10 trigger this project
+# started with, which rebuilt the TOP 10 from 30 days of views on every play
+trigger_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "sql", "create_trigger.sql")
+
+
+def db_connection():
+    # the database in .env, the one the server uses
+    return psycopg.connect(
+        user=os.getenv("USER"),
+        password=os.getenv("PASSWORD"),
+        host=os.getenv("HOSTDB"),
+        port=os.getenv("PORTDB"),
+        dbname=os.getenv("NAMEDB"),
+        autocommit=True,
+    )
+
+
+def sample_ids(conn, statement, count):
+    return [row[0] for row in conn.execute(statement, [count])]
+
+
+def report(rows, size, unit):
+    # rows of (variant, size, count, seconds)
+    print(f"{'variant':<10} {size:>7} {unit:>8} {'seconds':>9} {unit + '/s':>10}")
+
+    for variant, batch, count, seconds in rows:
+        print(f"{variant:<10} {batch:>7} {count:>8} {seconds:>9.2f} {count / seconds:>10.1f}")
+
+
+##########################################################
+# VIEWS
+##########################################################
+
+
+def insert_views(conn, views, batch):
+    # one INSERT per play like the sync path of add_view, or one per batch
+    # like the view buffer
+    start = time.perf_counter()
+
+    if batch == 1:
+        for view in views:
+            conn.execute(
+                "INSERT INTO view (date_view, song_ismn, consumer_person_users_id) VALUES (%s, %s, %s)",
+                view)
+    else:
+        for first in range(0, len(views), batch):
+            conn.execute(
+                """
+                INSERT INTO view (date_view, song_ismn, consumer_person_users_id)
+                SELECT * FROM unnest(%s::timestamp[], %s::bigint[], %s::bigint[])
+                """,
+                [list(column) for column in zip(*views[first:first + batch])])
+
+    return time.perf_counter() - start
+
+
+def bench_views(conn, options):
+    rng = random.Random(options.seed)
+    consumers = sample_ids(
+        conn, "SELECT person_users_id FROM consumer ORDER BY random() LIMIT %s", 1000)
+    songs = sample_ids(conn, "SELECT ismn FROM song ORDER BY random() LIMIT %s", 1000)
+    now = datetime.datetime.now()
+
+    views = [
+        (now - datetime.timedelta(seconds=rng.randrange(86400)), rng.choice(songs), rng.choice(consumers))
+        for _ in range(options.plays)
+    ]
+    rows = []
+
+    for variant in ("before", "after"):
+        for batch in options.batches:
+            with conn.transaction(force_rollback=True):
+                if variant == "before":
+                    conn.execute("DROP TRIGGER update_view_counters ON view")
+                    with open(trigger_path, encoding="utf-8") as file:
+                        conn.execute(file.read())
+                    # the old trigger only works once a public playlist exists
+                    conn.execute(
+                        """
+                        INSERT INTO playlist (name, is_private, consumer_person_users_id)
+                        SELECT 'TOP 10', NULL, %s
+                        WHERE NOT EXISTS (SELECT 1 FROM playlist WHERE is_private is NULL)
+                        """,
+                        [consumers[0]])
+
+                rows.append((variant, batch, len(views), insert_views(conn, views, batch)))
+
+    report(rows, "batch", "plays")
+
+
+##########################################################
+# SEARCH
+##########################################################
+
+
+# the search of song titles this project started with, with the keyword as a
+# parameter instead of pasted into the query
+search_before = """
+SELECT s.ismn AS song_id, s.title AS song_title, a.artistic_name AS artist_name, al.id AS album_id
+FROM song s
+INNER JOIN artist_song sa ON s.ismn = sa.song_ismn
+INNER JOIN artist a ON sa.artist_person_users_id = a.person_users_id
+LEFT JOIN song_album als ON s.ismn = als.song_ismn
+LEFT JOIN album al ON als.album_id = al.id
+WHERE s.title LIKE '%%' || %(keyword)s || '%%'
+"""
+
+
+def search_after():
+    # the search_song query of the app, first page
+    import main as app
+
+    return app.queries.statements["search_song"]
+
+
+def time_search(conn, statement, values, runs):
+    # median milliseconds of runs executions and the rows returned
+    seconds = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        rows = conn.execute(statement, values, prepare=True).fetchall()
+        seconds.append(time.perf_counter() - start)
+
+    return statistics.median(seconds) * 1000, len(rows)
+
+
+def bench_search(conn, options):
+    songs = conn.execute("SELECT count(*) FROM song").fetchone()[0]
+    print(f"{songs} songs")
+
+    variants = [("before", search_before), ("after", search_after())]
+    print(f"{'variant':<10} {'keyword':<12} {'rows':>6} {'ms':>10}")
+
+    for keyword in options.keywords:
+        values = {
+            "keyword": keyword,
+            "pattern": keyword,
+            "after_rank": None,
+            "after_song": 0,
+            "limit": options.limit + 1,
+        }
+
+        for variant, statement in variants:
+            milliseconds, rows = time_search(conn, statement, values, options.runs)
+            print(f"{variant:<10} {keyword:<12} {rows:>6} {milliseconds:>10.2f}")
+
+    if options.explain:
+        for variant, statement in variants:
+            print(f"\n{variant}, {options.keywords[0]}:")
+            values["keyword"] = values["pattern"] = options.keywords[0]
+
+            for row in conn.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, values):
+                print(row[0])
+
+
+##########################################################
+# SIGNUPS
+##########################################################
+
+
+def execute(conn, latency, statement, values=None):
+    # waits latency seconds after the statement, as if the database were on
+    # another host. the waits take no CPU, so they show how long the locks
+    # are held even when the database and the clients share the cores
+    cursor = conn.execute(statement, values)
+    time.sleep(latency)
+    return cursor
+
+
+def sign_up(conn, variant, username, latency):
+    # the queries add_user runs for a consumer, without the password hashing.
+    # returns False when the username is taken
+    inserted = False
+
+    with conn.transaction() as transaction:
+        if variant == "before":
+            execute(conn, latency, "LOCK TABLE users IN EXCLUSIVE MODE")
+            execute(conn, latency, "LOCK TABLE artist IN EXCLUSIVE MODE")
+
+            taken = execute(
+                conn, latency, "SELECT id FROM users WHERE username = %s", [username]).fetchone()
+
+            if taken is not None:
+                raise psycopg.Rollback(transaction)
+
+            row = execute(
+                conn, latency,
+                "INSERT INTO users (username, email, password) VALUES (%s, %s, '-') RETURNING id",
+                [username, f"{username}@example.com"]).fetchone()
+        else:
+            row = execute(
+                conn, latency,
+                "INSERT INTO users (username, email, password) VALUES (%s, %s, '-') ON CONFLICT (username) DO NOTHING RETURNING id",
+                [username, f"{username}@example.com"]).fetchone()
+
+            if row is None:
+                raise psycopg.Rollback(transaction)
+
+        execute(
+            conn, latency,
+            "INSERT INTO person (name, address, contact, users_id) VALUES (%s, 'rua', '9', %s)",
+            [username, row[0]])
+        execute(conn, latency, "INSERT INTO consumer (person_users_id) VALUES (%s)", [row[0]])
+        execute(
+            conn, latency,
+            "INSERT INTO playlist (name, consumer_person_users_id) VALUES ('TOP 10', %s)", [row[0]])
+        inserted = True
+
+    return inserted
+
+
+def delete_signups(conn, prefix):
+    with conn.transaction():
+        users = [row[0] for row in conn.execute(
+            "SELECT id FROM users WHERE username LIKE %s", [f"{prefix}%"])]
+
+        conn.execute("DELETE FROM playlist WHERE consumer_person_users_id = ANY(%s)", [users])
+        conn.execute("DELETE FROM consumer WHERE person_users_id = ANY(%s)", [users])
+        conn.execute("DELETE FROM person WHERE users_id = ANY(%s)", [users])
+        conn.execute("DELETE FROM users WHERE id = ANY(%s)", [users])
+
+
+def run_signups(variant, usernames, clients, latency):
+    # the clients share the usernames, each on its own connection
+    connections = [db_connection() for _ in range(clients)]
+    barrier = threading.Barrier(clients + 1)
+    inserted = [0] * clients
+
+    def client(index):
+        barrier.wait()
+
+        for username in usernames[index::clients]:
+            inserted[index] += sign_up(connections[index], variant, username, latency)
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+
+    for thread in threads:
+        thread.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+
+    for thread in threads:
+        thread.join()
+
+    seconds = time.perf_counter() - start
+
+    for conn in connections:
+        conn.close()
+
+    return seconds, sum(inserted)
+
+
+def bench_signups(conn, options):
+    # a share of the signups picks a username that is already taken, the
+    # same ones in every run
+    rng = random.Random(options.seed)
+    names = []
+
+    for index in range(options.signups):
+        if names and rng.random() < options.duplicates:
+            names.append(rng.choice(names))
+        else:
+            names.append(index)
+
+    rows = []
+
+    for variant in ("before", "after"):
+        for clients in options.clients:
+            prefix = f"bs-{uuid.uuid4().hex[:8]}-"
+            usernames = [f"{prefix}{name}" for name in names]
+
+            try:
+                seconds, inserted = run_signups(variant, usernames, clients, options.latency / 1000)
+            finally:
+                delete_signups(conn, prefix)
+
+            rows.append((variant, clients, options.signups, seconds))
+            print(f"{variant} {clients} clients: {inserted} inserted, {options.signups - inserted} taken")
+
+    report(rows, "clients", "signups")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spotsong database benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    views = subparsers.add_parser("views", help="insert throughput of plays")
+    views.add_argument("--plays", type=int, default=2000)
+    views.add_argument(
+        "--batches", default="1,100",
+        type=lambda text: [int(size) for size in text.split(",")],
+        help="plays per INSERT, comma separated")
+    views.add_argument("--seed", type=int, default=1)
+
+    search = subparsers.add_parser("search", help="latency of song searches")
+    search.add_argument(
+        "--keywords", default="noite,coracao,sol,zzz",
+        type=lambda text: text.split(","),
+        help="keywords, comma separated")
+    search.add_argument("--limit", type=int, default=50)
+    search.add_argument("--runs", type=int, default=10)
+    search.add_argument(
+        "--explain", action="store_true",
+        help="print the plans of the first keyword")
+
+    signups = subparsers.add_parser("signups", help="throughput of parallel signups")
+    signups.add_argument("--signups", type=int, default=2000)
+    signups.add_argument(
+        "--clients", default="1,16",
+        type=lambda text: [int(count) for count in text.split(",")],
+        help="parallel connections, comma separated")
+    signups.add_argument(
+        "--duplicates", type=float, default=0.1,
+        help="share of signups with a username already taken")
+    signups.add_argument(
+        "--latency", type=float, default=0.5,
+        help="milliseconds of network round trip added to every statement")
+    signups.add_argument("--seed", type=int, default=1)
+
+    options = parser.parse_args()
+
+    with db_connection() as conn:
+        if options.benchmark == "views":
+            bench_views(conn, options)
+        elif options.benchmark == "search":
+            bench_search(conn, options)
+        elif options.benchmark == "signups":
+            bench_signups(conn, options)
+
+
+if __name__ == "__main__":
+    main()
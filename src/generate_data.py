@@ -0,0 +1,533 @@
+# =============================================
+# ============== Bases de Dados ===============
+# ============== LEI  2022/2023 ===============
+# =============================================
+#
+# Synthetic data for scale tests. Consumers, artists, songs, albums,
+# playlists, subscriptions, comments and plays are bulk loaded with COPY on
+# top of the data already in the database (sql/insert_data.sql at least, for
+# the administrator and the plans).
+#
+# The data only depends on --seed, the volumes, --end and the rows already
+# in the database: every row has an explicit id, and the plays are generated
+# in chunks with their own random generator, so --jobs does not change them.
+#
+#   song popularity    Zipf (--song-skew), over a shuffled order of songs
+#   consumer activity  Zipf (--consumer-skew)
+#   genres             --genres, a weighted mix
+#   play times         the last --months months, growing towards the end,
+#                      busier at the weekend and in the evening
+#
+# Run with:
+#   python generate_data.py --consumers 2000000 --songs 3000000 \
+#       --views 300000000 --jobs 8
+#
+# Generated users log in with the password given by --password.
+
+import argparse
+import bcrypt
+import datetime
+import itertools
+import multiprocessing
+import os
+import random
+import sys
+import time
+from dotenv import load_dotenv
+
+import psycopg
+
+load_dotenv()
+
+default_genres = {
+    "pop": 25,
+    "rock": 15,
+    "rap": 15,
+    "eletronica": 10,
+    "indie": 7,
+    "funk": 8,
+    "fado": 5,
+    "jazz": 5,
+    "classica": 5,
+    "metal": 5,
+}
+
+# plays per hour of the day, relative
+hour_weights = [
+    3, 2, 1, 1, 1, 1, 2, 4, 6, 6, 6, 7,
+    8, 8, 7, 7, 8, 9, 11, 12, 12, 11, 8, 5,
+]
+
+# plays per day of the week (monday first), relative
+weekday_weights = [0.9, 0.9, 0.95, 1.0, 1.1, 1.25, 1.2]
+
+# plays are generated and copied in chunks of this many rows
+view_chunk_size = 1000000
+
+words = [
+    "amor", "noite", "dia", "mar", "coração", "saudade", "estrada", "lua",
+    "sol", "cidade", "fogo", "chuva", "vento", "céu", "canção", "vida",
+    "tempo", "sonho", "luz", "sombra", "love", "night", "heart", "road",
+    "fire", "rain", "dream", "light", "gold", "blue", "wild", "city",
+    "lisboa", "porto", "coimbra", "verão", "inverno", "paixão", "ilusão",
+    "alma", "fado", "rock", "baile", "rua", "janela", "segredo", "última",
+]
+
+first_names = [
+    "Ana", "João", "Maria", "Pedro", "Inês", "Tiago", "Beatriz", "Rui",
+    "Marta", "Nuno", "Sofia", "Miguel", "Rita", "André", "Carla", "Luís",
+]
+
+last_names = [
+    "Silva", "Santos", "Ferreira", "Pereira", "Oliveira", "Costa",
+    "Rodrigues", "Martins", "Sousa", "Gomes", "Lopes", "Marques",
+]
+
+
+def db_connection():
+    # the database in .env, the one the server uses
+    return psycopg.connect(
+        user=os.getenv("USER"),
+        password=os.getenv("PASSWORD"),
+        host=os.getenv("HOSTDB"),
+        port=os.getenv("PORTDB"),
+        dbname=os.getenv("NAMEDB"),
+        autocommit=True,
+    )
+
+
+def zipf_cum_weights(count, skew):
+    # cumulative weights of ranks 1..count, for random.choices
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+
+def copy_rows(conn, statement, lines):
+    # lines are rows in COPY text format, sent in blocks
+    block = []
+
+    with conn.cursor() as cur, cur.copy(statement) as copy:
+        for line in lines:
+            block.append(line)
+
+            if len(block) == 10000:
+                copy.write("".join(block))
+                block = []
+
+        if block:
+            copy.write("".join(block))
+
+
+def play_period(options):
+    # first day of the plays and the day after the last
+    return options.end - datetime.timedelta(days=round(options.months * 30.44)), options.end
+
+
+def timestamp(day, seconds):
+    return f"{day} {seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+##########################################################
+# PLAN
+##########################################################
+
+
+class Plan:
+    # ids and distributions shared by every table, rebuilt identically by
+    # the workers that load the plays
+
+    def __init__(self, options, base):
+        self.options = options
+        self.base = base
+
+        self.consumers = range(base["users"] + 1, base["users"] + options.consumers + 1)
+        self.artists = range(
+            self.consumers.stop, self.consumers.stop + options.artists)
+        self.songs = range(base["song"] + 1, base["song"] + options.songs + 1)
+        self.labels = range(base["label"] + 1, base["label"] + options.labels + 1)
+
+        self.genres = list(options.genres)
+        self.genre_weights = list(itertools.accumulate(options.genres.values()))
+
+        # popularity rank of the songs and activity rank of the consumers
+        popular = list(self.songs)
+        random.Random(f"{options.seed}:popularity").shuffle(popular)
+        self.popular_songs = popular
+        self.song_weights = zipf_cum_weights(len(popular), options.song_skew)
+
+        active = list(self.consumers)
+        random.Random(f"{options.seed}:activity").shuffle(active)
+        self.active_consumers = active
+        self.consumer_weights = zipf_cum_weights(len(active), options.consumer_skew)
+
+        # days of the plays, from --months ago until yesterday
+        start, end = play_period(options)
+        self.days = [
+            (start + datetime.timedelta(days=day)).isoformat()
+            for day in range((end - start).days)
+        ]
+        self.day_weights = list(itertools.accumulate(
+            (1 + options.growth * index / len(self.days))
+            * weekday_weights[datetime.date.fromisoformat(day).weekday()]
+            for index, day in enumerate(self.days)
+        ))
+        self.hour_weights = list(itertools.accumulate(hour_weights))
+
+    def song_artist_blocks(self):
+        # songs of an artist have consecutive ids, block sizes are skewed so
+        # a few artists have many songs
+        rng = random.Random(f"{self.options.seed}:artist_songs")
+        weights = [1 / rank ** 0.8 for rank in range(1, len(self.artists) + 1)]
+        rng.shuffle(weights)
+        total = sum(weights)
+
+        sizes = [int(weight / total * len(self.songs)) for weight in weights]
+        for index in range(len(self.songs) - sum(sizes)):
+            sizes[index % len(sizes)] += 1
+
+        blocks = []
+        first = self.songs.start
+
+        for artist, size in zip(self.artists, sizes):
+            blocks.append((artist, first, first + size))
+            first += size
+
+        return blocks
+
+    def popular_song(self, rng, k):
+        return rng.choices(self.popular_songs, cum_weights=self.song_weights, k=k)
+
+
+##########################################################
+# TABLES
+##########################################################
+
+
+def user_lines(plan, password_hash):
+    for user_id in plan.consumers:
+        yield f"{user_id}\tuser{user_id}\t{password_hash}\tuser{user_id}@example.com\n"
+
+    for user_id in plan.artists:
+        yield f"{user_id}\tartist{user_id}\t{password_hash}\tartist{user_id}@example.com\n"
+
+
+def person_lines(plan):
+    rng = random.Random(f"{plan.options.seed}:person")
+
+    for user_id in itertools.chain(plan.consumers, plan.artists):
+        name = f"{rng.choice(first_names)} {rng.choice(last_names)}"
+        yield f"{name}\trua {rng.randint(1, 999)}\t9{rng.randint(10000000, 99999999)}\t{user_id}\n"
+
+
+def artist_lines(plan, administrator):
+    rng = random.Random(f"{plan.options.seed}:artist")
+
+    for user_id in plan.artists:
+        yield f"artista {user_id}\t{administrator}\t{rng.choice(plan.labels)}\t{user_id}\n"
+
+
+def song_lines(plan, blocks, labels):
+    rng = random.Random(f"{plan.options.seed}:song")
+
+    for artist, first, last in blocks:
+        label = labels[artist]
+
+        for ismn in range(first, last):
+            title = " ".join(rng.sample(words, rng.randint(1, 4)))
+            release = timestamp(
+                (datetime.date(2000, 1, 1) + datetime.timedelta(days=rng.randrange(8700))).isoformat(),
+                rng.randrange(86400),
+            )
+            duration = f"{rng.randint(1, 7)}:{rng.randrange(60):02d}"
+            genre = rng.choices(plan.genres, cum_weights=plan.genre_weights)[0]
+            yield f"{ismn}\t{title}\t{release}\t{duration}\t{genre}\t{artist}\t{label}\n"
+
+
+def artist_song_lines(plan, blocks):
+    # the main artist of every song, and a featured artist on one in ten
+    rng = random.Random(f"{plan.options.seed}:artist_song")
+
+    for artist, first, last in blocks:
+        for ismn in range(first, last):
+            yield f"{artist}\t{ismn}\n"
+
+            if rng.random() < 0.1:
+                featured = rng.choice(plan.artists)
+
+                if featured != artist:
+                    yield f"{featured}\t{ismn}\n"
+
+
+def album_lines(plan, blocks, labels, album_ids, tracks):
+    # albums go to artists in proportion to their songs, with 8 to 14 of
+    # their songs each
+    rng = random.Random(f"{plan.options.seed}:album")
+    with_songs = [block for block in blocks if block[2] > block[1]]
+    cum_weights = list(itertools.accumulate(last - first for _, first, last in with_songs))
+
+    for album_id in album_ids:
+        artist, first, last = rng.choices(with_songs, cum_weights=cum_weights)[0]
+        title = " ".join(rng.sample(words, rng.randint(1, 3)))
+        release = timestamp(
+            (datetime.date(2000, 1, 1) + datetime.timedelta(days=rng.randrange(8700))).isoformat(), 0)
+
+        tracks.append((album_id, rng.sample(range(first, last), min(last - first, rng.randint(8, 14)))))
+        yield f"{album_id}\t{title}\t{release}\t{artist}\t{labels[artist]}\n"
+
+
+def playlist_lines(plan, playlist_ids, songs):
+    rng = random.Random(f"{plan.options.seed}:playlist")
+
+    for playlist_id in playlist_ids:
+        consumer = rng.choices(plan.active_consumers, cum_weights=plan.consumer_weights)[0]
+        private = "t" if rng.random() < 0.3 else "f"
+
+        songs.append((playlist_id, set(plan.popular_song(rng, rng.randint(5, 50)))))
+        yield f"{playlist_id}\tplaylist {playlist_id}\t{private}\t{consumer}\n"
+
+
+def subscription_lines(plan, subscription_ids, plans):
+    # one subscription for a share of the consumers, half of them still active
+    rng = random.Random(f"{plan.options.seed}:subscription")
+    now = datetime.datetime.combine(plan.options.end, datetime.time())
+    subscribers = rng.sample(plan.consumers, len(subscription_ids))
+
+    for subscription_id, consumer in zip(subscription_ids, subscribers):
+        plan_id, days = rng.choice(plans)
+        init = now - datetime.timedelta(
+            days=rng.uniform(0, days * 2), seconds=rng.randrange(86400))
+        end = init + datetime.timedelta(days=days)
+
+        yield (
+            f"{subscription_id}\t{init:%Y-%m-%d %H:%M:%S}\t{end:%Y-%m-%d %H:%M:%S}"
+            f"\t{init:%Y-%m-%d %H:%M:%S}\t{plan_id}\t{consumer}\n"
+        )
+
+
+def comment_lines(plan, comment_ids):
+    # comments on popular songs, one in five a reply to an earlier comment
+    rng = random.Random(f"{plan.options.seed}:comment")
+    earlier = []
+
+    for comment_id in comment_ids:
+        consumer = rng.choice(plan.consumers)
+
+        if earlier and rng.random() < 0.2:
+            parent, song = rng.choice(earlier)
+        else:
+            parent, song = "\\N", plan.popular_song(rng, 1)[0]
+            earlier.append((comment_id, song))
+
+        text = " ".join(rng.sample(words, rng.randint(2, 8)))
+        yield f"{comment_id}\t{text}\t{song}\t{consumer}\t{parent}\n"
+
+
+def view_lines(plan, chunk):
+    rng = random.Random(f"{plan.options.seed}:view:{chunk}")
+    first = plan.base["view"] + 1 + chunk * view_chunk_size
+    count = min(view_chunk_size, plan.options.views - chunk * view_chunk_size)
+
+    songs = plan.popular_song(rng, count)
+    consumers = rng.choices(
+        plan.active_consumers, cum_weights=plan.consumer_weights, k=count)
+    days = rng.choices(plan.days, cum_weights=plan.day_weights, k=count)
+    hours = rng.choices(range(24), cum_weights=plan.hour_weights, k=count)
+
+    for index in range(count):
+        seconds = hours[index] * 3600 + rng.randrange(3600)
+        yield f"{first + index}\t{timestamp(days[index], seconds)}\t{songs[index]}\t{consumers[index]}\n"
+
+
+##########################################################
+# LOADING
+##########################################################
+
+
+worker_plan = None
+
+
+def load_view_chunk(arguments):
+    # runs in the worker processes, the plan is built once per worker
+    global worker_plan
+
+    options, base, chunk = arguments
+
+    if worker_plan is None:
+        worker_plan = Plan(options, base)
+
+    with db_connection() as conn:
+        copy_rows(
+            conn,
+            "COPY view (id, date_view, song_ismn, consumer_person_users_id) FROM STDIN",
+            view_lines(worker_plan, chunk),
+        )
+
+    return chunk
+
+
+def load_views(conn, options, base):
+    # the counters trigger and the foreign keys are off while loading: the
+    # rollups are rebuilt and the keys validated once at the end
+    chunks = range((options.views + view_chunk_size - 1) // view_chunk_size)
+
+    # a partition per month of plays, when view is partitioned
+    if conn.execute("SELECT relkind FROM pg_class WHERE oid = 'view'::regclass").fetchone()[0] == "p":
+        conn.execute("SELECT create_view_partitions(%s, %s)", play_period(options))
+
+    conn.execute("ALTER TABLE view DISABLE TRIGGER update_view_counters")
+    conn.execute("ALTER TABLE view DROP CONSTRAINT IF EXISTS view_fk1, DROP CONSTRAINT IF EXISTS view_fk2")
+
+    try:
+        context = multiprocessing.get_context("spawn")
+
+        with context.Pool(options.jobs) as pool:
+            tasks = ((options, base, chunk) for chunk in chunks)
+
+            for done, chunk in enumerate(pool.imap_unordered(load_view_chunk, tasks), 1):
+                print(f"  view: {done}/{len(chunks)} chunks")
+    finally:
+        conn.execute("ALTER TABLE view ADD CONSTRAINT view_fk1 FOREIGN KEY (song_ismn) REFERENCES song(ismn)")
+        conn.execute("ALTER TABLE view ADD CONSTRAINT view_fk2 FOREIGN KEY (consumer_person_users_id) REFERENCES consumer(person_users_id)")
+        conn.execute("ALTER TABLE view ENABLE TRIGGER update_view_counters")
+
+
+def step(name, function, *arguments):
+    start = time.monotonic()
+    function(*arguments)
+    print(f"{name}: {time.monotonic() - start:.1f}s")
+
+
+def generate(options):
+    conn = db_connection()
+
+    base = {
+        table: conn.execute(f"SELECT COALESCE(MAX({column}), 0) FROM {table}").fetchone()[0]
+        for table, column in [
+            ("users", "id"), ("label", "id"), ("song", "ismn"), ("album", "id"),
+            ("playlist", "id"), ("subscription", "id"), ("comment", "id"), ("view", "id"),
+        ]
+    }
+
+    administrator = conn.execute("SELECT MIN(users_id) FROM administrator").fetchone()[0]
+    plans = conn.execute("SELECT id, days_period FROM plan ORDER BY id").fetchall()
+
+    if administrator is None or not plans:
+        sys.exit("there is no administrator or plan, load sql/insert_data.sql first")
+
+    plan = Plan(options, base)
+    blocks = plan.song_artist_blocks()
+
+    rng = random.Random(f"{options.seed}:labels")
+    labels = {artist: rng.choice(plan.labels) for artist in plan.artists}
+
+    # one hash for every generated user, bcrypt is far too slow for millions
+    password_hash = bcrypt.hashpw(
+        options.password.encode("utf-8"),
+        bcrypt.gensalt(int(os.getenv("BCRYPT_ROUNDS", "12")))).decode("utf-8")
+
+    album_ids = range(base["album"] + 1, base["album"] + options.albums + 1)
+    playlist_ids = range(base["playlist"] + 1, base["playlist"] + options.playlists + 1)
+    subscription_ids = range(
+        base["subscription"] + 1,
+        base["subscription"] + round(options.consumers * options.subscribers) + 1)
+    comment_ids = range(base["comment"] + 1, base["comment"] + options.comments + 1)
+    tracks = []
+    playlist_songs = []
+
+    step("label", copy_rows, conn, "COPY label (id, name) FROM STDIN",
+         (f"{label}\tlabel {label}\n" for label in plan.labels))
+    step("users", copy_rows, conn, "COPY users (id, username, password, email) FROM STDIN",
+         user_lines(plan, password_hash))
+    step("person", copy_rows, conn, "COPY person (name, address, contact, users_id) FROM STDIN",
+         person_lines(plan))
+    step("consumer", copy_rows, conn, "COPY consumer (person_users_id) FROM STDIN",
+         (f"{user_id}\n" for user_id in plan.consumers))
+    step("artist", copy_rows, conn,
+         "COPY artist (artistic_name, administrator_users_id, label_id, person_users_id) FROM STDIN",
+         artist_lines(plan, administrator))
+    step("song", copy_rows, conn,
+         "COPY song (ismn, title, release_date, duration, genre, artist_person_users_id, label_id) FROM STDIN",
+         song_lines(plan, blocks, labels))
+    step("artist_song", copy_rows, conn,
+         "COPY artist_song (artist_person_users_id, song_ismn) FROM STDIN",
+         artist_song_lines(plan, blocks))
+    step("album", copy_rows, conn,
+         "COPY album (id, title, release_date, artist_person_users_id, label_id) FROM STDIN",
+         album_lines(plan, blocks, labels, album_ids, tracks))
+    step("song_album", copy_rows, conn, "COPY song_album (song_ismn, album_id) FROM STDIN",
+         (f"{ismn}\t{album_id}\n" for album_id, songs in tracks for ismn in songs))
+    step("playlist", copy_rows, conn,
+         "COPY playlist (id, name, is_private, consumer_person_users_id) FROM STDIN",
+         playlist_lines(plan, playlist_ids, playlist_songs))
+    step("playlist_song", copy_rows, conn, "COPY playlist_song (playlist_id, song_ismn) FROM STDIN",
+         (f"{playlist_id}\t{ismn}\n" for playlist_id, songs in playlist_songs for ismn in songs))
+    step("subscription", copy_rows, conn,
+         "COPY subscription (id, init_date, end_date, purchase_date, plan_id, consumer_person_users_id) FROM STDIN",
+         subscription_lines(plan, subscription_ids, plans))
+    step("comment", copy_rows, conn,
+         "COPY comment (id, text, song_ismn, consumer_person_users_id, comment_id) FROM STDIN",
+         comment_lines(plan, comment_ids))
+    step("view", load_views, conn, options, base)
+
+    # explicit ids were copied, the sequences continue after them
+    for table, column in [
+        ("users", "id"), ("label", "id"), ("song", "ismn"), ("album", "id"),
+        ("playlist", "id"), ("subscription", "id"), ("comment", "id"), ("view", "id"),
+    ]:
+        conn.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'), "
+            f"(SELECT MAX({column}) FROM {table}))"
+        )
+
+    step("rollups", conn.execute, "SELECT rebuild_view_rollups()")
+    step("analyze", conn.execute, "ANALYZE")
+
+
+def parse_genres(text):
+    genres = {}
+
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        genres[name] = float(weight)
+
+    return genres
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spotsong synthetic data")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--consumers", type=int, default=10000)
+    parser.add_argument("--artists", type=int, default=500)
+    parser.add_argument("--labels", type=int, default=20)
+    parser.add_argument("--songs", type=int, default=50000)
+    parser.add_argument("--albums", type=int, default=5000)
+    parser.add_argument("--playlists", type=int, default=20000)
+    parser.add_argument("--comments", type=int, default=20000)
+    parser.add_argument("--views", type=int, default=1000000)
+    parser.add_argument(
+        "--subscribers", type=float, default=0.3,
+        help="share of the consumers with a subscription")
+    parser.add_argument("--song-skew", type=float, default=1.0)
+    parser.add_argument("--consumer-skew", type=float, default=0.8)
+    parser.add_argument(
+        "--genres", type=parse_genres, default=dict(default_genres),
+        help="genre=weight,... default "
+        + ",".join(f"{name}={weight}" for name, weight in default_genres.items()))
+    parser.add_argument("--months", type=float, default=12)
+    parser.add_argument(
+        "--end", type=datetime.date.fromisoformat, default=datetime.date.today(),
+        help="day after the last play (YYYY-MM-DD), today by default")
+    parser.add_argument(
+        "--growth", type=float, default=1.0,
+        help="how many times more plays the last day has than the first, minus one")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    options = parser.parse_args()
+
+    if options.artists < 1 or options.labels < 1 or options.consumers < 1:
+        sys.exit("at least one consumer, artist and label are needed")
+
+    generate(options)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+# =============================================
+# ============== Bases de Dados ===============
+# ============== LEI  2022/2023 ===============
+# =============================================
+#
+# Pre-fork server for the threaded mode. Run from src with:
+#   gunicorn -c gunicorn.conf.py "main:create_app()"
+#
+# Every worker imports main after the fork, so each one gets its own
+# connection pool, view buffer and hashing processes. SIGTERM stops the
+# workers once the requests in flight end (up to GRACEFUL_TIMEOUT) and SIGHUP
+# replaces them with new ones, picking up code and .env changes.
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = [os.getenv("BIND", "127.0.0.1:8080")]
+workers = int(os.getenv("WORKERS", str(os.cpu_count() or 1)))
+worker_class = "gthread"
+threads = int(os.getenv("THREADS", "8"))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+
+
+def worker_exit(server, worker):
+    # flush the views still queued before the worker goes away
+    import main
+
+    main.view_buffer.stop()
+    main.password_hasher.stop()
@@ -0,0 +1,642 @@
+# =============================================
+# ============== Bases de Dados ===============
+# ============== LEI  2022/2023 ===============
+# =============================================
+#
+# Load generator. The requests of postman/Spotsong.postman_collection.json
+# are the templates of weighted scenarios (signup, login, play, search,
+# subscribe, playlist, report and artist details), run by concurrent virtual
+# users against a running server. Throughput, latency percentiles and error
+# rates are reported per route and stored so runs can be compared.
+#
+# Run with:
+#   python loadtest.py --concurrency 32 --duration 60
+#   python loadtest.py --weights play=80,search=20 --label only-reads
+#   python loadtest.py --compare loadtest_results/A.json loadtest_results/B.json
+#
+# Every virtual user signs up its own consumer and buys a subscription before
+# the run starts, so playlists can be created. Song ids are read from the
+# database in .env, and cards are generated with the administrator account.
+
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from dotenv import load_dotenv
+
+import psycopg
+
+load_dotenv()
+
+collection_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..", "postman", "Spotsong.postman_collection.json")
+
+# scenario name: Postman request it is built from
+scenario_requests = {
+    "signup": "User Registration",
+    "login": "User Authentication",
+    "play": "Play Song",
+    "search": "Search Song",
+    "subscribe": "Subscribe to Premium",
+    "playlist": "Create Playlist",
+    "report": "Generate a monthly report",
+    "artist": "Detail Artist",
+}
+
+default_weights = {
+    "play": 50,
+    "search": 20,
+    "artist": 10,
+    "login": 5,
+    "playlist": 5,
+    "report": 5,
+    "subscribe": 3,
+    "signup": 2,
+}
+
+# keywords of the search scenario
+search_keywords = ["a", "e", "o", "am", "or", "the", "love", "rock", "ção"]
+
+# access tokens are refreshed a bit before ACCESS_TOKEN_MINUTES
+token_refresh_seconds = float(os.getenv("ACCESS_TOKEN_MINUTES", "5")) * 60 * 0.8
+
+
+##########################################################
+# POSTMAN COLLECTION
+##########################################################
+
+
+def load_templates(path):
+    # name: (method, path, body) of every request of the collection
+    with open(path, encoding="utf-8") as file:
+        collection = json.load(file)
+
+    templates = {}
+
+    for item in collection["item"]:
+        request = item["request"]
+        url = request["url"]["raw"] if isinstance(request["url"], dict) else request["url"]
+        raw = request.get("body", {}).get("raw", "")
+
+        templates[item["name"]] = (
+            request["method"],
+            urllib.parse.urlsplit(url).path,
+            json.loads(raw) if raw.strip() else {},
+        )
+
+    return templates
+
+
+##########################################################
+# RESULTS
+##########################################################
+
+
+class Recorder:
+    # latencies and outcomes per route of one virtual user, merged at the end
+    # so the users never contend on a lock
+
+    def __init__(self):
+        self.routes = {}
+        self.active = False
+
+    def record(self, route, seconds, outcome):
+        if not self.active:
+            return
+
+        if route not in self.routes:
+            self.routes[route] = {
+                "latencies": [], "ok": 0, "rejected": 0, "errors": 0}
+
+        stats = self.routes[route]
+        stats["latencies"].append(seconds)
+        stats[outcome] += 1
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(recorders, elapsed):
+    routes = {}
+
+    for recorder in recorders:
+        for route, stats in recorder.routes.items():
+            merged = routes.setdefault(
+                route, {"latencies": [], "ok": 0, "rejected": 0, "errors": 0})
+            merged["latencies"].extend(stats["latencies"])
+
+            for outcome in ("ok", "rejected", "errors"):
+                merged[outcome] += stats[outcome]
+
+    summary = {}
+
+    for route, stats in sorted(routes.items()):
+        ordered = sorted(stats["latencies"])
+        count = len(ordered)
+
+        summary[route] = {
+            "requests": count,
+            "throughput": count / elapsed,
+            "p50_ms": percentile(ordered, 0.50) * 1000,
+            "p90_ms": percentile(ordered, 0.90) * 1000,
+            "p95_ms": percentile(ordered, 0.95) * 1000,
+            "p99_ms": percentile(ordered, 0.99) * 1000,
+            "max_ms": ordered[-1] * 1000,
+            # API errors (status 400 in the body) are expected for some
+            # requests, such as a search with no results
+            "rejected_rate": stats["rejected"] / count,
+            "error_rate": stats["errors"] / count,
+        }
+
+    return summary
+
+
+def print_summary(summary, totals):
+    print(
+        f"{'route':<42} {'req':>8} {'req/s':>9} {'p50':>8} {'p95':>8} "
+        f"{'p99':>8} {'max':>8} {'rej%':>6} {'err%':>6}"
+    )
+
+    for route, stats in summary.items():
+        print(
+            f"{route:<42} {stats['requests']:>8} {stats['throughput']:>9.1f} "
+            f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} "
+            f"{stats['p99_ms']:>8.1f} {stats['max_ms']:>8.1f} "
+            f"{stats['rejected_rate'] * 100:>6.1f} {stats['error_rate'] * 100:>6.1f}"
+        )
+
+    print(
+        f"\n{totals['requests']} requests in {totals['seconds']:.1f}s: "
+        f"{totals['throughput']:.1f} req/s, "
+        f"{totals['error_rate'] * 100:.2f}% errors"
+    )
+
+
+def compare(old_path, new_path):
+    with open(old_path, encoding="utf-8") as file:
+        old = json.load(file)
+    with open(new_path, encoding="utf-8") as file:
+        new = json.load(file)
+
+    print(f"old: {old_path} ({old['label']})\nnew: {new_path} ({new['label']})\n")
+    print(
+        f"{'route':<42} {'req/s':>17} {'p50 ms':>17} {'p95 ms':>17} "
+        f"{'p99 ms':>17} {'err%':>13}"
+    )
+
+    def change(before, after):
+        if before is None or after is None:
+            return f"{'-':>17}"
+        return f"{after:>8.1f} ({(after - before) / before * 100 if before else 0:+5.0f}%)"
+
+    for route in sorted(set(old["routes"]) | set(new["routes"])):
+        before = old["routes"].get(route, {})
+        after = new["routes"].get(route, {})
+
+        print(
+            f"{route:<42} "
+            + " ".join(
+                change(before.get(key), after.get(key))
+                for key in ("throughput", "p50_ms", "p95_ms", "p99_ms")
+            )
+            + f" {before.get('error_rate', 0) * 100:>5.1f}->{after.get('error_rate', 0) * 100:<5.1f}"
+        )
+
+
+##########################################################
+# VIRTUAL USERS
+##########################################################
+
+
+class CardStock:
+    # prepaid cards for the subscribe scenario, generated in batches by the
+    # administrator. POST /dbproj/card answers with the ids of the cards, the
+    # codes are read from the database
+
+    def __init__(self, client, conn, batch):
+        self.client = client
+        self.conn = conn
+        self.batch = batch
+        self.cards = []
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if not self.cards:
+                response = self.client.call(
+                    "POST /dbproj/card", "POST", "/dbproj/card",
+                    {"token": self.client.token(), "number_cards": self.batch,
+                     "card_price": 10})
+
+                if response is None or response.get("status") != 200:
+                    return None
+
+                self.cards = [row[0] for row in self.conn.execute(
+                    "SELECT code FROM card WHERE id = ANY(%s)", [response["results"]])]
+
+            return self.cards.pop()
+
+
+class Client:
+    # one keep-alive connection to the server and the tokens of one user
+
+    def __init__(self, host, port, recorder, username, password):
+        self.host = host
+        self.port = port
+        self.recorder = recorder
+        self.username = username
+        self.password = password
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+        self.access_token = None
+        self.refresh_token = None
+        self.token_time = 0
+        # outcome of the last request, shown when the setup fails
+        self.last = None
+
+    def call(self, route, method, path, body):
+        data = json.dumps(body).encode("utf-8")
+
+        for attempt in range(2):
+            start = time.perf_counter()
+
+            try:
+                self.connection.request(
+                    method, path, data, {"Content-Type": "application/json"})
+                response = self.connection.getresponse()
+                content = response.read()
+                break
+            except (OSError, http.client.HTTPException) as error:
+                # a new connection is opened by the next request
+                self.connection.close()
+
+                # the server may close idle keep-alive connections, which is
+                # only seen when the next request is sent on them
+                if attempt == 0 and isinstance(
+                        error, (ConnectionError, http.client.RemoteDisconnected)):
+                    continue
+
+                self.last = f"{route}: {error!r}"
+                self.recorder.record(route, time.perf_counter() - start, "errors")
+                return None
+
+        seconds = time.perf_counter() - start
+
+        try:
+            payload = json.loads(content)
+        except ValueError:
+            payload = None
+
+        self.last = f"{route}: HTTP {response.status} {content[:200]!r}"
+
+        if response.status != 200 or not isinstance(payload, dict):
+            self.recorder.record(route, seconds, "errors")
+            return None
+
+        if payload.get("status") == 200:
+            self.recorder.record(route, seconds, "ok")
+        elif payload.get("status") == 400:
+            self.recorder.record(route, seconds, "rejected")
+        else:
+            self.recorder.record(route, seconds, "errors")
+
+        return payload
+
+    def login(self):
+        response = self.call(
+            "PUT /dbproj/user", "PUT", "/dbproj/user",
+            {"username": self.username, "password": self.password})
+
+        if response is None or response.get("status") != 200:
+            return False
+
+        self.access_token = response["results"]
+        self.refresh_token = response.get("refresh_token")
+        self.token_time = time.monotonic()
+        return True
+
+    def token(self):
+        # refreshed before it expires, so long runs keep their users
+        if time.monotonic() - self.token_time > token_refresh_seconds:
+            response = None
+
+            if self.refresh_token is not None:
+                response = self.call(
+                    "PUT /dbproj/token", "PUT", "/dbproj/token",
+                    {"refresh_token": self.refresh_token})
+
+            if response is not None and response.get("status") == 200:
+                # the refresh token is replaced every time it is used
+                self.access_token = response["results"]
+                self.refresh_token = response["refresh_token"]
+                self.token_time = time.monotonic()
+            else:
+                self.login()
+
+        return self.access_token
+
+
+class VirtualUser:
+    # a consumer running the weighted scenarios one after the other
+
+    def __init__(self, index, run, templates, options, songs, cards):
+        self.index = index
+        self.run = run
+        self.templates = templates
+        self.options = options
+        self.songs = songs
+        self.cards = cards
+        self.random = random.Random(options.seed * 100003 + index)
+        self.recorder = Recorder()
+        self.signups = 0
+        self.client = Client(
+            options.host, options.port, self.recorder,
+            f"lt{run}u{index}", f"lt{run}u{index}")
+
+        scenarios = [name for name, weight in options.weights.items() if weight > 0]
+        self.scenarios = scenarios
+        self.weights = [options.weights[name] for name in scenarios]
+
+    def template(self, scenario):
+        method, path, body = self.templates[scenario_requests[scenario]]
+        return method, path, dict(body)
+
+    def setup(self):
+        # not recorded: a consumer with an active subscription
+        if not self.signup(self.client.username) or not self.client.login():
+            return False
+
+        return self.subscribe()
+
+    def step(self):
+        scenario = self.random.choices(self.scenarios, self.weights)[0]
+        getattr(self, scenario)()
+
+    def signup(self, username=None):
+        if username is None:
+            self.signups += 1
+            username = f"lt{self.run}u{self.index}s{self.signups}"
+
+        method, path, body = self.template("signup")
+
+        # without token, artistic_name and label_id it is a consumer signup
+        for field in ("token", "artistic_name", "label_id"):
+            body.pop(field, None)
+
+        body.update({"username": username, "password": username,
+                     "email": f"{username}@loadtest"})
+
+        response = self.client.call(f"{method} /dbproj/user", method, path, body)
+        return response is not None and response.get("status") == 200
+
+    def login(self):
+        self.client.login()
+
+    def play(self):
+        method, path, body = self.template("play")
+        body["token"] = self.client.token()
+        song = self.song()
+
+        self.client.call(
+            f"{method} /dbproj/<song_id>", method, f"/dbproj/{song}", body)
+
+    def search(self):
+        method, path, body = self.template("search")
+        body["token"] = self.client.token()
+        keyword = urllib.parse.quote(self.random.choice(search_keywords))
+
+        self.client.call(
+            f"{method} /dbproj/song/<keyword>", method, f"/dbproj/song/{keyword}", body)
+
+    def artist(self):
+        method, path, body = self.template("artist")
+        body["token"] = self.client.token()
+
+        self.client.call(
+            f"{method} /dbproj/artist_info/<artist_id>", method,
+            f"/dbproj/artist_info/{self.random.choice(self.options.artists)}", body)
+
+    def subscribe(self):
+        card = self.cards.take()
+
+        if card is None:
+            self.client.last = f"no cards: {self.cards.client.last}"
+            return False
+
+        method, path, body = self.template("subscribe")
+        body.update({"token": self.client.token(), "period": "month", "cards": [card]})
+
+        response = self.client.call(f"{method} {path}", method, path, body)
+        return response is not None and response.get("status") == 200
+
+    def playlist(self):
+        method, path, body = self.template("playlist")
+        body.update({
+            "token": self.client.token(),
+            "playlist_name": f"lt{self.run}",
+            "songs": list({self.song() for _ in range(self.random.randint(1, 20))}),
+        })
+
+        self.client.call(f"{method} {path}", method, path, body)
+
+    def report(self):
+        method, path, body = self.template("report")
+        body["token"] = self.client.token()
+        today = datetime.date.today()
+
+        self.client.call(
+            f"{method} /dbproj/report/<year>-<month>", method,
+            f"/dbproj/report/{today.year}-{today.month}", body)
+
+    def song(self):
+        # popular songs are played more: the first ids of the shuffled list
+        # follow a Zipf-like distribution
+        rank = min(int(self.random.paretovariate(1.0)) - 1, len(self.songs) - 1)
+        return self.songs[rank]
+
+    def loop(self, start, warmup_end, end):
+        while time.monotonic() < start:
+            time.sleep(0.01)
+
+        while True:
+            now = time.monotonic()
+
+            if now >= end:
+                break
+
+            self.recorder.active = now >= warmup_end
+            self.step()
+
+        self.recorder.active = False
+
+
+def db_connection():
+    # the database the server uses
+    return psycopg.connect(
+        user=os.getenv("USER"),
+        password=os.getenv("PASSWORD"),
+        host=os.getenv("HOSTDB"),
+        port=os.getenv("PORTDB"),
+        dbname=os.getenv("NAMEDB"),
+        autocommit=True,
+    )
+
+
+def read_ids(conn, options):
+    # ids the scenarios pick from
+    songs = [row[0] for row in conn.execute(
+        "SELECT ismn FROM song ORDER BY ismn LIMIT %s", [options.max_songs])]
+    artists = [row[0] for row in conn.execute(
+        "SELECT person_users_id FROM artist ORDER BY person_users_id LIMIT 1000")]
+
+    return songs, artists
+
+
+def run(options):
+    templates = load_templates(options.collection)
+    conn = db_connection()
+    songs, options.artists = read_ids(conn, options)
+
+    if not songs or not options.artists:
+        sys.exit("there are no songs or artists in the database")
+
+    random.Random(options.seed).shuffle(songs)
+
+    admin = Client(options.host, options.port, Recorder(), *options.admin.split(":", 1))
+
+    if not admin.login():
+        sys.exit("administrator login failed")
+
+    cards = CardStock(admin, conn, options.card_batch)
+    run_id = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+
+    users = [
+        VirtualUser(index, run_id, templates, options, songs, cards)
+        for index in range(options.concurrency)
+    ]
+
+    # setup in parallel, signups are slow (bcrypt)
+    failed = []
+    threads = [
+        threading.Thread(target=lambda user=user: user.setup() or failed.append(user))
+        for user in users
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if failed:
+        sys.exit(
+            f"setup of {len(failed)} virtual users failed, "
+            f"last response: {failed[0].client.last}")
+
+    print(
+        f"{len(users)} virtual users ready, running for {options.duration}s "
+        f"after {options.warmup}s of warmup"
+    )
+
+    start = time.monotonic() + 0.5
+    warmup_end = start + options.warmup
+    end = warmup_end + options.duration
+
+    threads = [
+        threading.Thread(target=user.loop, args=(start, warmup_end, end))
+        for user in users
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.monotonic() - warmup_end
+    summary = summarize([user.recorder for user in users], elapsed)
+
+    requests = sum(stats["requests"] for stats in summary.values())
+    errors = sum(stats["requests"] * stats["error_rate"] for stats in summary.values())
+    totals = {
+        "requests": requests,
+        "seconds": elapsed,
+        "throughput": requests / elapsed,
+        "error_rate": errors / requests if requests else 0,
+    }
+
+    print_summary(summary, totals)
+
+    result = {
+        "label": options.label,
+        "started": run_id,
+        "target": f"{options.host}:{options.port}",
+        "concurrency": options.concurrency,
+        "duration": options.duration,
+        "warmup": options.warmup,
+        "seed": options.seed,
+        "weights": options.weights,
+        "totals": totals,
+        "routes": summary,
+    }
+
+    os.makedirs(options.results, exist_ok=True)
+    path = os.path.join(options.results, f"{run_id}-{options.label}.json")
+
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(result, file, indent=2)
+
+    print(f"results saved to {path}")
+
+
+def parse_weights(text):
+    weights = dict(default_weights)
+
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+
+        if name not in scenario_requests:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name}")
+
+        weights[name] = int(weight)
+
+    return weights
+
+
+def main():
+    host, _, port = os.getenv("BIND", "127.0.0.1:8080").rpartition(":")
+
+    parser = argparse.ArgumentParser(description="Spotsong load generator")
+    parser.add_argument("--host", default=host or "127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(port))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--weights", type=parse_weights, default=dict(default_weights),
+        help="scenario=weight,... over the defaults "
+        + ",".join(f"{name}={weight}" for name, weight in default_weights.items()))
+    parser.add_argument("--admin", default="admin:admin", help="username:password")
+    parser.add_argument("--card-batch", type=int, default=100)
+    parser.add_argument("--max-songs", type=int, default=100000)
+    parser.add_argument("--collection", default=collection_path)
+    parser.add_argument("--results", default="loadtest_results")
+    parser.add_argument("--label", default="run")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    options = parser.parse_args()
+
+    if options.compare:
+        compare(*options.compare)
+    else:
+        run(options)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,15 +13,37 @@
 #   BD 2022 Team - https://dei.uc.pt/lei/
 #   University of Coimbra
 
+import atexit
+import base64
+import binascii
 import bcrypt
+import bisect
+import collections
+import concurrent.futures
+import contextvars
+import dataclasses
 import flask
+import hashlib
 import logging
+import logging.handlers
+import multiprocessing
 import psycopg
+import psycopg.sql
+import functools
 import jwt
+import json
 import datetime
 import os
+import queue
 import random
+import re
+import secrets
+import signal
+import sys
+import threading
+import time
 from dotenv import load_dotenv
+from psycopg_pool import ConnectionPool
 
 load_dotenv()
 
@@ -33,6 +55,75 @@ hostdb = os.getenv("HOSTDB")
 portdb = os.getenv("PORTDB")
 namedb = os.getenv("NAMEDB")
 
+# connection pool settings
+pool_min_size = int(os.getenv("POOL_MIN_SIZE", "2"))
+pool_max_size = int(os.getenv("POOL_MAX_SIZE", "10"))
+pool_timeout = float(os.getenv("POOL_TIMEOUT", "30"))
+pool_max_lifetime = float(os.getenv("POOL_MAX_LIFETIME", "3600"))
+
+# page size of paginated endpoints (song search, artist details)
+page_limit = int(os.getenv("PAGE_LIMIT", "50"))
+page_max_limit = int(os.getenv("PAGE_MAX_LIMIT", "500"))
+
+# how long an artist profile may be served from the cache
+artist_cache_size = int(os.getenv("ARTIST_CACHE_SIZE", "10000"))
+artist_cache_ttl = float(os.getenv("ARTIST_CACHE_TTL", "60"))
+
+# how long the roles of a user may be served from the cache
+role_cache_size = int(os.getenv("ROLE_CACHE_SIZE", "100000"))
+role_cache_ttl = float(os.getenv("ROLE_CACHE_TTL", "300"))
+
+# token lifetimes: access tokens are short lived and exchanged for new ones
+# with a refresh token, which is replaced by a new one every time it is used
+access_token_minutes = float(os.getenv("ACCESS_TOKEN_MINUTES", "5"))
+refresh_token_days = float(os.getenv("REFRESH_TOKEN_DAYS", "30"))
+
+# password hashing settings: bcrypt cost, worker processes and how many
+# hashes may be waiting for a worker before logins are turned away
+bcrypt_rounds = int(os.getenv("BCRYPT_ROUNDS", "12"))
+hash_workers = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+hash_max_pending = int(os.getenv("HASH_MAX_PENDING", "64"))
+hash_queue_timeout = float(os.getenv("HASH_QUEUE_TIMEOUT", "5"))
+
+# most cards a single request may generate
+card_max_number = int(os.getenv("CARD_MAX_NUMBER", "100000"))
+
+# slow query log: statements slower than SLOW_QUERY_MS are written to a
+# rotating file, and a share of the slow SELECTs is explained
+slow_query_ms = float(os.getenv("SLOW_QUERY_MS", "200"))
+slow_query_explain_rate = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", "0"))
+slow_query_file = os.getenv("SLOW_QUERY_FILE", "slow_queries.log")
+slow_query_file_bytes = int(os.getenv("SLOW_QUERY_FILE_BYTES", "10485760"))
+slow_query_file_backups = int(os.getenv("SLOW_QUERY_FILE_BACKUPS", "5"))
+slow_query_keep = int(os.getenv("SLOW_QUERY_KEEP", "200"))
+
+# server settings: address to listen on, worker processes (gunicorn and the
+# async mode) and threads per worker, and how long shutdowns wait for
+# requests in flight
+server_bind = os.getenv("BIND", "127.0.0.1:8080")
+server_workers = int(os.getenv("WORKERS", str(os.cpu_count() or 1)))
+server_threads = int(os.getenv("THREADS", "8"))
+server_graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+server_debug = os.getenv("DEBUG", "0") == "1"
+
+# play ingestion settings: "sync" inserts every play on the request,
+# "buffered" queues it and writes it later in batches. batches that can't be
+# written are kept in the spill file and written again later
+view_ingestion = os.getenv("VIEW_INGESTION", "sync")
+view_buffer_size = int(os.getenv("VIEW_BUFFER_SIZE", "10000"))
+view_batch_size = int(os.getenv("VIEW_BATCH_SIZE", "500"))
+view_flush_interval = float(os.getenv("VIEW_FLUSH_INTERVAL", "1"))
+view_enqueue_timeout = float(os.getenv("VIEW_ENQUEUE_TIMEOUT", "0.5"))
+view_spill_file = os.getenv("VIEW_SPILL_FILE", "view_spill.tsv")
+
+# partition maintenance: when view is partitioned (migration 0006) every
+# worker runs maintain_view_partitions() on start and every interval seconds,
+# creating the partitions of the next months and, if PARTITION_KEEP_MONTHS
+# is set, archiving the older ones
+partition_interval = float(os.getenv("PARTITION_INTERVAL", "3600"))
+partition_months_ahead = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+partition_keep_months = int(os.getenv("PARTITION_KEEP_MONTHS") or 0) or None
+
 # set up logging
 logging.basicConfig(filename="log_file.log")
 logger = logging.getLogger("logger")
@@ -40,32 +131,1466 @@ logger.setLevel(logging.DEBUG)
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
 
-# create formatter
-formatter = logging.Formatter(
-    "%(asctime)s [%(levelname)s]:  %(message)s", "%H:%M:%S")
-ch.setFormatter(formatter)
-logger.addHandler(ch)
+# create formatter
+formatter = logging.Formatter(
+    "%(asctime)s [%(levelname)s]:  %(message)s", "%H:%M:%S")
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# the routes are registered on the app built by create_app()
+api = flask.Blueprint("api", __name__)
+
+StatusCodes = {"success": 200, "api_error": 400, "internal_error": 500}
+
+
+##########################################################
+# METRICS
+##########################################################
+
+
+# upper bounds, in seconds, of the request latency histogram buckets
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# upper bounds of the queries per request histogram buckets
+query_buckets = (1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    # cumulative counts are only built when the metrics are rendered
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # estimated by linear interpolation inside the bucket, like
+        # histogram_quantile() in Prometheus
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+
+                lower = self.buckets[index - 1] if index > 0 else 0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / count
+
+            seen += count
+
+        return self.buckets[-1]
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+
+        return lines
+
+
+class RequestMetrics:
+    # per route request counts, latency, database time, queries and pool
+    # wait, kept per process. recording is a few additions under a lock, so
+    # it stays on in production
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.requests = collections.Counter()
+
+    def observe(self, route, method, status, seconds, usage):
+        with self.lock:
+            if route not in self.routes:
+                self.routes[route] = {
+                    "latency": Histogram(latency_buckets),
+                    "queries": Histogram(query_buckets),
+                    "db_seconds": 0.0,
+                    "pool_wait_seconds": 0.0,
+                    "errors": 0,
+                }
+
+            metrics = self.routes[route]
+            metrics["latency"].observe(seconds)
+            metrics["queries"].observe(usage["queries"])
+            metrics["db_seconds"] += usage["db_seconds"]
+            metrics["pool_wait_seconds"] += usage["pool_wait_seconds"]
+
+            if status >= 500:
+                metrics["errors"] += 1
+
+            self.requests[(route, method, status)] += 1
+
+    def summary(self):
+        # latency percentiles per route, for /dbproj/stats
+        with self.lock:
+            return {
+                route: {
+                    "requests": metrics["latency"].count,
+                    "errors": metrics["errors"],
+                    "p50": metrics["latency"].quantile(0.5),
+                    "p95": metrics["latency"].quantile(0.95),
+                    "p99": metrics["latency"].quantile(0.99),
+                    "db_seconds": metrics["db_seconds"],
+                    "pool_wait_seconds": metrics["pool_wait_seconds"],
+                }
+                for route, metrics in self.routes.items()
+            }
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+
+        with self.lock:
+            lines.append("# TYPE spotsong_requests_total counter")
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append(
+                    f'spotsong_requests_total{{route="{route}",method="{method}",status="{status}"}} {count}'
+                )
+
+            lines.append("# TYPE spotsong_request_duration_seconds histogram")
+            for route, metrics in sorted(self.routes.items()):
+                lines.extend(
+                    metrics["latency"].render(
+                        "spotsong_request_duration_seconds", f'route="{route}"')
+                )
+
+            lines.append("# TYPE spotsong_request_queries histogram")
+            for route, metrics in sorted(self.routes.items()):
+                lines.extend(
+                    metrics["queries"].render(
+                        "spotsong_request_queries", f'route="{route}"')
+                )
+
+            for name in ("db_seconds", "pool_wait_seconds", "errors"):
+                lines.append(f"# TYPE spotsong_request_{name}_total counter")
+                for route, metrics in sorted(self.routes.items()):
+                    lines.append(
+                        f'spotsong_request_{name}_total{{route="{route}"}} {metrics[name]}'
+                    )
+
+        return lines
+
+
+request_metrics = RequestMetrics()
+
+# database usage of the request being served, None outside of requests
+request_usage = contextvars.ContextVar("request_usage", default=None)
+
+
+def start_request_usage(route):
+    usage = {
+        "route": route, "queries": 0, "db_seconds": 0.0, "pool_wait_seconds": 0.0}
+    request_usage.set(usage)
+    return usage
+
+
+def record_query(seconds):
+    usage = request_usage.get()
+
+    if usage is not None:
+        usage["queries"] += 1
+        usage["db_seconds"] += seconds
+
+
+def record_pool_wait(seconds):
+    usage = request_usage.get()
+
+    if usage is not None:
+        usage["pool_wait_seconds"] += seconds
+
+
+class MetricsJSONProvider(flask.json.provider.DefaultJSONProvider):
+    # endpoints report errors in the "status" of the body rather than the
+    # HTTP status, so it is picked up here when flask.jsonify builds it
+
+    def response(self, *args, **kwargs):
+        if len(args) == 1 and isinstance(args[0], dict) and "status" in args[0]:
+            flask.g.api_status = args[0]["status"]
+
+        return super().response(*args, **kwargs)
+
+
+@api.before_app_request
+def before_request_metrics():
+    flask.g.request_start = time.perf_counter()
+    rule = flask.request.url_rule
+    flask.g.request_usage = start_request_usage(
+        rule.rule if rule is not None else "unmatched")
+
+
+@api.after_app_request
+def after_request_metrics(response):
+    if "request_start" in flask.g:
+        request_metrics.observe(
+            flask.g.request_usage["route"],
+            flask.request.method,
+            flask.g.get("api_status", response.status_code),
+            time.perf_counter() - flask.g.request_start,
+            flask.g.request_usage,
+        )
+
+    return response
+
+
+##########################################################
+# SLOW QUERIES
+##########################################################
+
+
+def statement_text(cursor, query):
+    if isinstance(query, psycopg.sql.Composable):
+        return query.as_string(cursor)
+
+    if isinstance(query, bytes):
+        return query.decode("utf-8")
+
+    return query
+
+
+def normalize_statement(text):
+    # one line, with literals replaced so equal statements group together
+    text = re.sub(r"'(?:[^']|'')*'", "?", text)
+    text = re.sub(r"\b\d+(?:\.\d+)?\b", "?", text)
+    return " ".join(text.split())
+
+
+def params_shape(params):
+    # types of the parameters, never their values
+    def shape(value):
+        if isinstance(value, (list, tuple)):
+            return f"{type(value).__name__}[{len(value)}]"
+        return type(value).__name__
+
+    if params is None:
+        return None
+
+    if isinstance(params, dict):
+        return {key: shape(value) for key, value in params.items()}
+
+    return [shape(value) for value in params]
+
+
+# SELECT, or WITH ... SELECT without data-modifying statements
+read_only_statement = re.compile(
+    r"(?is)^(?:SELECT\b|WITH\b(?!.*\b(?:INSERT|UPDATE|DELETE|MERGE)\b))")
+
+# reads that lock the rows they return
+locking_clause = re.compile(r"(?is)\bFOR\s+(?:NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b")
+
+# SELECT without FROM, a call of functions such as refresh_top10s() or
+# maintain_view_partitions(), which may write or take locks
+function_call = re.compile(r"(?is)^SELECT\b(?!.*\bFROM\b)")
+
+
+class SlowQueryLog:
+    # statements slower than threshold seconds, written as JSON lines to a
+    # rotating file and kept in memory for /dbproj/slow_queries. a sample of
+    # the slow SELECTs is explained, see explain_statements()
+
+    def __init__(self, threshold, explain_rate, path, max_bytes, backups, keep):
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+        self.entries = collections.deque(maxlen=keep)
+        self.lock = threading.Lock()
+
+        self.logger = logging.getLogger("slow_queries")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.addHandler(
+            logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backups, delay=True)
+        )
+
+    def entry(self, cursor, query, params, seconds):
+        usage = request_usage.get()
+        text = statement_text(cursor, query)
+
+        return {
+            "time": datetime.datetime.now().isoformat(),
+            "endpoint": usage["route"] if usage is not None else None,
+            "duration_ms": round(seconds * 1000, 3),
+            "statement": normalize_statement(text),
+            "params": params_shape(params),
+            "plan": None,
+        }, text
+
+    def explains(self, entry):
+        # ANALYZE runs the statement again, so only reads are explained
+        return (
+            self.explain_rate > 0
+            and read_only_statement.match(entry["statement"]) is not None
+            and random.random() < self.explain_rate
+        )
+
+    def explain_statements(self, text):
+        # ANALYZE runs the statement again, so it is only used in read only
+        # mode, and never for reads that lock rows or call functions, which
+        # only get their plan
+        if locking_clause.search(text) or function_call.match(text):
+            return ["EXPLAIN " + text]
+
+        return ["SET LOCAL transaction_read_only = on", "EXPLAIN (ANALYZE, BUFFERS) " + text]
+
+    def add(self, entry):
+        with self.lock:
+            self.entries.append(entry)
+
+        self.logger.info(json.dumps(entry, default=str))
+
+    def recent(self):
+        with self.lock:
+            return list(reversed(self.entries))
+
+
+slow_query_log = SlowQueryLog(
+    slow_query_ms / 1000,
+    slow_query_explain_rate,
+    slow_query_file,
+    slow_query_file_bytes,
+    slow_query_file_backups,
+    slow_query_keep,
+)
+
+
+class TimedCursor(psycopg.Cursor):
+    # cursor of every pooled connection, times the statements of the request
+    # and logs the slow ones
+
+    def execute(self, query, params=None, **kwargs):
+        if not query:
+            # connection check of the pool, counted in the pool wait
+            return super().execute(query, params, **kwargs)
+
+        start = time.perf_counter()
+        failed = True
+
+        try:
+            result = super().execute(query, params, **kwargs)
+            failed = False
+        finally:
+            seconds = time.perf_counter() - start
+            record_query(seconds)
+
+            if seconds >= slow_query_log.threshold:
+                self.log_slow_query(query, params, seconds, not failed)
+
+        return result
+
+    def executemany(self, query, params_seq, **kwargs):
+        start = time.perf_counter()
+
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            record_query(seconds)
+
+            if seconds >= slow_query_log.threshold:
+                self.log_slow_query(query, None, seconds, False)
+
+    def log_slow_query(self, query, params, seconds, explain):
+        entry, text = slow_query_log.entry(self, query, params, seconds)
+
+        if explain and slow_query_log.explains(entry):
+            # a savepoint when called inside a transaction of the endpoint.
+            # it is always rolled back, so nothing done while explaining is
+            # kept
+            try:
+                with self.connection.transaction() as explaining:
+                    cur = psycopg.Cursor(self.connection)
+                    *setup, explain = slow_query_log.explain_statements(text)
+
+                    for statement in setup:
+                        cur.execute(statement)
+
+                    cur.execute(explain, params)
+                    entry["plan"] = [row[0] for row in cur.fetchall()]
+                    raise psycopg.Rollback(explaining)
+            except psycopg.Error as error:
+                entry["plan"] = f"EXPLAIN failed: {error}"
+
+        slow_query_log.add(entry)
+
+
+class TimedAsyncCursor(psycopg.AsyncCursor):
+    # same as TimedCursor, for the async connections of async_main
+
+    async def execute(self, query, params=None, **kwargs):
+        if not query:
+            # connection check of the pool, counted in the pool wait
+            return await super().execute(query, params, **kwargs)
+
+        start = time.perf_counter()
+        failed = True
+
+        try:
+            result = await super().execute(query, params, **kwargs)
+            failed = False
+        finally:
+            seconds = time.perf_counter() - start
+            record_query(seconds)
+
+            if seconds >= slow_query_log.threshold:
+                await self.log_slow_query(query, params, seconds, not failed)
+
+        return result
+
+    async def executemany(self, query, params_seq, **kwargs):
+        start = time.perf_counter()
+
+        try:
+            return await super().executemany(query, params_seq, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            record_query(seconds)
+
+            if seconds >= slow_query_log.threshold:
+                await self.log_slow_query(query, None, seconds, False)
+
+    async def log_slow_query(self, query, params, seconds, explain):
+        entry, text = slow_query_log.entry(self, query, params, seconds)
+
+        if explain and slow_query_log.explains(entry):
+            try:
+                async with self.connection.transaction() as explaining:
+                    cur = psycopg.AsyncCursor(self.connection)
+                    *setup, explain = slow_query_log.explain_statements(text)
+
+                    for statement in setup:
+                        await cur.execute(statement)
+
+                    await cur.execute(explain, params)
+                    entry["plan"] = [row[0] for row in await cur.fetchall()]
+                    raise psycopg.Rollback(explaining)
+            except psycopg.Error as error:
+                entry["plan"] = f"EXPLAIN failed: {error}"
+
+        slow_query_log.add(entry)
+
+
+##########################################################
+# DATABASE ACCESS
+##########################################################
+
+
+# shared by the thread pool here and the asyncio pool of async_main
+db_connect_kwargs = {
+    "user": userdb,
+    "password": passdb,
+    "host": hostdb,
+    "port": portdb,
+    "dbname": namedb,
+    # transactions are controlled with explicit BEGIN/COMMIT
+    "autocommit": True,
+}
+
+db_pool = None
+db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    # the pool is created on first use, so every process gets its own
+    global db_pool
+
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                db_pool = ConnectionPool(
+                    kwargs={**db_connect_kwargs, "cursor_factory": TimedCursor},
+                    min_size=pool_min_size,
+                    max_size=pool_max_size,
+                    timeout=pool_timeout,
+                    max_lifetime=pool_max_lifetime,
+                    check=ConnectionPool.check_connection,
+                    name="spotsong",
+                    open=True,
+                )
+
+    return db_pool
+
+
+def db_connection():
+    # waits up to pool_timeout for a free connection, raises PoolTimeout otherwise
+    start = time.perf_counter()
+    conn = get_db_pool().getconn()
+    record_pool_wait(time.perf_counter() - start)
+
+    return conn
+
+
+def release_connection(conn):
+    # gives the connection back to the pool, rolling back any open transaction
+    get_db_pool().putconn(conn)
+
+
+##########################################################
+# QUERIES
+##########################################################
+
+
+class QueryRegistry:
+    # named statements for the hot paths. handlers run them with
+    # queries.execute(cur, name, values), and psycopg prepares each one on
+    # the server the first time a pooled connection runs it, reusing the
+    # plan after that. the time spent in each statement is kept by name
+
+    def __init__(self):
+        self.statements = {}
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def register(self, name, statement):
+        if name in self.statements:
+            raise ValueError(f"query {name} is already registered")
+
+        self.statements[name] = statement
+        self.stats[name] = {"calls": 0, "seconds": 0.0, "max_seconds": 0.0}
+
+    def record(self, name, seconds):
+        with self.lock:
+            stats = self.stats[name]
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def execute(self, cur, name, values=None):
+        # cur may be a cursor or a connection, the cursor is returned
+        start = time.perf_counter()
+
+        try:
+            return cur.execute(self.statements[name], values, prepare=True)
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    async def execute_async(self, conn, name, values=None):
+        # same as execute, for the async connections of async_main
+        start = time.perf_counter()
+
+        try:
+            return await conn.execute(self.statements[name], values, prepare=True)
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+
+queries = QueryRegistry()
+
+
+##########################################################
+# PAGINATION
+##########################################################
+
+
+def page_size(payload):
+    # ValueError when the limit is not a whole number
+    limit = payload.get("limit", page_limit)
+
+    if isinstance(limit, bool) or not isinstance(limit, (int, str)):
+        raise ValueError("invalid limit")
+
+    return max(1, min(int(limit), page_max_limit))
+
+
+def encode_cursor(values):
+    # opaque token holding the sort key of the last row of a page
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(token):
+    if not isinstance(token, str):
+        raise ValueError("invalid cursor")
+
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except (binascii.Error, UnicodeError, ValueError) as error:
+        raise ValueError("invalid cursor") from error
+
+
+##########################################################
+# CACHES
+##########################################################
+
+
+class TTLCache:
+    # thread safe LRU cache whose entries expire after ttl seconds. values
+    # loaded before an invalidation are not stored, see generation()
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.invalidations = 0
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[1] < time.monotonic():
+                self.stats["misses"] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def generation(self):
+        # take it before loading a value and hand it to set()
+        with self.lock:
+            return self.invalidations
+
+    def set(self, key, value, generation):
+        with self.lock:
+            if generation != self.invalidations:
+                return
+
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.invalidations += 1
+            self.stats["invalidations"] += 1
+
+
+# songs, albums and public playlists of each artist, by artist id
+artist_cache = TTLCache(artist_cache_size, artist_cache_ttl)
+
+
+queries.register("artist_profile", """
+SELECT
+artist.artistic_name,
+song.ismn,
+song_album.album_id,
+NULL AS playlist_id
+FROM
+artist
+LEFT JOIN song ON artist.person_users_id = song.artist_person_users_id
+LEFT JOIN song_album ON song.ismn = song_album.song_ismn
+WHERE
+artist.person_users_id = %(artist_id)s
+
+UNION
+
+SELECT
+artist.artistic_name,
+song.ismn,
+NULL AS album_id,
+playlist_song.playlist_id
+FROM
+artist
+JOIN song ON artist.person_users_id = song.artist_person_users_id
+JOIN playlist_song ON song.ismn = playlist_song.song_ismn
+JOIN playlist ON playlist_song.playlist_id = playlist.id
+WHERE
+artist.person_users_id = %(artist_id)s
+AND playlist.is_private = false
+ORDER BY
+2;
+""")
+
+
+def get_artist_profile(cur, artist_id):
+    # returns None when the artist doesn't exist
+    profile = artist_cache.get(artist_id)
+
+    if profile is not None:
+        return profile
+
+    generation = artist_cache.generation()
+
+    values = {"artist_id": artist_id}
+    queries.execute(cur, "artist_profile", values)
+
+    profile = build_artist_profile(cur.fetchall())
+
+    if profile is not None:
+        artist_cache.set(artist_id, profile, generation)
+
+    return profile
+
+
+def build_artist_profile(all):
+    # builds the profile from the rows of the artist_profile query
+    if len(all) == 0:
+        return None
+
+    # albums and public playlists are kept per song, so a page of songs can
+    # be served without going back to the database
+    profile = {"name": all[0][0], "songs": [], "albuns": {}, "playlists": {}}
+
+    for linha in all:
+        if linha[1] is None:
+            continue
+        if linha[1] not in profile["albuns"]:
+            profile["songs"].append(linha[1])
+            profile["albuns"][linha[1]] = []
+            profile["playlists"][linha[1]] = []
+        if linha[2] is not None:
+            profile["albuns"][linha[1]].append(linha[2])
+        if linha[3] is not None:
+            profile["playlists"][linha[1]].append(linha[3])
+
+    return profile
+
+
+##########################################################
+# AUTHENTICATION
+##########################################################
+
+
+@dataclasses.dataclass(frozen=True)
+class Principal:
+    # the user behind a token and the roles they have
+    user_id: int
+    is_consumer: bool
+    is_artist: bool
+    is_administrator: bool
+
+
+# Principal of each user, by user id
+role_cache = TTLCache(role_cache_size, role_cache_ttl)
+
+
+def issue_access_token(user_id):
+    return jwt.encode(
+        {
+            "user_id": user_id,
+            "exp": (
+                datetime.datetime.now()
+                + datetime.timedelta(minutes=access_token_minutes)
+            ).timestamp(),
+        },
+        secret_key,
+        algorithm="HS256",
+    )
+
+
+def new_refresh_token():
+    # only the hash of the token is stored, the token itself is a random
+    # secret that is given to the client once
+    return secrets.token_urlsafe(32)
+
+
+def refresh_token_expires():
+    return datetime.datetime.now() + datetime.timedelta(days=refresh_token_days)
+
+
+def refresh_token_hash(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+# the revoked and expired refresh tokens of a user are deleted whenever
+# the user is given a new one
+queries.register("issue_refresh_token", """
+WITH pruned AS (
+    DELETE FROM refresh_token
+    WHERE users_id = %(user_id)s AND (revoked OR expires < %(now)s)
+)
+INSERT INTO refresh_token (token_hash, expires, users_id)
+VALUES (%(token_hash)s, %(expires)s, %(user_id)s);
+""")
+
+
+def issue_refresh_token(cur, user_id):
+    token = new_refresh_token()
+
+    values = {
+        "user_id": user_id,
+        "token_hash": refresh_token_hash(token),
+        "expires": refresh_token_expires(),
+        "now": datetime.datetime.now(),
+    }
+    queries.execute(cur, "issue_refresh_token", values)
+
+    return token
+
+
+# a refresh token is used only once: it is deleted and, if it was still
+# valid, replaced by a new one for the same user. when the same token is
+# used twice at the same time, the second DELETE finds nothing
+queries.register("rotate_refresh_token", """
+WITH used AS (
+    DELETE FROM refresh_token
+    WHERE token_hash = %(used_hash)s
+    RETURNING users_id, expires, revoked
+),
+pruned AS (
+    DELETE FROM refresh_token r
+    USING used
+    WHERE r.users_id = used.users_id
+    AND r.token_hash <> %(used_hash)s
+    AND (r.revoked OR r.expires < %(now)s)
+)
+INSERT INTO refresh_token (token_hash, expires, users_id)
+SELECT %(token_hash)s, %(expires)s, users_id
+FROM used
+WHERE NOT revoked AND expires >= %(now)s
+RETURNING users_id;
+""")
+
+
+def rotate_refresh_token_values(token):
+    # values of rotate_refresh_token and the new token they hold
+    new_token = new_refresh_token()
+
+    values = {
+        "used_hash": refresh_token_hash(token),
+        "token_hash": refresh_token_hash(new_token),
+        "expires": refresh_token_expires(),
+        "now": datetime.datetime.now(),
+    }
+
+    return values, new_token
+
+
+def decode_token(token):
+    # returns the user id in the token, raises jwt.InvalidTokenError
+    credentials = jwt.decode(token, secret_key, algorithms="HS256")
+
+    if "user_id" not in credentials:
+        raise jwt.exceptions.InvalidTokenError("user_id not in token")
+
+    return credentials["user_id"]
+
+
+queries.register("principal", """
+SELECT
+EXISTS (SELECT 1 FROM consumer WHERE person_users_id = %(user_id)s),
+EXISTS (SELECT 1 FROM artist WHERE person_users_id = %(user_id)s),
+EXISTS (SELECT 1 FROM administrator WHERE users_id = %(user_id)s);
+""")
+
+
+def resolve_principal(user_id, cur=None):
+    # cur lets callers that already hold a connection reuse it
+    principal = role_cache.get(user_id)
+
+    if principal is not None:
+        return principal
+
+    generation = role_cache.generation()
+
+    values = {"user_id": user_id}
+
+    if cur is not None:
+        queries.execute(cur, "principal", values)
+        row = cur.fetchone()
+    else:
+        conn = db_connection()
+        try:
+            row = queries.execute(conn, "principal", values).fetchone()
+        finally:
+            release_connection(conn)
+
+    principal = Principal(user_id, *row)
+    role_cache.set(user_id, principal, generation)
+
+    return principal
+
+
+def invalidate_principal(user_id):
+    # must be called whenever the roles of a user change
+    role_cache.invalidate(user_id)
+
+
+def authenticated(role=None, denied="Invalid token"):
+    # decorator for endpoints that take a token in the payload. the endpoint
+    # gets the Principal as its first argument and is only called when the
+    # user has the role ("consumer", "artist" or "administrator"), otherwise
+    # the denied message is returned
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            payload = flask.request.get_json()
+
+            if "token" not in payload:
+                response = {
+                    "status": StatusCodes["api_error"],
+                    "results": "token value not in payload",
+                }
+                return flask.jsonify(response)
+
+            try:
+                user_id = decode_token(payload["token"])
+
+            except jwt.exceptions.ExpiredSignatureError:
+                response = {
+                    "status": StatusCodes["api_error"],
+                    "results": "token invalido. tente autenticar novamente",
+                }
+                return flask.jsonify(response)
+
+            except jwt.exceptions.InvalidTokenError:
+                response = {
+                    "status": StatusCodes["api_error"], "results": "Invalid token"}
+                return flask.jsonify(response)
+
+            principal = resolve_principal(user_id)
+
+            if role is not None and not getattr(principal, f"is_{role}"):
+                response = {
+                    "status": StatusCodes["api_error"], "results": denied}
+                return flask.jsonify(response)
+
+            return endpoint(principal, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+##########################################################
+# PASSWORD HASHING
+##########################################################
 
-app = flask.Flask(__name__)
 
-StatusCodes = {"success": 200, "api_error": 400, "internal_error": 500}
+def hash_password(password, rounds):
+    # runs on the hashing workers
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def check_password(password, hashed):
+    # runs on the hashing workers
+    return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+
+
+class PasswordHasher:
+    # bcrypt is CPU bound, so it runs on a fixed number of worker processes
+    # instead of the request threads, and a burst of logins can't take every
+    # core. at most max_pending hashes are queued or running, callers wait up
+    # to queue_timeout for a slot and get None back if none frees up
+
+    def __init__(self, workers, max_pending, queue_timeout, rounds):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.rounds = rounds
+        self.executor = None
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.stats = {
+            "pending": 0,
+            "hashed": 0,
+            "checked": 0,
+            "rehashed": 0,
+            "rejected": 0,
+            "seconds": 0.0,
+        }
+
+    def after_fork(self):
+        self.executor = None
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.stats["pending"] = 0
+
+    def get_executor(self):
+        # the workers are started on first use, so every process gets its own.
+        # they are spawned rather than forked, as this process has threads
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None and multiprocessing.current_process().daemon:
+                    # daemonic processes (the async mode workers) can't have
+                    # children. bcrypt releases the GIL, so threads still keep
+                    # it off the request threads
+                    self.executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="hasher"
+                    )
+                elif self.executor is None:
+                    self.executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+
+        return self.executor
+
+    def run(self, stat, function, *args):
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            with self.lock:
+                self.stats["rejected"] += 1
+            return None
+
+        with self.lock:
+            self.stats["pending"] += 1
+
+        start = time.monotonic()
+
+        try:
+            executor = self.get_executor()
+            return executor.submit(function, *args).result()
+
+        except concurrent.futures.process.BrokenProcessPool:
+            # a worker died, the next call starts a new pool
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = None
+            raise
+
+        finally:
+            self.slots.release()
+
+            with self.lock:
+                self.stats["pending"] -= 1
+                self.stats[stat] += 1
+                self.stats["seconds"] += time.monotonic() - start
+
+    def hash(self, password):
+        return self.run("hashed", hash_password, password, self.rounds)
+
+    def check(self, password, hashed):
+        return self.run("checked", check_password, password, hashed)
+
+    def rehash(self, password):
+        return self.run("rehashed", hash_password, password, self.rounds)
+
+    def needs_rehash(self, hashed):
+        # bcrypt hashes look like $2b$<rounds>$<salt and hash>
+        return int(hashed.split("$")[2]) != self.rounds
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+password_hasher = PasswordHasher(
+    hash_workers, hash_max_pending, hash_queue_timeout, bcrypt_rounds
+)
+atexit.register(password_hasher.stop)
 
 
 ##########################################################
-# DATABASE ACCESS
+# PLAY INGESTION
 ##########################################################
 
 
-def db_connection():
-    db = psycopg.connect(
-        user=userdb,
-        password=passdb,
-        host=hostdb,
-        port=portdb,
-        dbname=namedb,
-    )
+class ViewBuffer:
+    # write-behind buffer for song views: requests only enqueue the view and
+    # a background thread writes them with COPY, batch_size at a time or
+    # every flush_interval seconds, whichever comes first.
+    #
+    # a batch that fails on a deadlock, a serialization failure or a lost
+    # connection is written again after a backoff, as many times as needed.
+    # one that fails flush_attempts times on any other error, or can't be
+    # written while shutting down, is appended to the spill file, which is
+    # written again every replay_interval seconds.
+    #
+    # when a batch is rejected for its data (a value out of range, a consumer
+    # that no longer exists) its views are written one at a time, and the
+    # ones rejected again are moved to the {spill_file}.rejected file, so a
+    # bad view never holds back the rest of its batch
+
+    flush_attempts = 3
+    retry_delay = 0.1
+    retry_max_delay = 5
+    replay_interval = 60
+
+    def __init__(self, max_size, batch_size, flush_interval, spill_file):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_file = spill_file
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.next_replay = 0
+        self.stats = {
+            "queued": 0,
+            "rejected": 0,
+            "flushed": 0,
+            "dropped": 0,
+            "batches": 0,
+            "retries": 0,
+            "spilled": 0,
+            "replayed": 0,
+            "quarantined": 0,
+        }
+
+    def after_fork(self):
+        # the views queued in the parent are still flushed by the parent
+        self.queue = queue.Queue(maxsize=self.queue.maxsize)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def start(self):
+        # the thread is started on first use, so every process gets its own
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping.clear()
+                self.thread = threading.Thread(
+                    target=self.run, name="view-buffer", daemon=True
+                )
+                self.thread.start()
+
+    def put(self, view, timeout):
+        # blocks while the queue is full, returns False if it stays full
+        self.start()
+
+        try:
+            self.queue.put(view, timeout=timeout)
+        except queue.Full:
+            with self.lock:
+                self.stats["rejected"] += 1
+            return False
+
+        with self.lock:
+            self.stats["queued"] += 1
+        return True
+
+    def stop(self, timeout=30):
+        # flushes everything still queued before returning
+        self.stopping.set()
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            batch = self.take_batch()
+
+            if len(batch) > 0:
+                self.flush(batch)
+
+            if not self.stopping.is_set() and time.monotonic() >= self.next_replay:
+                self.next_replay = time.monotonic() + self.replay_interval
+
+                # the thread must outlive a spill file it can't read
+                try:
+                    self.replay()
+                except Exception as error:
+                    logger.error(f"view buffer - replay of spilled views failed: {error}")
+
+    def take_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            try:
+                if self.stopping.is_set():
+                    batch.append(self.queue.get_nowait())
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def flush(self, batch):
+        failures = 0
+        delay = self.retry_delay
+
+        while True:
+            try:
+                inserted, written = self.write_batch(batch)
+                break
+
+            except psycopg.OperationalError as error:
+                # deadlocks, serialization failures, lost connections and
+                # pool timeouts, the batch is fine. only counted as failures
+                # once shutting down, so the thread ends in time
+                if self.stopping.is_set():
+                    failures += 1
+                message = error
+
+            except (Exception, psycopg.DatabaseError) as error:
+                failures += 1
+                message = error
+
+            if failures >= self.flush_attempts:
+                logger.error(f"view buffer - flush of {len(batch)} views failed: {message}")
+                self.spill(batch)
+                return
+
+            logger.error(
+                f"view buffer - flush of {len(batch)} views failed, retrying in {delay:.1f}s: {message}"
+            )
+
+            with self.lock:
+                self.stats["retries"] += 1
+
+            time.sleep(delay)
+            delay = min(delay * 2, self.retry_max_delay)
+
+        with self.lock:
+            self.stats["flushed"] += inserted
+            self.stats["dropped"] += written - inserted
+            self.stats["batches"] += 1
+
+        if inserted < written:
+            logger.warning(
+                f"view buffer - dropped {written - inserted} views of unknown songs"
+            )
+
+    def write_batch(self, batch):
+        # returns the views inserted and the views written, which leave out
+        # the ones moved to the rejected or the spill file on the way
+        try:
+            return self.write(batch), len(batch)
+
+        except (psycopg.DataError, psycopg.IntegrityError) as error:
+            logger.error(
+                f"view buffer - batch of {len(batch)} views rejected, writing them one at a time: {error}"
+            )
+
+        inserted = 0
+        written = 0
+
+        for index, view in enumerate(batch):
+            try:
+                inserted += self.write([view])
+                written += 1
+
+            except (psycopg.DataError, psycopg.IntegrityError) as error:
+                logger.error(f"view buffer - view {view} rejected: {error}")
+                self.quarantine([self.spill_line(view)])
+
+            except (Exception, psycopg.DatabaseError) as error:
+                # the views before this one are written, so the batch can't
+                # be retried as a whole
+                logger.error(f"view buffer - flush of {len(batch) - index} views failed: {error}")
+                self.spill(batch[index:])
+                break
+
+        return inserted, written
+
+    def spill_line(self, view):
+        date_view, song_ismn, consumer_id = view
+        return f"{date_view.isoformat()}\t{song_ismn}\t{consumer_id}\n"
+
+    def append(self, path, lines):
+        # several workers may share the file, so the lines go in a single
+        # append
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, "".join(lines).encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    def quarantine(self, lines):
+        # views that can't be written at all, kept for someone to look at
+        self.append(f"{self.spill_file}.rejected", lines)
+
+        with self.lock:
+            self.stats["quarantined"] += len(lines)
+
+    def spill(self, batch):
+        # appends the views to the spill file, one line each
+        self.append(self.spill_file, [self.spill_line(view) for view in batch])
+
+        with self.lock:
+            self.stats["spilled"] += len(batch)
+
+        logger.error(
+            f"view buffer - {len(batch)} views written to {self.spill_file}, they are retried later"
+        )
+
+    def replay(self):
+        # writes the spilled views again. the file is first renamed, so only
+        # one worker replays it and new spills go to a new file
+        replaying = f"{self.spill_file}.{os.getpid()}"
+
+        try:
+            os.rename(self.spill_file, replaying)
+        except FileNotFoundError:
+            return
+
+        with open(replaying, encoding="utf-8", errors="replace") as file:
+            views = []
+            rejected = []
+
+            for line in file:
+                # a line cut short by a crash is kept aside with the views
+                # that can't be written
+                try:
+                    date_view, song_ismn, consumer_id = line.rstrip("\n").split("\t")
+                    views.append(
+                        (datetime.datetime.fromisoformat(date_view), int(song_ismn), int(consumer_id)))
+                except ValueError:
+                    rejected.append(line if line.endswith("\n") else line + "\n")
+
+        if len(rejected) > 0:
+            logger.error(f"view buffer - {len(rejected)} unreadable lines in {replaying}")
+            self.quarantine(rejected)
+
+        logger.info(f"view buffer - replaying {len(views)} spilled views")
 
-    return db
+        for first in range(0, len(views), self.batch_size):
+            batch = views[first:first + self.batch_size]
+
+            try:
+                inserted, written = self.write_batch(batch)
+            except (Exception, psycopg.DatabaseError) as error:
+                logger.error(f"view buffer - replay of spilled views failed: {error}")
+                self.spill(views[first:])
+                break
+
+            with self.lock:
+                self.stats["flushed"] += inserted
+                self.stats["dropped"] += written - inserted
+                self.stats["replayed"] += written
+
+        os.remove(replaying)
+
+    def write(self, batch):
+        conn = db_connection()
+        cur = conn.cursor()
+
+        try:
+            cur.execute("BEGIN TRANSACTION;")
+
+            cur.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS view_staging (date_view TIMESTAMP, song_ismn BIGINT, consumer_person_users_id BIGINT) ON COMMIT DELETE ROWS;"
+            )
+
+            with cur.copy(
+                "COPY view_staging (date_view, song_ismn, consumer_person_users_id) FROM STDIN"
+            ) as copy:
+                for view in batch:
+                    copy.write_row(view)
+
+            # songs were not checked when the views were queued, views of
+            # songs that don't exist are left out here
+            statement = """
+            INSERT INTO view (date_view, song_ismn, consumer_person_users_id)
+            SELECT vs.date_view, vs.song_ismn, vs.consumer_person_users_id
+            FROM view_staging vs
+            JOIN song s ON s.ismn = vs.song_ismn;
+            """
+            cur.execute(statement)
+            inserted = cur.rowcount
+
+            cur.execute("COMMIT;")
+
+        except (Exception, psycopg.DatabaseError):
+            cur.execute("ROLLBACK;")
+            raise
+
+        finally:
+            release_connection(conn)
+
+        return inserted
+
+
+view_buffer = ViewBuffer(
+    view_buffer_size, view_batch_size, view_flush_interval, view_spill_file)
+atexit.register(view_buffer.stop)
+
+
+##########################################################
+# PARTITION MAINTENANCE
+##########################################################
+
+
+class PartitionMaintenance:
+    # runs maintain_view_partitions() in a background thread when the
+    # process starts serving and every interval seconds after that. the
+    # workers take turns through an advisory lock, and databases where view
+    # is not partitioned are left alone
+
+    advisory_lock = 7310542
+
+    def __init__(self, interval, months_ahead, keep_months):
+        self.interval = interval
+        self.months_ahead = months_ahead
+        self.keep_months = keep_months
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.stats = {"runs": 0, "skipped": 0, "failures": 0}
+
+    def after_fork(self):
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def start(self):
+        # called on every request, only the first one starts the thread
+        if self.thread is not None:
+            return
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="partition-maintenance", daemon=True
+                )
+                self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.maintain()
+            except (Exception, psycopg.DatabaseError) as error:
+                logger.error(f"partition maintenance - error: {error}")
+
+                with self.lock:
+                    self.stats["failures"] += 1
+
+            self.stopping.wait(self.interval)
+
+    def maintain(self):
+        conn = db_connection()
+        cur = conn.cursor()
+
+        try:
+            cur.execute("BEGIN TRANSACTION;")
+
+            statement = "SELECT to_regproc('maintain_view_partitions') IS NOT NULL, pg_try_advisory_xact_lock(%s);"
+            cur.execute(statement, (self.advisory_lock,))
+            partitioned, locked = cur.fetchone()
+
+            if partitioned and locked:
+                statement = "SELECT maintain_view_partitions(%s, %s);"
+                cur.execute(statement, (self.months_ahead, self.keep_months))
+
+            cur.execute("COMMIT;")
+
+        except (Exception, psycopg.DatabaseError):
+            if not conn.closed:
+                cur.execute("ROLLBACK;")
+            raise
+
+        finally:
+            release_connection(conn)
+
+        with self.lock:
+            self.stats["runs" if partitioned and locked else "skipped"] += 1
+
+
+partition_maintenance = PartitionMaintenance(
+    partition_interval, partition_months_ahead, partition_keep_months)
+atexit.register(partition_maintenance.stop)
+
+
+@api.before_app_request
+def start_partition_maintenance():
+    partition_maintenance.start()
 
 
 ##########################################################
@@ -73,7 +1598,7 @@ def db_connection():
 ##########################################################
 
 
-@app.route("/dbproj")
+@api.route("/dbproj")
 def landing_page():
     return """
     <title>SpotSong</title>
@@ -86,9 +1611,101 @@ def landing_page():
     """
 
 
+# Connection pool statistics
+# GET http://localhost:8080/dbproj/stats
+@api.route("/dbproj/stats", methods=["GET"])
+@authenticated("administrator", denied="Token inválido.")
+def pool_stats(principal):
+    logger.info("GET /dbproj/stats")
+
+    pool = get_db_pool()
+
+    results = {
+        "pool": {
+            "min_size": pool.min_size,
+            "max_size": pool.max_size,
+            "timeout": pool.timeout,
+            "max_lifetime": pool.max_lifetime,
+            **pool.get_stats(),
+        },
+        "artist_cache": {
+            "size": len(artist_cache.entries),
+            "max_size": artist_cache.max_size,
+            "ttl": artist_cache.ttl,
+            **artist_cache.stats,
+        },
+        "role_cache": {
+            "size": len(role_cache.entries),
+            "max_size": role_cache.max_size,
+            "ttl": role_cache.ttl,
+            **role_cache.stats,
+        },
+        "requests": request_metrics.summary(),
+        "queries": {name: dict(stats) for name, stats in queries.stats.items()},
+        "hasher": {
+            "workers": password_hasher.workers,
+            "rounds": password_hasher.rounds,
+            "max_pending": password_hasher.max_pending,
+            **password_hasher.stats,
+        },
+        "views": {
+            "ingestion": view_ingestion,
+            "queue_size": view_buffer.queue.qsize(),
+            "queue_max": view_buffer.queue.maxsize,
+            **view_buffer.stats,
+        },
+        "partitions": {
+            "interval": partition_maintenance.interval,
+            "months_ahead": partition_maintenance.months_ahead,
+            "keep_months": partition_maintenance.keep_months,
+            **partition_maintenance.stats,
+        },
+    }
+
+    response = {"status": StatusCodes["success"], "results": results}
+
+    return flask.jsonify(response)
+
+
+# Prometheus metrics
+# GET http://localhost:8080/dbproj/metrics
+@api.route("/dbproj/metrics", methods=["GET"])
+def metrics():
+    lines = request_metrics.render()
+
+    # connection pool gauges
+    for name, value in sorted(get_db_pool().get_stats().items()):
+        lines.append(f"# TYPE spotsong_pool_{name} gauge")
+        lines.append(f"spotsong_pool_{name} {value}")
+
+    lines.append("# TYPE spotsong_view_queue_size gauge")
+    lines.append(f"spotsong_view_queue_size {view_buffer.queue.qsize()}")
+
+    return flask.Response(
+        "\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+# Slow queries
+# GET http://localhost:8080/dbproj/slow_queries
+@api.route("/dbproj/slow_queries", methods=["GET"])
+@authenticated("administrator", denied="Token inválido.")
+def slow_queries(principal):
+    logger.info("GET /dbproj/slow_queries")
+
+    response = {
+        "status": StatusCodes["success"],
+        "results": {
+            "threshold_ms": slow_query_ms,
+            "explain_rate": slow_query_explain_rate,
+            "queries": slow_query_log.recent(),
+        },
+    }
+    return flask.jsonify(response)
+
+
 # User Registration
 # curl -X POST http://localhost:8080/dbproj/user
-@app.route("/dbproj/user", methods=["POST"])
+@api.route("/dbproj/user", methods=["POST"])
 def add_user():
     logger.info("POST /dbproj/user")
     payload = flask.request.get_json()
@@ -106,39 +1723,39 @@ def add_user():
             }
             return flask.jsonify(response)
 
-    hashed_password = bcrypt.hashpw(
-        payload["password"].encode("utf-8"), bcrypt.gensalt()
-    ).decode("utf-8")
+    hashed_password = password_hasher.hash(payload["password"])
+
+    if hashed_password is None:
+        response = {
+            "status": StatusCodes["internal_error"],
+            "errors": "Too many users signing in. Try again later",
+        }
+        return flask.jsonify(response)
 
     conn = db_connection()
     cur = conn.cursor()
 
     try:
-        cur.execute("LOCK TABLE users IN EXCLUSIVE MODE;")
-        cur.execute("LOCK TABLE artist IN EXCLUSIVE MODE;")
         # begin the transaction
         cur.execute("BEGIN TRANSACTION;")
 
-        statement = "SELECT id FROM users WHERE username = %s"
-        values = (payload["username"],)
+        # the UNIQUE constraint on username detects duplicates, so concurrent
+        # signups only wait on each other when they pick the same username
+        statement = "INSERT INTO users (username, email, password) VALUES (%s, %s, %s) ON CONFLICT (username) DO NOTHING RETURNING id;"
+        values = (payload["username"], payload["email"], hashed_password)
 
         cur.execute(statement, values)
         res = cur.fetchone()
 
-        if res is not None:
+        if res is None:
             response = {
                 "status": StatusCodes["api_error"],
                 "results": "Usuario com esse username já existe. Escolha outro",
             }
             cur.execute("ROLLBACK;")
-            conn.close()
             return flask.jsonify(response)
 
-        statement = "INSERT INTO users (username, email, password) VALUES (%s, %s, %s) RETURNING id;"
-        values = (payload["username"], payload["email"], hashed_password)
-
-        cur.execute(statement, values)
-        user_id = cur.fetchone()[0]
+        user_id = res[0]
 
         statement = "INSERT INTO person (name,address, contact, users_id) VALUES (%s,%s, %s, %s);"
         values = (payload["name"], payload["address"],
@@ -155,14 +1772,10 @@ def add_user():
                         "results": f"{field} not in payload",
                     }
                     cur.execute("ROLLBACK;")
-                    conn.close()
                     return flask.jsonify(response)
 
             try:
-                # o id está guardado no credentials
-                credentials = jwt.decode(
-                    payload["token"], secret_key, algorithms="HS256"
-                )
+                adm_id = decode_token(payload["token"])
 
             except jwt.exceptions.ExpiredSignatureError:
                 response = {
@@ -170,48 +1783,39 @@ def add_user():
                     "results": "token invalido. tente autenticar novamente",
                 }
                 cur.execute("ROLLBACK;")
-                conn.close()
                 return flask.jsonify(response)
 
-            statement = "SELECT users_id FROM administrator WHERE users_id = %s"
-            values = (credentials["user_id"],)
-
-            cur.execute(statement, values)
-            res = cur.fetchone()
+            except jwt.exceptions.InvalidTokenError:
+                adm_id = None
 
-            if res is None:
+            if adm_id is None or not resolve_principal(adm_id, cur).is_administrator:
                 response = {
                     "status": StatusCodes["api_error"],
                     "results": "token invalido",
                 }
                 cur.execute("ROLLBACK;")
-                conn.close()
                 return flask.jsonify(response)
-            adm_id = res[0]
 
-            statement = "SELECT artistic_name FROM artist WHERE artistic_name = %s"
-            values = (payload["artistic_name"],)
+            # same for artistic_name, which is UNIQUE as well
+            statement = "INSERT INTO artist (artistic_name, administrator_users_id,label_id,person_users_id) VALUES (%s,%s,%s,%s) ON CONFLICT (artistic_name) DO NOTHING RETURNING person_users_id;"
+            values = (
+                payload["artistic_name"],
+                adm_id,
+                payload["label_id"],
+                user_id,
+            )
 
             cur.execute(statement, values)
             res = cur.fetchone()
 
-            if res is not None:
+            if res is None:
                 response = {
                     "status": StatusCodes["api_error"],
                     "results": "Usuario com esse nome artistico já existe. Escolha outro",
                 }
                 cur.execute("ROLLBACK;")
-                conn.close()
                 return flask.jsonify(response)
 
-            statement = "INSERT INTO artist (artistic_name, administrator_users_id,label_id,person_users_id) VALUES (%s,%s,%s,%s)"
-            values = (
-                payload["artistic_name"],
-                adm_id,
-                payload["label_id"],
-                user_id,
-            )
-
         else:
             statement = "INSERT INTO consumer (person_users_id) VALUES (%s)"
             values = (user_id,)
@@ -224,105 +1828,225 @@ def add_user():
                 user_id,
             )
 
-        cur.execute(statement, values)
+            cur.execute(statement, values)
+
+        # commit the transaction
+        cur.execute("COMMIT;")
+
+        invalidate_principal(user_id)
+
+        response = {
+            "status": StatusCodes["success"],
+            "results": f"Inserted user {user_id}",
+        }
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f"POST /dbproj/user - error: {error}")
+        response = {
+            "status": StatusCodes["internal_error"], "errors": str(error)}
+
+        # an error occurred, rollback
+        cur.execute("ROLLBACK;")
+
+    finally:
+        if conn is not None:
+            release_connection(conn)
+
+    return flask.jsonify(response)
+
+
+queries.register("user_password", "SELECT id, password FROM users WHERE username = %s;")
+
+
+# User Authentication
+# PUT http://localhost:8080/dbproj/user
+@api.route("/dbproj/user", methods=["PUT"])
+def authenticate_user():
+    logger.info("PUT /dbproj/user")
+    payload = flask.request.get_json()
+
+    logger.debug(f"PUT /dbproj/user - payload: {payload}")
+
+    # validate every argument:
+    required_fields = ["username", "password"]
+    for field in required_fields:
+        if field not in payload:
+            response = {
+                "status": StatusCodes["api_error"],
+                "results": f"{field} not in payload",
+            }
+            return flask.jsonify(response)
+
+    conn = db_connection()
+    cur = conn.cursor()
+
+    try:
+        # parameterized queries, good for security and performance
+        values = (payload["username"],)
+        queries.execute(cur, "user_password", values)
+
+        row = cur.fetchone()
+
+        if row is None:
+            response = {
+                "status": StatusCodes["api_error"],
+                "results": "username incorreto",
+            }
+            return flask.jsonify(response)
+
+        # release the connection while the password is checked
+        release_connection(conn)
+        conn = None
+
+        valid = password_hasher.check(payload["password"], row[1])
+
+        if valid is None:
+            response = {
+                "status": StatusCodes["internal_error"],
+                "errors": "Too many users signing in. Try again later",
+            }
+            return flask.jsonify(response)
+
+        if valid and password_hasher.needs_rehash(row[1]):
+            # the cost changed since this password was hashed. a failed
+            # rehash only means it is tried again on the next login
+            rehashed = password_hasher.rehash(payload["password"])
+
+            if rehashed is not None:
+                conn = db_connection()
+                statement = "UPDATE users SET password = %s WHERE id = %s AND password = %s;"
+                values = (rehashed, row[0], row[1])
+                conn.execute(statement, values)
+
+        if valid:
+            if conn is None:
+                conn = db_connection()
+
+            refresh_token = issue_refresh_token(conn.cursor(), row[0])
+
+            response = {
+                "status": StatusCodes["success"],
+                "results": issue_access_token(row[0]),
+                "refresh_token": refresh_token,
+            }
+        else:
+            response = {
+                "status": StatusCodes["api_error"],
+                "errors": "Passsword incorreta",
+            }
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(error)
+        response = {
+            "status": StatusCodes["internal_error"], "errors": str(error)}
+
+    finally:
+        if conn is not None:
+            release_connection(conn)
+
+    return flask.jsonify(response)
+
+
+# Refresh access token
+# PUT http://localhost:8080/dbproj/token
+@api.route("/dbproj/token", methods=["PUT"])
+def refresh_access_token():
+    logger.info("PUT /dbproj/token")
+    payload = flask.request.get_json()
+
+    if "refresh_token" not in payload:
+        response = {
+            "status": StatusCodes["api_error"],
+            "results": "refresh_token not in payload",
+        }
+        return flask.jsonify(response)
+
+    conn = db_connection()
+    cur = conn.cursor()
+
+    try:
+        values, refresh_token = rotate_refresh_token_values(payload["refresh_token"])
+        queries.execute(cur, "rotate_refresh_token", values)
+        row = cur.fetchone()
+
+        if row is None:
+            response = {
+                "status": StatusCodes["api_error"],
+                "results": "refresh token invalido. tente autenticar novamente",
+            }
+            return flask.jsonify(response)
 
-        # commit the transaction
-        cur.execute("COMMIT;")
         response = {
             "status": StatusCodes["success"],
-            "results": f"Inserted user {user_id}",
+            "results": issue_access_token(row[0]),
+            "refresh_token": refresh_token,
         }
 
     except (Exception, psycopg.DatabaseError) as error:
-        logger.error(f"POST /dbproj/user - error: {error}")
+        logger.error(f"PUT /dbproj/token - error: {error}")
         response = {
             "status": StatusCodes["internal_error"], "errors": str(error)}
 
-        # an error occurred, rollback
-        cur.execute("ROLLBACK;")
-
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
-# User Authentication
-# PUT http://localhost:8080/dbproj/user
-@app.route("/dbproj/user", methods=["PUT"])
-def authenticate_user():
-    logger.info("PUT /dbproj/user")
+# Revoke refresh token
+# DELETE http://localhost:8080/dbproj/token
+@api.route("/dbproj/token", methods=["DELETE"])
+def revoke_refresh_token():
+    logger.info("DELETE /dbproj/token")
     payload = flask.request.get_json()
 
-    logger.debug(f"PUT /dbproj/user - payload: {payload}")
-
-    # validate every argument:
-    required_fields = ["username", "password"]
-    for field in required_fields:
-        if field not in payload:
-            response = {
-                "status": StatusCodes["api_error"],
-                "results": f"{field} not in payload",
-            }
-            return flask.jsonify(response)
+    if "refresh_token" not in payload:
+        response = {
+            "status": StatusCodes["api_error"],
+            "results": "refresh_token not in payload",
+        }
+        return flask.jsonify(response)
 
     conn = db_connection()
     cur = conn.cursor()
 
     try:
-        # parameterized queries, good for security and performance
-        statement = "SELECT id, password FROM users WHERE username = %s;"
-        values = (payload["username"],)
-        cur.execute(statement, values)
+        token_hash = refresh_token_hash(payload["refresh_token"])
 
-        row = cur.fetchone()
+        statement = "UPDATE refresh_token SET revoked = TRUE WHERE token_hash = %s;"
+        values = (token_hash,)
+        cur.execute(statement, values)
 
-        if row is None:
+        if cur.rowcount == 0:
             response = {
                 "status": StatusCodes["api_error"],
-                "results": "username incorreto",
+                "results": "refresh token invalido",
             }
-            conn.close()
             return flask.jsonify(response)
 
-        if bcrypt.checkpw(payload["password"].encode("utf-8"), row[1].encode("utf-8")):
-            response = {
-                "status": StatusCodes["success"],
-                "results": jwt.encode(
-                    {
-                        "user_id": row[0],
-                        "exp": (
-                            datetime.datetime.now() + datetime.timedelta(minutes=5)
-                        ).timestamp(),
-                    },
-                    secret_key,
-                    algorithm="HS256",
-                ),
-            }
-        else:
-            response = {
-                "status": StatusCodes["api_error"],
-                "errors": "Passsword incorreta",
-            }
-            conn.close()
+        response = {
+            "status": StatusCodes["success"],
+            "results": "refresh token revoked",
+        }
 
     except (Exception, psycopg.DatabaseError) as error:
-        logger.error(error)
+        logger.error(f"DELETE /dbproj/token - error: {error}")
         response = {
             "status": StatusCodes["internal_error"], "errors": str(error)}
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
 # Add song
 # POST http://localhost:8080/dbproj/song
-@app.route("/dbproj/song", methods=["POST"])
-def add_song():
+@api.route("/dbproj/song", methods=["POST"])
+@authenticated("artist", denied="token invalido.")
+def add_song(principal):
     logger.info("POST /dbproj/song")
     payload = flask.request.get_json()
 
@@ -345,22 +2069,6 @@ def add_song():
             }
             return flask.jsonify(response)
 
-    try:
-        credentials = jwt.decode(
-            payload["token"], secret_key, algorithms="HS256")
-
-    except jwt.exceptions.ExpiredSignatureError:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token invalido. tente autenticar novamente",
-        }
-        return flask.jsonify(response)
-
-    if "user_id" not in credentials:
-        response = {
-            "status": StatusCodes["api_error"], "results": "Invalid token"}
-        return flask.jsonify(response)
-
     conn = db_connection()
     cur = conn.cursor()
 
@@ -369,20 +2077,6 @@ def add_song():
         cur.execute("BEGIN TRANSACTION;")
 
         # parameterized queries, good for security and performance
-        statement = "SELECT person_users_id FROM artist WHERE person_users_id = %s"
-        values = (credentials["user_id"],)
-
-        cur.execute(statement, values)
-        indb = cur.fetchone()
-        if indb is None:
-            response = {
-                "status": StatusCodes["api_error"],
-                "results": "token invalido.",
-            }
-            cur.execute("ROLLBACK;")
-            conn.close()
-            return flask.jsonify(response)
-
         statement = "SELECT id FROM label WHERE id = %s"
         values = (payload["publisher_id"],)
 
@@ -394,7 +2088,6 @@ def add_song():
                 "results": "publisher_id invalido.",
             }
             cur.execute("ROLLBACK;")
-            conn.close()
             return flask.jsonify(response)
 
         statement = "INSERT INTO song (title, release_date, duration, genre, artist_person_users_id, label_id) VALUES (%s, %s, %s, %s, %s, %s) RETURNING ismn;"
@@ -403,7 +2096,7 @@ def add_song():
             payload["release_date"],
             payload["duration"],
             payload["genre"],
-            credentials["user_id"],
+            principal.user_id,
             payload["publisher_id"],
         )
 
@@ -413,7 +2106,7 @@ def add_song():
 
         statement = "INSERT INTO artist_song (artist_person_users_id, song_ismn) VALUES (%s, %s)"
         values = (
-            credentials["user_id"],
+            principal.user_id,
             song_id,
         )
 
@@ -435,7 +2128,6 @@ def add_song():
                         "results": f"artista com o id {artist_id} nao existe.",
                     }
                     cur.execute("ROLLBACK;")
-                    conn.close()
                     return flask.jsonify(response)
 
                 statement = "INSERT INTO artist_song (artist_person_users_id, song_ismn) VALUES (%s, %s)"
@@ -449,6 +2141,8 @@ def add_song():
         # commit the transaction
         cur.execute("COMMIT;")
 
+        artist_cache.invalidate(principal.user_id)
+
         response = {
             "status": StatusCodes["success"],
             "results": f"Inserted song {song_id}",
@@ -464,15 +2158,16 @@ def add_song():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
 # Add album
 # POST http://localhost:8080/dbproj/album
-@app.route("/dbproj/album", methods=["POST"])
-def add_album():
+@api.route("/dbproj/album", methods=["POST"])
+@authenticated("artist", denied="Token inválido.")
+def add_album(principal):
     logger.info("POST /dbproj/album")
     payload = flask.request.get_json()
 
@@ -496,21 +2191,20 @@ def add_album():
         }
         return flask.jsonify(response)
 
-    try:
-        credentials = jwt.decode(
-            payload["token"], secret_key, algorithms="HS256")
-
-    except jwt.exceptions.ExpiredSignatureError:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token inválido. Tente autenticar novamente",
-        }
-        return flask.jsonify(response)
+    # new songs come as objects, songs already uploaded as their id
+    new_songs = [song for song in payload["songs"] if type(song) is dict]
+    old_songs = [song for song in payload["songs"] if type(song) is not dict]
 
-    if "user_id" not in credentials:
-        response = {
-            "status": StatusCodes["api_error"], "results": "Token inválido"}
-        return flask.jsonify(response)
+    required_fields = ["song_name", "duration",
+                       "genre", "release_date", "publisher_id"]
+    for song in new_songs:
+        for field in required_fields:
+            if field not in song:
+                response = {
+                    "status": StatusCodes["api_error"],
+                    "results": f"{field} not in payload",
+                }
+                return flask.jsonify(response)
 
     conn = db_connection()
     cur = conn.cursor()
@@ -519,41 +2213,74 @@ def add_album():
         # begin the transaction
         cur.execute("BEGIN TRANSACTION;")
 
-        # parameterized queries, good for security and performance
-        statement = "SELECT person_users_id FROM artist WHERE person_users_id = %s"
-        values = (credentials["user_id"],)
+        # labels, artists and songs are each checked with a single query. ids
+        # may come as numbers or strings, postgres casts them all
+        labels = [str(payload["publisher_id"])] + [str(song["publisher_id"]) for song in new_songs]
+
+        statement = "SELECT id FROM label WHERE id = ANY(%s::bigint[])"
+        values = (labels,)
 
         cur.execute(statement, values)
-        indb = cur.fetchone()
-        if indb is None:
+        found = {str(linha[0]) for linha in cur.fetchall()}
+
+        if labels[0] not in found:
             response = {
                 "status": StatusCodes["api_error"],
-                "results": "Token inválido.",
+                "results": "label invalida.",
             }
             cur.execute("ROLLBACK;")
-            conn.close()
             return flask.jsonify(response)
 
-        statement = "SELECT id FROM label WHERE id = %s"
-        values = (payload["publisher_id"],)
-
-        cur.execute(statement, values)
-        indb = cur.fetchone()
-        if indb is None:
+        if any(label not in found for label in labels):
             response = {
                 "status": StatusCodes["api_error"],
-                "results": "label invalida.",
+                "results": "Token inválido.",
             }
             cur.execute("ROLLBACK;")
-            conn.close()
             return flask.jsonify(response)
 
+        other_artists = [
+            artist_id for song in new_songs for artist_id in song.get("other_artists", [])
+        ]
+
+        if len(other_artists) > 0:
+            statement = "SELECT person_users_id FROM artist WHERE person_users_id = ANY(%s::bigint[])"
+            values = ([str(artist_id) for artist_id in other_artists],)
+
+            cur.execute(statement, values)
+            found = {str(linha[0]) for linha in cur.fetchall()}
+
+            for artist_id in other_artists:
+                if str(artist_id) not in found:
+                    response = {
+                        "status": StatusCodes["api_error"],
+                        "results": f"artista com o id {artist_id} nao existe.",
+                    }
+                    cur.execute("ROLLBACK;")
+                    return flask.jsonify(response)
+
+        if len(old_songs) > 0:
+            statement = "SELECT song_ismn FROM artist_song WHERE song_ismn = ANY(%s::bigint[]) AND artist_person_users_id = %s"
+            values = ([str(song) for song in old_songs], principal.user_id)
+
+            cur.execute(statement, values)
+            found = {str(linha[0]) for linha in cur.fetchall()}
+
+            for song in old_songs:
+                if str(song) not in found:
+                    response = {
+                        "status": StatusCodes["api_error"],
+                        "errors": f"You are not associated with song {song}",
+                    }
+                    cur.execute("ROLLBACK;")
+                    return flask.jsonify(response)
+
         # parameterized queries, good for security and performance
         statement = "INSERT INTO album (title, release_date, artist_person_users_id, label_id) VALUES (%s,%s,%s,%s) RETURNING id;"
         values = (
             payload["album_name"],
             payload["release_date"],
-            credentials["user_id"],
+            principal.user_id,
             payload["publisher_id"],
         )
 
@@ -561,114 +2288,61 @@ def add_album():
 
         album_id = cur.fetchone()[0]
 
-        for song in payload["songs"]:
-            song_id = 0
-            if type(song) is dict:
-                required_fields = [
-                    "song_name",
-                    "duration",
-                    "genre",
-                    "release_date",
-                    "publisher_id",
-                ]
-                for field in required_fields:
-                    if field not in song:
-                        response = {
-                            "status": StatusCodes["api_error"],
-                            "results": f"{field} not in payload",
-                        }
-                        cur.execute("ROLLBACK;")
-                        conn.close()
-                        return flask.jsonify(response)
-
-                statement = "SELECT id FROM label WHERE id = %s"
-
-                values = (song["publisher_id"],)
-
-                cur.execute(statement, values)
-                indb = cur.fetchone()
-                if indb is None:
-                    response = {
-                        "status": StatusCodes["api_error"],
-                        "results": "Token inválido.",
-                    }
-                    cur.execute("ROLLBACK;")
-                    conn.close()
-                    return flask.jsonify(response)
+        # executemany sends the rows in pipeline mode, so each of the inserts
+        # below costs about one round trip whatever the number of songs
+        song_ids = []
 
-                statement = "INSERT INTO song (title, release_date, duration, genre, artist_person_users_id, label_id) VALUES (%s, %s, %s, %s, %s, %s) RETURNING ismn;"
-                values = (
+        if len(new_songs) > 0:
+            statement = "INSERT INTO song (title, release_date, duration, genre, artist_person_users_id, label_id) VALUES (%s, %s, %s, %s, %s, %s) RETURNING ismn;"
+            values = [
+                (
                     song["song_name"],
                     song["release_date"],
                     song["duration"],
                     song["genre"],
-                    credentials["user_id"],
+                    principal.user_id,
                     song["publisher_id"],
                 )
-                cur.execute(statement, values)
-
-                song_id = cur.fetchone()[0]
-
-                if "other_artists" in song:
-                    for artist_id in song["other_artists"]:
-                        statement = "SELECT person_users_id FROM artist WHERE person_users_id = %s"
-                        values = (artist_id,)
-
-                        cur.execute(statement, values)
-                        indb = cur.fetchone()
-
-                        if indb is None:
-                            response = {
-                                "status": StatusCodes["api_error"],
-                                "results": f"artista com o id {artist_id} nao existe.",
-                            }
-                            cur.execute("ROLLBACK;")
-                            conn.close()
-                            return flask.jsonify(response)
-
-                        statement = "INSERT INTO artist_song (artist_person_users_id, song_ismn) VALUES (%s, %s);"
-                        values = (
-                            artist_id,
-                            song_id,
-                        )
-                        cur.execute(statement, values)
-
-                statement = "INSERT INTO artist_song (artist_person_users_id, song_ismn) VALUES (%s, %s);"
-                values = (
-                    credentials["user_id"],
-                    song_id,
-                )
-
-                cur.execute(statement, values)
-
-            else:
-                statement = "SELECT artist_person_users_id FROM artist_song WHERE song_ismn = %s AND artist_person_users_id = %s"
-                values = (
-                    song,
-                    credentials["user_id"],
-                )
-
-                cur.execute(statement, values)
-                if cur.fetchone() is None:
-                    response = {
-                        "status": StatusCodes["api_error"],
-                        "errors": f"You are not associated with song {song}",
-                    }
-                    cur.execute("ROLLBACK;")
-                    conn.close()
-                    return flask.jsonify(response)
-                song_id = song
-
-            statement = "INSERT INTO song_album (song_ismn, album_id) VALUES (%s,%s);"
-            values = (
-                song_id,
-                album_id,
-            )
-            cur.execute(statement, values)
+                for song in new_songs
+            ]
+            cur.executemany(statement, values, returning=True)
+
+            while True:
+                song_ids.append(cur.fetchone()[0])
+                if not cur.nextset():
+                    break
+
+            statement = "INSERT INTO artist_song (artist_person_users_id, song_ismn) VALUES (%s, %s);"
+            values = [
+                (artist_id, song_id)
+                for song, song_id in zip(new_songs, song_ids)
+                for artist_id in song.get("other_artists", []) + [principal.user_id]
+            ]
+            cur.executemany(statement, values)
+
+        # the album keeps the order of the payload
+        new_song_ids = iter(song_ids)
+        album_songs = [
+            next(new_song_ids) if type(song) is dict else song
+            for song in payload["songs"]
+        ]
+
+        statement = "INSERT INTO song_album (song_ismn, album_id) VALUES (%s,%s);"
+        values = [(song_id, album_id) for song_id in album_songs]
+        cur.executemany(statement, values)
+
+        # songs of other artists can be in the album too
+        statement = "SELECT DISTINCT song.artist_person_users_id FROM song JOIN song_album ON song.ismn = song_album.song_ismn WHERE song_album.album_id = %s"
+        values = (album_id,)
+        cur.execute(statement, values)
+        artists = [linha[0] for linha in cur.fetchall()]
 
         # commit the transaction
         cur.execute("COMMIT;")
 
+        for artist_id in artists:
+            artist_cache.invalidate(artist_id)
+
         response = {
             "status": StatusCodes["success"],
             "results": f"Inserted album {album_id}",
@@ -684,97 +2358,142 @@ def add_album():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
+# search_text() folds case and accents and is backed by a trigram
+# index. only one page of songs (plus one, to know if there are more)
+# is picked, and each comes back as a single row with its artists
+# and albums already aggregated
+queries.register("search_song", """
+WITH ranked AS (
+    SELECT
+    s.ismn,
+    s.title,
+    similarity(search_text(s.title), search_text(%(keyword)s)) AS rank
+    FROM
+    song s
+    WHERE
+    search_text(s.title) LIKE '%%' || search_text(%(pattern)s) || '%%'
+),
+matches AS (
+    SELECT
+    ismn,
+    title,
+    rank
+    FROM
+    ranked
+    WHERE
+    %(after_rank)s::real IS NULL
+    OR rank < %(after_rank)s::real
+    OR (rank = %(after_rank)s::real AND ismn > %(after_song)s)
+    ORDER BY
+    rank DESC, ismn
+    LIMIT %(limit)s
+)
+SELECT
+m.ismn AS song_id,
+m.title AS song_title,
+m.rank,
+array_agg(DISTINCT a.artistic_name) AS artists,
+array_agg(DISTINCT als.album_id) FILTER (WHERE als.album_id IS NOT NULL) AS albuns
+FROM
+matches m
+INNER JOIN artist_song sa ON m.ismn = sa.song_ismn
+INNER JOIN artist a ON sa.artist_person_users_id = a.person_users_id
+LEFT JOIN song_album als ON m.ismn = als.song_ismn
+GROUP BY
+m.ismn, m.title, m.rank
+ORDER BY
+m.rank DESC, m.ismn;
+""")
+
+
+def search_page(all, limit):
+    # returns the results and next cursor from the rows of the search_song query
+    next_cursor = None
+
+    if len(all) > limit:
+        # the extra song only tells that there is a next page
+        all = all[:limit]
+        next_cursor = encode_cursor([all[-1][2], all[-1][0]])
+
+    results = []
+    # dict keys keep the albums unique and in order of appearance
+    albuns = {}
+
+    for element in all:
+        results.append({"title": element[1], "artists": element[3]})
+
+        for album in element[4] or []:
+            albuns[album] = None
+
+    results.append({"albuns": list(albuns)})
+
+    return results, next_cursor
+
+
 # Search song
 # GET http://localhost:8080/dbproj/song/{keyword}
-@app.route("/dbproj/song/<keyword>", methods=["GET"])
-def search_song(keyword):
+@api.route("/dbproj/song/<keyword>", methods=["GET"])
+@authenticated("consumer", denied="Token inválido.")
+def search_song(principal, keyword):
     payload = flask.request.get_json()
     logger.info("GET /dbproj/song/{keyword}")
 
     logger.debug("GET /dbproj/song/{keyword} - payload: {payload}")
 
-    if "token" not in payload:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token value not in payload",
-        }
-        return flask.jsonify(response)
-
-    try:
-        # o id está guardado no credentials
-        credentials = jwt.decode(
-            payload["token"], secret_key, algorithms="HS256")
-
-    except jwt.exceptions.ExpiredSignatureError:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token invalido. tente autenticar novamente",
-        }
-        return flask.jsonify(response)
-
-    # verificar se user_id está em credentials
-    if "user_id" not in credentials:
-        response = {
-            "status": StatusCodes["api_error"], "results": "Invalid token"}
-        return flask.jsonify(response)
-
     conn = db_connection()
     cur = conn.cursor()
 
     try:
-        statement = "SELECT person_users_id FROM consumer WHERE person_users_id = %s"
-        values = (credentials["user_id"],)
-
-        cur.execute(statement, values)
-        indb = cur.fetchone()
-        if indb is None:
+        try:
+            limit = page_size(payload)
+        except ValueError:
             response = {
                 "status": StatusCodes["api_error"],
-                "results": "Token inválido.",
+                "results": "invalid limit",
             }
-            conn.close()
             return flask.jsonify(response)
 
-        # parameterized queries, good for security and performance
-        statement = f"SELECT s.ismn AS song_id, s.title AS song_title, a.artistic_name AS artist_name, al.id AS album_id FROM song s INNER JOIN artist_song sa ON s.ismn = sa.song_ismn INNER JOIN artist a ON sa.artist_person_users_id = a.person_users_id LEFT JOIN song_album als ON s.ismn = als.song_ismn LEFT JOIN album al ON als.album_id = al.id WHERE s.title LIKE '%{keyword}%'; "
-
-        cur.execute(statement)
-
-        all = cur.fetchall()
-
-        dicisongs = {}
-        albuns = []
-
-        for element in all:
-            song_id = element[0]
-            if song_id in dicisongs:
-                if element[2] not in dicisongs[song_id]["artists"]:
-                    dicisongs[song_id]["artists"].append(element[2])
-            else:
-                dicisongs[song_id] = {
-                    "song_title": element[1], "artists": [element[2]]}
-
-            album = element[3]
+        # the cursor holds the rank and id of the last song of the previous page
+        after_rank, after_song = None, 0
+        if "after" in payload:
+            try:
+                after_rank, after_song = decode_cursor(payload["after"])
+                after_rank, after_song = float(after_rank), int(after_song)
+            except (ValueError, TypeError, OverflowError):
+                response = {
+                    "status": StatusCodes["api_error"],
+                    "results": "invalid after cursor",
+                }
+                return flask.jsonify(response)
 
-            if album is not None:
-                if album not in albuns:
-                    albuns.append(album)
+        # LIKE wildcards typed by the user are matched literally
+        pattern = (
+            keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        )
 
-        results = []
+        values = {
+            "keyword": keyword,
+            "pattern": pattern,
+            "after_rank": after_rank,
+            "after_song": after_song,
+            "limit": limit + 1,
+        }
 
-        for song_id, song_info in dicisongs.items():
-            song = {"title": song_info["song_title"],
-                    "artists": song_info["artists"]}
-            results.append(song)
+        # parameterized queries, good for security and performance
+        queries.execute(cur, "search_song", values)
 
-        results.append({"albuns": albuns})
+        results, next_cursor = search_page(cur.fetchall(), limit)
 
-        response = {"status": StatusCodes["success"], "results": results}
+        response = {
+            "status": StatusCodes["success"],
+            "results": results,
+            "next": next_cursor,
+        }
 
     except (Exception, psycopg.DatabaseError) as error:
         logger.error(f"GET /dbproj/song/{keyword} - error: {error}")
@@ -783,128 +2502,122 @@ def search_song(keyword):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
+def artist_page(profile, after_song, limit):
+    # songs are sorted by id, so the page starts right after the cursor
+    first = bisect.bisect_right(profile["songs"], after_song)
+    songs = profile["songs"][first:first + limit]
+    next_cursor = None
+
+    if first + limit < len(profile["songs"]):
+        next_cursor = encode_cursor(songs[-1])
+
+    # dict keys keep the ids unique and in order of appearance
+    albuns = {}
+    playlist = {}
+
+    for song in songs:
+        for album in profile["albuns"][song]:
+            albuns[album] = None
+        for playlist_id in profile["playlists"][song]:
+            playlist[playlist_id] = None
+
+    return songs, albuns, playlist, next_cursor
+
+
+# the private and TOP 10 playlists depend on who is asking, so they are the
+# only part of the artist details read live
+queries.register("private_playlists", """
+SELECT DISTINCT
+playlist_song.playlist_id
+FROM
+playlist_song
+JOIN playlist ON playlist_song.playlist_id = playlist.id
+WHERE
+playlist_song.song_ismn = ANY(%s)
+AND (playlist.is_private IS NULL OR playlist.is_private = true)
+AND playlist.consumer_person_users_id = %s
+ORDER BY
+1;
+""")
+
+
 # Detail artist
 # GET http://localhost:8080/dbproj/artist_info/{artist_id}
-@app.route("/dbproj/artist_info/<artist_id>", methods=["GET"])
-def detail_artist(artist_id):
+@api.route("/dbproj/artist_info/<artist_id>", methods=["GET"])
+@authenticated("consumer")
+def detail_artist(principal, artist_id):
     payload = flask.request.get_json()
     logger.info("GET /dbproj/song/{artist_id}")
 
     logger.debug("GET /dbproj/song/{artist_id} - payload: {payload}")
 
-    if "token" not in payload:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token value not in payload",
-        }
-        return flask.jsonify(response)
-
-    try:
-        # o id está guardado no credentials
-        credentials = jwt.decode(
-            payload["token"], secret_key, algorithms="HS256")
-
-    except jwt.exceptions.ExpiredSignatureError:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token invalido. tente autenticar novamente",
-        }
-        return flask.jsonify(response)
-
-    # verificar se user_id está em credentials
-    if "user_id" not in credentials:
-        response = {
-            "status": StatusCodes["api_error"], "results": "Invalid token"}
-        return flask.jsonify(response)
-
     conn = db_connection()
     cur = conn.cursor()
 
     try:
-        statement = "SELECT person_users_id FROM consumer WHERE person_users_id = %s"
-        values = (credentials["user_id"],)
-
-        cur.execute(statement, values)
-        indb = cur.fetchone()
+        if not artist_id.isdigit():
+            response = {
+                "status": StatusCodes["api_error"],
+                "errors": "Nothing foud with that user id",
+            }
+            return flask.jsonify(response)
 
-        if indb is None:
+        try:
+            limit = page_size(payload)
+        except ValueError:
             response = {
-                "status": StatusCodes["api_error"], "results": "Invalid token"}
-            conn.close()
+                "status": StatusCodes["api_error"],
+                "results": "invalid limit",
+            }
             return flask.jsonify(response)
 
-        # parameterized queries, good for security and performance
-        statement = """
-        SELECT
-        artist.artistic_name,
-        song.ismn,
-        song_album.album_id,
-        NULL AS playlist_id
-        FROM
-        artist
-        JOIN song ON artist.person_users_id = song.artist_person_users_id
-        LEFT JOIN song_album ON song.ismn = song_album.song_ismn
-        WHERE
-        artist.person_users_id = %s
-
-        UNION
-
-        SELECT
-        artist.artistic_name,
-        song.ismn,
-        NULL AS album_id,
-        playlist_song.playlist_id
-        FROM
-        artist
-        JOIN song ON artist.person_users_id = song.artist_person_users_id
-        LEFT JOIN playlist_song ON song.ismn = playlist_song.song_ismn
-        LEFT JOIN playlist ON playlist_song.playlist_id = playlist.id
-        WHERE
-        artist.person_users_id = %s
-        AND (
-            (playlist.is_private IS NULL OR playlist.is_private = true) AND playlist.consumer_person_users_id = %s
-            OR playlist.is_private = false
-        );
-        """
-        values = (artist_id, artist_id, credentials["user_id"])
-        cur.execute(statement, values)
+        # the cursor holds the id of the last song of the previous page
+        after_song = 0
+        if "after" in payload:
+            try:
+                after_song = int(decode_cursor(payload["after"]))
+            except (ValueError, TypeError, OverflowError):
+                response = {
+                    "status": StatusCodes["api_error"],
+                    "results": "invalid after cursor",
+                }
+                return flask.jsonify(response)
 
-        all = cur.fetchall()
+        profile = get_artist_profile(cur, int(artist_id))
 
-        if len(all) == 0:
+        if profile is None:
             response = {
                 "status": StatusCodes["api_error"],
                 "errors": "Nothing foud with that user id",
             }
-            conn.close()
             return flask.jsonify(response)
 
-        artistic_name = all[0][0]
-        songs = []
-        albuns = []
-        playlist = []
+        songs, albuns, playlist, next_cursor = artist_page(profile, after_song, limit)
+
+        if len(songs) > 0:
+            values = (songs, principal.user_id)
+            queries.execute(cur, "private_playlists", values)
 
-        for linha in all:
-            if linha[1] not in songs and linha[1] is not None:
-                songs.append(linha[1])
-            if linha[2] not in albuns and linha[2] is not None:
-                albuns.append(linha[2])
-            if linha[3] not in playlist and linha[3] is not None:
-                playlist.append(linha[3])
+            for linha in cur.fetchall():
+                playlist[linha[0]] = None
 
         results = {
-            "name": artistic_name,
+            "name": profile["name"],
             "songs": songs,
-            "albuns": albuns,
-            "playlists": playlist,
+            "albuns": list(albuns),
+            "playlists": list(playlist),
         }
 
-        response = {"status": StatusCodes["success"], "results": results}
+        response = {
+            "status": StatusCodes["success"],
+            "results": results,
+            "next": next_cursor,
+        }
 
     except (Exception, psycopg.DatabaseError) as error:
         logger.error(f"GET /dbproj/song/{artist_id} - error: {error}")
@@ -913,15 +2626,34 @@ def detail_artist(artist_id):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
+queries.register(
+    "plan_price",
+    "SELECT price, days_period, id FROM plan WHERE name = %s AND last_update <= %s ORDER BY last_update DESC LIMIT 1;",
+)
+queries.register(
+    "lock_consumer",
+    "SELECT person_users_id FROM consumer WHERE person_users_id = %s FOR NO KEY UPDATE",
+)
+queries.register(
+    "subscription_end",
+    "SELECT end_date FROM subscription WHERE consumer_person_users_id = %s AND end_date >= %s ORDER BY end_date DESC LIMIT 1",
+)
+queries.register(
+    "lock_cards",
+    "SELECT id, amount, expire FROM card WHERE expire >= %s AND code = ANY(%s) AND amount > 0 AND (consumer_person_users_id = %s OR consumer_person_users_id IS NULL) ORDER BY id FOR UPDATE;",
+)
+
+
 # Subscribe to Premium
 # POST http://localhost:8080/dbproj/subcription
-@app.route("/dbproj/subcription", methods=["POST"])
-def subscribe_premium():
+@api.route("/dbproj/subcription", methods=["POST"])
+@authenticated("consumer")
+def subscribe_premium(principal):
     logger.info("POST /dbproj/subcription")
     payload = flask.request.get_json()
 
@@ -930,73 +2662,50 @@ def subscribe_premium():
     # validate every argument:
     required_fields = ["period", "cards", "token"]
     for field in required_fields:
-        if field not in payload:
-            response = {
-                "status": StatusCodes["api_error"],
-                "results": f"{field} not in payload",
-            }
-            return flask.jsonify(response)
-
-    try:
-        credentials = jwt.decode(
-            payload["token"], secret_key, algorithms="HS256")
-
-    except jwt.exceptions.ExpiredSignatureError:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token invalido. tente autenticar novamente",
-        }
-        return flask.jsonify(response)
-
-    if "user_id" not in credentials:
-        response = {
-            "status": StatusCodes["api_error"], "results": "Invalid token"}
-        return flask.jsonify(response)
+        if field not in payload:
+            response = {
+                "status": StatusCodes["api_error"],
+                "results": f"{field} not in payload",
+            }
+            return flask.jsonify(response)
 
     conn = db_connection()
     cur = conn.cursor()
 
     try:
 
-        statement = "SELECT person_users_id FROM consumer WHERE person_users_id = %s"
-        values = (credentials["user_id"],)
-
-        cur.execute(statement, values)
-        indb = cur.fetchone()
-
-        if indb is None:
-            response = {
-                "status": StatusCodes["api_error"], "results": "Invalid token"}
-            conn.close()
-            return flask.jsonify(response)
-
         today = datetime.datetime.now()
 
         # buscar o preço do plano
 
-        statement = "SELECT price, days_period, id FROM plan WHERE name = %s AND last_update <= %s ORDER BY last_update DESC LIMIT 1;"
         values = (payload["period"], today)
 
-        cur.execute(statement, values)
+        queries.execute(cur, "plan_price", values)
         all = cur.fetchone()
 
-        price = all[0]
-        days_period = all[1]
-        plan_id = all[2]
-
-        if price is None:
+        if all is None:
             response = {
                 "status": StatusCodes["api_error"],
                 "results": "Plano indisponivel",
             }
-            conn.close()
             return flask.jsonify(response)
 
+        price = all[0]
+        days_period = all[1]
+        plan_id = all[2]
+
+        # begin the transaction
+        cur.execute("BEGIN TRANSACTION;")
+
+        # serialize only the purchases of this consumer, so two of them can't
+        # both extend the same subscription end date
+        values = (principal.user_id,)
+        queries.execute(cur, "lock_consumer", values)
+
         # verificar se é já subscrito
 
-        statement = "SELECT end_date FROM subscription WHERE end_date >= %s ORDER BY end_date DESC LIMIT 1"
-        values = (today,)
-        cur.execute(statement, values)
+        values = (principal.user_id, today)
+        queries.execute(cur, "subscription_end", values)
         res = cur.fetchone()
 
         sub_end = today
@@ -1004,26 +2713,24 @@ def subscribe_premium():
         if res is not None:
             sub_end = res[0]
 
-        cur.execute("LOCK TABLE card IN EXCLUSIVE MODE;")
-        cur.execute("LOCK TABLE subscription IN EXCLUSIVE MODE;")
-        cur.execute("LOCK TABLE history_card IN EXCLUSIVE MODE;")
-        # begin the transaction
-        cur.execute("BEGIN TRANSACTION;")
-
-        statement = "SELECT id, amount FROM card WHERE expire >= %s AND code = ANY(%s) AND amount > 0 AND (consumer_person_users_id = %s OR consumer_person_users_id IS NULL)  ORDER BY expire;"
-        values = (today, payload["cards"], credentials["user_id"])
-        cur.execute(statement, values)
+        # lock only the cards being redeemed, always in id order so purchases
+        # sharing cards can't deadlock. a card spent by a concurrent purchase
+        # is re-checked once its lock is released and drops out on amount > 0
+        values = (today, payload["cards"], principal.user_id)
+        queries.execute(cur, "lock_cards", values)
         cards = cur.fetchall()
 
-        if cards is None:
+        if len(cards) == 0:
             response = {
                 "status": StatusCodes["api_error"],
                 "results": "Saldo indisponivel",
             }
             cur.execute("ROLLBACK;")
-            conn.close()
             return flask.jsonify(response)
 
+        # spend the cards closest to expiring first
+        cards.sort(key=lambda card: card[2])
+
         statement = "INSERT INTO subscription (init_date, end_date, purchase_date, plan_id, consumer_person_users_id) VALUES (%s, %s, %s, %s, %s) RETURNING id;"
         sub_end_timedelta = sub_end - datetime.datetime.now()
 
@@ -1032,7 +2739,7 @@ def subscribe_premium():
             today + sub_end_timedelta + datetime.timedelta(days=days_period),
             today,
             plan_id,
-            credentials["user_id"],
+            principal.user_id,
         )
 
         cur.execute(statement, values)
@@ -1048,18 +2755,20 @@ def subscribe_premium():
                 cur.execute(statement, values)
 
                 statement = "UPDATE card SET amount = %s, consumer_person_users_id = %s  WHERE id = %s;"
-                values = (-price, credentials["user_id"], card[0])
+                values = (-price, principal.user_id, card[0])
                 cur.execute(statement, values)
                 break
 
             statement = "INSERT INTO history_card (cost, card_id, subscription_id) VALUES (%s, %s, %s);"
             values = (card[1], card[0], sub_id)
+            cur.execute(statement, values)
 
             statement = "UPDATE card SET amount = 0, consumer_person_users_id = %s WHERE id = %s;"
             values = (
-                credentials["user_id"],
+                principal.user_id,
                 card[0],
             )
+            cur.execute(statement, values)
 
             if price == 0:
                 break
@@ -1070,7 +2779,6 @@ def subscribe_premium():
                 "results": "Saldo indisponivel",
             }
             cur.execute("ROLLBACK;")
-            conn.close()
             return flask.jsonify(response)
 
         # commit the transaction
@@ -1091,15 +2799,26 @@ def subscribe_premium():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
+queries.register(
+    "active_subscription",
+    "SELECT id FROM subscription WHERE end_date >= %s AND consumer_person_users_id = %s",
+)
+queries.register(
+    "song_artists",
+    "SELECT ismn, artist_person_users_id FROM song WHERE ismn = ANY(%s::bigint[])",
+)
+
+
 # Create Playlist
 # POST http://localhost:8080/dbproj/playlist
-@app.route("/dbproj/playlist", methods=["POST"])
-def add_playlist():
+@api.route("/dbproj/playlist", methods=["POST"])
+@authenticated()
+def add_playlist(principal):
     logger.info(f"POST /dbproj/playlist")
     payload = flask.request.get_json()
 
@@ -1115,22 +2834,6 @@ def add_playlist():
             }
             return flask.jsonify(response)
 
-    try:
-        credentials = jwt.decode(
-            payload["token"], secret_key, algorithms="HS256")
-
-    except jwt.exceptions.ExpiredSignatureError:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token invalido. tente autenticar novamente",
-        }
-        return flask.jsonify(response)
-
-    if "user_id" not in credentials:
-        response = {
-            "status": StatusCodes["api_error"], "results": "Invalid token"}
-        return flask.jsonify(response)
-
     visibilidade = ""
 
     if payload["visibility"] == "private":
@@ -1152,12 +2855,11 @@ def add_playlist():
         # begin the transaction
         cur.execute("BEGIN TRANSACTION;")
 
-        statement = "SELECT id FROM subscription WHERE end_date >= %s AND consumer_person_users_id = %s"
         values = (
             today,
-            credentials["user_id"],
+            principal.user_id,
         )
-        cur.execute(statement, values)
+        queries.execute(cur, "active_subscription", values)
         res = cur.fetchone()
 
         if res is None:
@@ -1166,43 +2868,58 @@ def add_playlist():
                 "results": "Você nao tem permissoes para criar playlists.",
             }
             cur.execute("ROLLBACK;")
-            conn.close()
             return flask.jsonify(response)
 
+        # ids may come as numbers or strings, postgres casts them all
+        songs = [str(song) for song in payload["songs"]]
+
+        # all the songs are checked with a single query, so every missing
+        # one can be reported
+        values = (songs,)
+        queries.execute(cur, "song_artists", values)
+        found = {str(linha[0]): linha[1] for linha in cur.fetchall()}
+
+        missing = [song for song in songs if song not in found]
+
+        if len(missing) == 1:
+            response = {
+                "status": StatusCodes["api_error"],
+                "results": f"Você musica com o id {missing[0]} nao existe .",
+            }
+            cur.execute("ROLLBACK;")
+            return flask.jsonify(response)
+
+        if len(missing) > 1:
+            response = {
+                "status": StatusCodes["api_error"],
+                "results": f"As musicas com os ids {', '.join(missing)} nao existem.",
+            }
+            cur.execute("ROLLBACK;")
+            return flask.jsonify(response)
+
+        artists = set(found.values())
+
         # parameterized queries, good for security and performance
         statement = "INSERT INTO playlist (name, is_private, consumer_person_users_id) VALUES (%s, %s, %s) RETURNING id;"
         values = (payload["playlist_name"],
-                  visibilidade, credentials["user_id"])
+                  visibilidade, principal.user_id)
         cur.execute(statement, values)
 
         playlist_id = cur.fetchone()[0]
 
-        for song in payload["songs"]:
-            statement = "SELECT ismn FROM song WHERE ismn = %s"
-            values = (song,)
-            cur.execute(statement, values)
-            res = cur.fetchone()
-
-            if res is None:
-                response = {
-                    "status": StatusCodes["api_error"],
-                    "results": f"Você musica com o id {song} nao existe .",
-                }
-                cur.execute("ROLLBACK;")
-                conn.close()
-                return flask.jsonify(response)
-
-            statement = (
-                "INSERT INTO playlist_song (song_ismn, playlist_id) VALUES (%s, %s);"
-            )
-
-            values = (song, playlist_id)
-
-            cur.execute(statement, values)
+        # one statement whatever the number of songs
+        statement = "INSERT INTO playlist_song (song_ismn, playlist_id) SELECT unnest(%s::bigint[]), %s;"
+        values = (songs, playlist_id)
+        cur.execute(statement, values)
 
         # commit the transaction
         cur.execute("COMMIT;")
 
+        # only public playlists are part of the cached artist profiles
+        if visibilidade == "false":
+            for artist_id in artists:
+                artist_cache.invalidate(artist_id)
+
         response = {
             "status": StatusCodes["success"],
             "results": f"Inserted playlist {playlist_id}",
@@ -1218,80 +2935,77 @@ def add_playlist():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
+# largest value of a BIGINT column
+bigint_max = 2**63 - 1
+
+
+def is_song_id(text):
+    # ids typed in the url, queued plays are only checked against song when
+    # they are written, so ids that can't be a BIGINT are turned away here
+    return text.isascii() and text.isdigit() and int(text) <= bigint_max
+
+
+# only inserts when the song exists, in a single round trip
+queries.register(
+    "add_view",
+    "INSERT INTO view (date_view, song_ismn, consumer_person_users_id) SELECT %s, ismn, %s FROM song WHERE ismn = %s RETURNING id;",
+)
+
+
 # Play song
 # POST http://localhost:8080/dbproj/{song_ismn}
-@app.route("/dbproj/<song_id>", methods=["PUT"])
-def add_view(song_id):
+@api.route("/dbproj/<song_id>", methods=["PUT"])
+@authenticated("consumer")
+def add_view(principal, song_id):
     payload = flask.request.get_json()
     logger.debug(f"PUT /dbproj/{song_id} - payload: {payload}")
 
-    if "token" not in payload:
+    if not is_song_id(song_id):
         response = {
             "status": StatusCodes["api_error"],
-            "results": "token value not in payload",
+            "results": "Song is not in database",
         }
         return flask.jsonify(response)
 
-    try:
-        # o id está guardado no credentials
-        credentials = jwt.decode(
-            payload["token"], secret_key, algorithms="HS256")
+    # callers that need the view_id back can ask for the synchronous path
+    if view_ingestion == "buffered" and not payload.get("sync", False):
+        view = (datetime.datetime.now(), int(song_id), principal.user_id)
 
-    except jwt.exceptions.ExpiredSignatureError:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token invalido. tente autenticar novamente",
-        }
-        return flask.jsonify(response)
+        if not view_buffer.put(view, view_enqueue_timeout):
+            response = {
+                "status": StatusCodes["internal_error"],
+                "errors": "Too many views being recorded. Try again later",
+            }
+            return flask.jsonify(response)
 
-    # verificar se user_id está em credentials
-    if "user_id" not in credentials:
         response = {
-            "status": StatusCodes["api_error"], "results": "Invalid token"}
+            "status": StatusCodes["success"],
+            "results": {"message": "Song view queued successfully"},
+        }
         return flask.jsonify(response)
 
     conn = db_connection()
     cur = conn.cursor()
 
     try:
-        statement = "SELECT person_users_id FROM consumer WHERE person_users_id = %s"
-        values = (credentials["user_id"],)
-
-        cur.execute(statement, values)
-        indb = cur.fetchone()
-
-        if indb is None:
-            response = {
-                "status": StatusCodes["api_error"], "results": "Invalid token"}
-            conn.close()
-            return flask.jsonify(response)
-
-        cur.execute("BEGIN TRANSACTION;")
+        values = (datetime.datetime.now(), principal.user_id, song_id)
 
-        cur.execute("SELECT * FROM song WHERE ismn = %s;", (song_id,))
-        song = cur.fetchone()
+        queries.execute(cur, "add_view", values)
+        res = cur.fetchone()
 
-        if song is None:
-            conn.close()
+        if res is None:
             response = {
                 "status": StatusCodes["api_error"],
                 "results": "Song is not in database",
             }
-            cur.execute("ROLLBACK;")
-            conn.close()
             return flask.jsonify(response)
 
-        statement = "INSERT INTO view (date_view, song_ismn, consumer_person_users_id) VALUES (%s, %s, %s) RETURNING id;"
-
-        values = (datetime.datetime.now(), song_id, credentials["user_id"])
-
-        cur.execute(statement, values)
-        view_id = cur.fetchone()[0]
+        view_id = res[0]
 
         response = {
             "status": StatusCodes["success"],
@@ -1301,27 +3015,49 @@ def add_view(song_id):
             },
         }
 
-        cur.execute("COMMIT;")
-
     except (Exception, psycopg.DatabaseError) as error:
         logger.error(f"PUT /dbproj/{song_id} - error: {error}")
         response = {
             "status": StatusCodes["internal_error"], "errors": str(error)}
 
-        # an error occurred, rollback
-        cur.execute("ROLLBACK;")
-
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
+card_chars = b"QWERTYUIOPASDFGHJKLZXCVBNM1234567890"
+card_code_length = 16
+card_code_attempts = 5
+
+# maps a random byte to a code character. bytes 252 to 255 are dropped
+# before mapping, so every character is equally likely
+card_char_table = bytes(card_chars[byte % len(card_chars)] for byte in range(256))
+card_biased_bytes = bytes(range(256 - 256 % len(card_chars), 256))
+
+
+def card_codes(number):
+    # returns number distinct codes from the OS random generator
+    codes = set()
+
+    while len(codes) < number:
+        missing = number - len(codes)
+        # about 2% of the bytes are dropped, so ask for a bit more
+        raw = secrets.token_bytes(missing * card_code_length * 105 // 100 + card_code_length)
+        text = raw.translate(None, card_biased_bytes).translate(card_char_table).decode("ascii")
+
+        for start in range(0, len(text) - card_code_length + 1, card_code_length):
+            codes.add(text[start:start + card_code_length])
+
+    return list(codes)[:number]
+
+
 # Generate pre-paid cards
 # POST http://localhost:8080/dbproj/card
-@app.route("/dbproj/card", methods=["POST"])
-def generate_cards():
+@api.route("/dbproj/card", methods=["POST"])
+@authenticated("administrator", denied="Token inválido.")
+def generate_cards(principal):
     logger.info("POST /dbproj/card")
     payload = flask.request.get_json()
 
@@ -1337,22 +3073,6 @@ def generate_cards():
             }
             return flask.jsonify(response)
 
-    try:
-        credentials = jwt.decode(
-            payload["token"], secret_key, algorithms="HS256")
-
-    except jwt.exceptions.ExpiredSignatureError:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token invalido. tente autenticar novamente",
-        }
-        return flask.jsonify(response)
-
-    if "user_id" not in credentials:
-        response = {
-            "status": StatusCodes["api_error"], "results": "Invalid token"}
-        return flask.jsonify(response)
-
     amount = 0
 
     if payload["card_price"] == 10:
@@ -1366,47 +3086,78 @@ def generate_cards():
             "status": StatusCodes["api_error"], "results": "Invalid card_price"}
         return flask.jsonify(response)
 
+    try:
+        number_cards = int(payload["number_cards"])
+    except (ValueError, TypeError):
+        number_cards = 0
+
+    if number_cards < 1 or number_cards > card_max_number:
+        response = {
+            "status": StatusCodes["api_error"],
+            "results": f"number_cards must be between 1 and {card_max_number}",
+        }
+        return flask.jsonify(response)
+
     conn = db_connection()
     cur = conn.cursor()
 
-    chars = "QWERTYUIOPASDFGHJKLZXCVBNM1234567890"
-
     try:
-        statement = "SELECT users_id FROM administrator WHERE users_id = %s"
-        values = (credentials["user_id"],)
-
-        cur.execute(statement, values)
-        indb = cur.fetchone()
-        if indb is None:
-            response = {
-                "status": StatusCodes["api_error"],
-                "results": "Token inválido.",
-            }
-            conn.close()
-            return flask.jsonify(response)
-
         # begin the transaction
         cur.execute("BEGIN TRANSACTION;")
 
+        cur.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS card_staging (code VARCHAR(16)) ON COMMIT DELETE ROWS;"
+        )
+
+        expire = datetime.datetime.now() + datetime.timedelta(days=30)
         cards = []
-        for i in range(int(payload["number_cards"])):
-            statement = "INSERT INTO card (code, expire, amount, type, administrator_users_id) VALUES (%s, %s, %s, %s, %s) RETURNING id;"
-            values = (
-                "".join(random.choices(chars, k=16)),
-                datetime.datetime.now() + datetime.timedelta(days=30),
-                amount,
-                amount,
-                credentials["user_id"],
-            )
+
+        # every attempt loads the codes with COPY and inserts them in one
+        # statement. codes already taken are skipped by ON CONFLICT and
+        # replaced with new ones on the next attempt
+        for attempt in range(card_code_attempts):
+            with cur.copy("COPY card_staging (code) FROM STDIN") as copy:
+                for code in card_codes(number_cards - len(cards)):
+                    copy.write_row((code,))
+
+            statement = """
+            INSERT INTO card (code, expire, amount, type, administrator_users_id)
+            SELECT code, %s, %s, %s, %s FROM card_staging
+            ON CONFLICT (code) DO NOTHING
+            RETURNING id, code;
+            """
+            values = (expire, amount, amount, principal.user_id)
 
             cur.execute(statement, values)
-            card_id = cur.fetchone()[0]
-            cards.append(card_id)
+            cards.extend(cur.fetchall())
+
+            if len(cards) == number_cards:
+                break
+
+            cur.execute("TRUNCATE card_staging;")
+
+        else:
+            response = {
+                "status": StatusCodes["internal_error"],
+                "errors": "Could not generate unique card codes. Try again",
+            }
+            cur.execute("ROLLBACK;")
+            return flask.jsonify(response)
 
         # commit the transaction
         cur.execute("COMMIT;")
 
-        response = {"status": StatusCodes["success"], "results": cards}
+        if payload.get("stream", False):
+            # one {"id", "code"} object per line, written as it is sent
+            return flask.Response(
+                (json.dumps({"id": card[0], "code": card[1]}) + "\n" for card in cards),
+                mimetype="application/x-ndjson",
+            )
+
+        response = {
+            "status": StatusCodes["success"],
+            "results": [card[0] for card in cards],
+        }
 
     except (Exception, psycopg.DatabaseError) as error:
         logger.error(f"POST /dbproj/card - error: {error}")
@@ -1418,15 +3169,16 @@ def generate_cards():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
 # Leave	comment/feedback of an song
 # POST http://localhost:8080/dbproj/comments/{song_ismn}
-@app.route("/dbproj/comments/<song_ismn>", methods=["POST"])
-def add_comment(song_ismn):
+@api.route("/dbproj/comments/<song_ismn>", methods=["POST"])
+@authenticated("consumer")
+def add_comment(principal, song_ismn):
     logger.info(f"POST /dbproj/comments/{song_ismn}")
     payload = flask.request.get_json()
 
@@ -1441,22 +3193,6 @@ def add_comment(song_ismn):
                 "results": f"{field} not in payload",
             }
             return flask.jsonify(response)
-    try:
-        credentials = jwt.decode(
-            payload["token"], secret_key, algorithms="HS256")
-
-    except jwt.exceptions.ExpiredSignatureError:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token invalido. tente autenticar novamente",
-        }
-        return flask.jsonify(response)
-
-    if "user_id" not in credentials:
-        response = {
-            "status": StatusCodes["api_error"], "results": "Invalid token"}
-        return flask.jsonify(response)
-
     conn = db_connection()
     cur = conn.cursor()
 
@@ -1470,27 +3206,14 @@ def add_comment(song_ismn):
         if indb is None:
             response = {
                 "status": StatusCodes["api_error"], "results": "song id errado"}
-            conn.close()
             return flask.jsonify(response)
 
         # begin the transaction
         cur.execute("BEGIN TRANSACTION;")
 
-        statement = "SELECT person_users_id FROM consumer WHERE person_users_id = %s"
-        values = (credentials["user_id"],)
-
-        cur.execute(statement, values)
-        indb = cur.fetchone()
-
-        if indb is None:
-            response = {
-                "status": StatusCodes["api_error"], "results": "Invalid token"}
-            conn.close()
-            return flask.jsonify(response)
-
         # parameterized queries, good for security and performance
         statement = "INSERT INTO comment (text, song_ismn, consumer_person_users_id) VALUES (%s, %s, %s) RETURNING id;"
-        values = (payload["comment"], song_ismn, credentials["user_id"])
+        values = (payload["comment"], song_ismn, principal.user_id)
 
         cur.execute(statement, values)
 
@@ -1514,15 +3237,16 @@ def add_comment(song_ismn):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
 # Leave	comment/feedback of an comment
 # POST http://localhost:8080/dbproj/comments/{song_ismn}/{parent_comment_id}
-@app.route("/dbproj/comments/<song_ismn>/<parent_comment_id>", methods=["POST"])
-def add_comment_comment(song_ismn, parent_comment_id):
+@api.route("/dbproj/comments/<song_ismn>/<parent_comment_id>", methods=["POST"])
+@authenticated("consumer")
+def add_comment_comment(principal, song_ismn, parent_comment_id):
     logger.info(f"POST /dbproj/comments/{song_ismn}/{parent_comment_id}")
     payload = flask.request.get_json()
 
@@ -1539,22 +3263,6 @@ def add_comment_comment(song_ismn, parent_comment_id):
                 "results": f"{field} not in payload",
             }
             return flask.jsonify(response)
-    try:
-        credentials = jwt.decode(
-            payload["token"], secret_key, algorithms="HS256")
-
-    except jwt.exceptions.ExpiredSignatureError:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token invalido. tente autenticar novamente",
-        }
-        return flask.jsonify(response)
-
-    if "user_id" not in credentials:
-        response = {
-            "status": StatusCodes["api_error"], "results": "Invalid token"}
-        return flask.jsonify(response)
-
     conn = db_connection()
     cur = conn.cursor()
 
@@ -1571,25 +3279,11 @@ def add_comment_comment(song_ismn, parent_comment_id):
                 "status": StatusCodes["api_error"],
                 "results": "song id ou parant_comment_id errados",
             }
-            conn.close()
             return flask.jsonify(response)
 
         # begin the transaction
         cur.execute("BEGIN TRANSACTION;")
 
-        statement = "SELECT person_users_id FROM consumer WHERE person_users_id = %s"
-        values = (credentials["user_id"],)
-
-        cur.execute(statement, values)
-        indb = cur.fetchone()
-
-        if indb is None:
-            response = {
-                "status": StatusCodes["api_error"], "results": "Invalid token"}
-            cur.execute("ROLLBACK;")
-            conn.close()
-            return flask.jsonify(response)
-
         statement = "SELECT id FROM comment WHERE id = %s"
         values = (parent_comment_id,)
 
@@ -1602,7 +3296,6 @@ def add_comment_comment(song_ismn, parent_comment_id):
                 "results": "Invalid comment parent",
             }
             cur.execute("ROLLBACK;")
-            conn.close()
             return flask.jsonify(response)
 
         # parameterized queries, good for security and performance
@@ -1610,7 +3303,7 @@ def add_comment_comment(song_ismn, parent_comment_id):
         values = (
             payload["comment"],
             song_ismn,
-            credentials["user_id"],
+            principal.user_id,
             parent_comment_id,
         )
 
@@ -1638,38 +3331,38 @@ def add_comment_comment(song_ismn, parent_comment_id):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
+# the rollups hold one row per consumer, month and genre, so this
+# reads at most 12 months worth of rows whatever the play history
+queries.register("monthly_report", """
+SELECT
+EXTRACT(MONTH FROM month) AS mes,
+genre,
+play_count AS numero_de_reproducoes
+FROM
+consumer_monthly_genre
+WHERE
+consumer_person_users_id = %s
+AND month >= %s
+AND month < %s
+ORDER BY
+mes, genre;
+""")
+
+
 # Generate a monthly report
 # GET - http://localhost:8080/dbproj/report/year-month
-@app.route("/dbproj/report/<year>-<month>", methods=["GET"])
-def monthly_report(year, month):
+@api.route("/dbproj/report/<year>-<month>", methods=["GET"])
+@authenticated("consumer", denied="Token inválido.")
+def monthly_report(principal, year, month):
     payload = flask.request.get_json()
     logger.info("GET /dbproj/song/{year}{month}")
     logger.debug("GET /dbproj/song/{year}{month}")
 
-    if "token" not in payload:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token value not in payload",
-        }
-        return flask.jsonify(response)
-
-    try:
-        # o id está guardado no credentials
-        credentials = jwt.decode(
-            payload["token"], secret_key, algorithms="HS256")
-
-    except jwt.exceptions.ExpiredSignatureError:
-        response = {
-            "status": StatusCodes["api_error"],
-            "results": "token invalido. tente autenticar novamente",
-        }
-        return flask.jsonify(response)
-
     init_date = datetime.datetime(int(year) - 1, int(month), 1).strftime("%Y-%m-%d")
     end_date = datetime.datetime(int(year), int(month), 1).strftime("%Y-%m-%d")
 
@@ -1677,42 +3370,11 @@ def monthly_report(year, month):
     cur = conn.cursor()
 
     try:
-        statement = "SELECT person_users_id FROM consumer WHERE person_users_id = %s"
-        values = (credentials["user_id"],)
-
-        cur.execute(statement, values)
-        indb = cur.fetchone()
-        if indb is None:
-            response = {
-                "status": StatusCodes["api_error"],
-                "results": "Token inválido.",
-            }
-            conn.close()
-            return flask.jsonify(response)
-
-        statement = """
-        SELECT
-        EXTRACT(MONTH FROM v.date_view) AS mes,
-        s.genre,
-        COUNT(*) AS numero_de_reproducoes
-        FROM
-        view v
-        INNER JOIN
-        song s ON s.ismn = v.song_ismn
-        WHERE
-        v.consumer_person_users_id = %s
-        AND v.date_view >= %s
-        AND v.date_view <= %s
-        GROUP BY
-        mes, s.genre
-        ORDER BY
-        mes, s.genre;
-        """
-        values = (credentials["user_id"], init_date, end_date)
+        values = (principal.user_id, init_date, end_date)
 
         response = {"status": StatusCodes["success"], "results": []}
 
-        cur.execute(statement, values)
+        queries.execute(cur, "monthly_report", values)
         all_data = cur.fetchall()
 
         for linha in all_data:
@@ -1727,17 +3389,60 @@ def monthly_report(year, month):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return flask.jsonify(response)
 
 
+##########################################################
+# SERVER
+##########################################################
+
+
+def create_app():
+    # app factory, gunicorn builds one per worker with "main:create_app()"
+    app = flask.Flask(__name__)
+    app.json = MetricsJSONProvider(app)
+    app.register_blueprint(api)
+
+    return app
+
+
+def after_fork():
+    # a forked worker must not use the connections, threads and locks of its
+    # parent, so they are created again on first use
+    global db_pool, db_pool_lock
+
+    db_pool = None
+    db_pool_lock = threading.Lock()
+
+    for cache in (artist_cache, role_cache):
+        cache.lock = threading.Lock()
+
+    queries.lock = threading.Lock()
+    request_metrics.lock = threading.Lock()
+    slow_query_log.lock = threading.Lock()
+
+    view_buffer.after_fork()
+    partition_maintenance.after_fork()
+    password_hasher.after_fork()
+
+
+os.register_at_fork(after_in_child=after_fork)
+
+app = create_app()
+
+
 def main():
-    host = "127.0.0.1"
-    port = 8080
+    # development server, see gunicorn.conf.py and async_main.py for the
+    # multi-process ones
+    host, port = server_bind.rsplit(":", 1)
+
+    # turn SIGTERM into a normal exit, so queued views are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     logger.info(f"API online: http://{host}:{port}/dbproj")
-    app.run(host=host, debug=True, threaded=True, port=port)
+    app.run(host=host, debug=server_debug, threaded=True, port=int(port))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+# =============================================
+# ============== Bases de Dados ===============
+# ============== LEI  2022/2023 ===============
+# =============================================
+#
+# Schema migrations. sql/migrations holds NNNN_name.up.sql and
+# NNNN_name.down.sql scripts, applied in order of version on top of the
+# schema the project started with (sql/create_tables.sql and
+# sql/create_trigger.sql), so existing databases upgrade the same way new
+# ones are set up. Every change to the schema since then is a migration.
+# The versions applied are kept in the schema_migrations table.
+#
+# A script runs in a transaction together with its schema_migrations row,
+# unless its first line is "-- migrate: no-transaction". Those scripts (for
+# CREATE INDEX CONCURRENTLY and the like) run one statement at a time, so
+# they must be safe to run again after a failure and cannot hold $$ bodies.
+#
+# Run with:
+#   python migrate.py status
+#   python migrate.py up [--to VERSION]
+#   python migrate.py down [--to VERSION]   (one version by default)
+
+import argparse
+import os
+import re
+import sys
+import time
+from dotenv import load_dotenv
+
+import psycopg
+
+load_dotenv()
+
+migrations_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "sql", "migrations")
+
+# held while migrating, so two deployments never migrate at the same time
+migration_lock = 7310541
+
+no_transaction = "-- migrate: no-transaction"
+
+
+def db_connection():
+    # the database in .env, the one the server uses
+    return psycopg.connect(
+        user=os.getenv("USER"),
+        password=os.getenv("PASSWORD"),
+        host=os.getenv("HOSTDB"),
+        port=os.getenv("PORTDB"),
+        dbname=os.getenv("NAMEDB"),
+        autocommit=True,
+    )
+
+
+def read_migrations(path):
+    # version: (name, up script path, down script path)
+    migrations = {}
+
+    for file in sorted(os.listdir(path)):
+        match = re.fullmatch(r"(\d+)_(\w+)\.(up|down)\.sql", file)
+
+        if match is None:
+            continue
+
+        version, name, direction = int(match[1]), match[2], match[3]
+        migration = migrations.setdefault(version, {"name": name})
+
+        if migration["name"] != name:
+            sys.exit(f"version {version} is used by {migration['name']} and {name}")
+
+        migration[direction] = os.path.join(path, file)
+
+    for version, migration in migrations.items():
+        if "up" not in migration or "down" not in migration:
+            sys.exit(f"migration {version} needs an up and a down script")
+
+    return migrations
+
+
+def applied_versions(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version    BIGINT,
+            name       VARCHAR(512) NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY(version)
+        )
+        """
+    )
+
+    return {
+        row[0]: row[1:]
+        for row in conn.execute("SELECT version, name, applied_at FROM schema_migrations")
+    }
+
+
+def split_statements(script):
+    # statements end with ; at the end of a line
+    statements = []
+
+    for statement in re.split(r";[ \t]*(?:\n|$)", script):
+        code = "\n".join(
+            line for line in statement.splitlines()
+            if not line.strip().startswith("--")
+        ).strip()
+
+        if code:
+            statements.append(code)
+
+    return statements
+
+
+def run_script(conn, path, record, values):
+    # runs a script and the statement that records it in schema_migrations
+    with open(path, encoding="utf-8") as file:
+        script = file.read()
+
+    start = time.monotonic()
+
+    if script.startswith(no_transaction):
+        for statement in split_statements(script):
+            try:
+                conn.execute(statement)
+            except psycopg.Error:
+                invalid = conn.execute(
+                    "SELECT indexrelid::regclass::text FROM pg_index WHERE NOT indisvalid"
+                ).fetchall()
+
+                if invalid:
+                    print(
+                        "indexes left INVALID, drop them before trying again: "
+                        + ", ".join(row[0] for row in invalid)
+                    )
+                raise
+
+        conn.execute(record, values)
+    else:
+        with conn.transaction():
+            conn.execute(script)
+            conn.execute(record, values)
+
+    return time.monotonic() - start
+
+
+def up(conn, migrations, applied, target):
+    for version in sorted(migrations):
+        if version in applied or (target is not None and version > target):
+            continue
+
+        name = migrations[version]["name"]
+        print(f"up {version:04d} {name}", end=" ", flush=True)
+
+        seconds = run_script(
+            conn, migrations[version]["up"],
+            "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+            [version, name])
+        print(f"({seconds:.1f}s)")
+
+
+def down(conn, migrations, applied, target):
+    versions = sorted(applied, reverse=True)
+
+    if target is None:
+        # one version by default
+        versions = versions[:1]
+    else:
+        versions = [version for version in versions if version > target]
+
+    for version in versions:
+        if version not in migrations:
+            sys.exit(f"there is no down script for version {version}")
+
+        print(f"down {version:04d} {migrations[version]['name']}", end=" ", flush=True)
+
+        seconds = run_script(
+            conn, migrations[version]["down"],
+            "DELETE FROM schema_migrations WHERE version = %s", [version])
+        print(f"({seconds:.1f}s)")
+
+
+def status(migrations, applied):
+    for version in sorted(set(migrations) | set(applied)):
+        if version in applied:
+            name, applied_at = applied[version]
+            print(f"{version:04d} {name:<40} applied {applied_at:%Y-%m-%d %H:%M:%S}")
+        else:
+            print(f"{version:04d} {migrations[version]['name']:<40} pending")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spotsong schema migrations")
+    parser.add_argument("command", choices=["status", "up", "down"])
+    parser.add_argument("--to", type=int, help="last version to keep applied")
+    parser.add_argument("--path", default=migrations_path)
+    options = parser.parse_args()
+
+    migrations = read_migrations(options.path)
+
+    with db_connection() as conn:
+        conn.execute("SELECT pg_advisory_lock(%s)", [migration_lock])
+
+        try:
+            applied = applied_versions(conn)
+
+            if options.command == "status":
+                status(migrations, applied)
+            elif options.command == "up":
+                up(conn, migrations, applied, options.to)
+            else:
+                down(conn, migrations, applied, options.to)
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s)", [migration_lock])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# Tests against the database in src/.env, which must have the schema of
+# sql/create_tables.sql with every migration applied. They are skipped when
+# the database can't be reached.
+#
+# Run with (from the root of the project):
+#   python -m pytest -q
+
+import os
+import sys
+import uuid
+
+import psycopg
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    try:
+        psycopg.connect(**main.db_connect_kwargs, connect_timeout=3).close()
+    except psycopg.OperationalError as error:
+        pytest.skip(f"database not available: {error}")
+
+    return main.app
+
+
+@pytest.fixture
+def db(app):
+    conn = psycopg.connect(**main.db_connect_kwargs)
+    yield conn
+    conn.close()
+
+
+class Fixtures:
+    # rows created by a test, deleted again at the end of it
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.tag = uuid.uuid4().hex[:12]
+        self.users = []
+        self.cards = []
+        self.plans = []
+
+    def user(self, name):
+        # a user with a password hash that matches no password
+        return self.conn.execute(
+            "INSERT INTO users (username, password, email) VALUES (%s, '-', %s) RETURNING id",
+            [f"{name}-{self.tag}", f"{name}-{self.tag}@example.com"],
+        ).fetchone()[0]
+
+    def consumer(self, name):
+        user_id = self.user(name)
+        self.conn.execute(
+            "INSERT INTO person (name, address, contact, users_id) VALUES (%s, 'rua', '9', %s)",
+            [name, user_id],
+        )
+        self.conn.execute("INSERT INTO consumer (person_users_id) VALUES (%s)", [user_id])
+        self.users.append(user_id)
+
+        return user_id
+
+    def artist(self, name, label_id):
+        user_id = self.user(name)
+        self.conn.execute(
+            "INSERT INTO person (name, address, contact, users_id) VALUES (%s, 'rua', '9', %s)",
+            [name, user_id],
+        )
+        self.conn.execute(
+            """
+            INSERT INTO artist (artistic_name, administrator_users_id, label_id, person_users_id)
+            SELECT %s, MIN(users_id), %s, %s FROM administrator
+            """,
+            [f"{name}-{self.tag}", label_id, user_id],
+        )
+        self.users.append(user_id)
+
+        return user_id
+
+    def plan(self, price, days_period):
+        name = f"plan-{self.tag}"
+        self.plans.append(self.conn.execute(
+            "INSERT INTO plan (name, price, last_update, days_period) VALUES (%s, %s, now() - INTERVAL '1 day', %s) RETURNING id",
+            [name, price, days_period],
+        ).fetchone()[0])
+
+        return name
+
+    def card(self, amount):
+        code = uuid.uuid4().hex[:16].upper()
+        self.cards.append(self.conn.execute(
+            """
+            INSERT INTO card (code, expire, amount, type, administrator_users_id)
+            SELECT %s, now() + INTERVAL '30 days', %s, %s, MIN(users_id) FROM administrator
+            RETURNING id
+            """,
+            [code, amount, amount],
+        ).fetchone()[0])
+
+        return code
+
+    def signups(self):
+        # users created through the API by this test
+        return [
+            row[0] for row in self.conn.execute(
+                "SELECT id FROM users WHERE username LIKE %s", [f"%-{self.tag}"])
+        ]
+
+    def delete(self):
+        users = set(self.users) | set(self.signups())
+
+        with self.conn.transaction():
+            self.conn.execute(
+                "DELETE FROM history_card WHERE card_id = ANY(%s) OR subscription_id IN (SELECT id FROM subscription WHERE consumer_person_users_id = ANY(%s))",
+                [self.cards, list(users)],
+            )
+            self.conn.execute("DELETE FROM card WHERE id = ANY(%s)", [self.cards])
+            self.conn.execute(
+                "DELETE FROM subscription WHERE consumer_person_users_id = ANY(%s)", [list(users)])
+            self.conn.execute("DELETE FROM plan WHERE id = ANY(%s)", [self.plans])
+            self.conn.execute(
+                "DELETE FROM playlist_song WHERE playlist_id IN (SELECT id FROM playlist WHERE consumer_person_users_id = ANY(%s))",
+                [list(users)],
+            )
+            self.conn.execute("DELETE FROM playlist WHERE consumer_person_users_id = ANY(%s)", [list(users)])
+            self.conn.execute("DELETE FROM view WHERE consumer_person_users_id = ANY(%s)", [list(users)])
+            self.conn.execute("DELETE FROM view_daily_count WHERE consumer_person_users_id = ANY(%s)", [list(users)])
+            self.conn.execute("DELETE FROM consumer_monthly_genre WHERE consumer_person_users_id = ANY(%s)", [list(users)])
+            self.conn.execute("DELETE FROM refresh_token WHERE users_id = ANY(%s)", [list(users)])
+            self.conn.execute(
+                "DELETE FROM song_album WHERE album_id IN (SELECT id FROM album WHERE artist_person_users_id = ANY(%s)) OR song_ismn IN (SELECT ismn FROM song WHERE artist_person_users_id = ANY(%s))",
+                [list(users), list(users)],
+            )
+            self.conn.execute("DELETE FROM album WHERE artist_person_users_id = ANY(%s)", [list(users)])
+            self.conn.execute(
+                "DELETE FROM artist_song WHERE artist_person_users_id = ANY(%s) OR song_ismn IN (SELECT ismn FROM song WHERE artist_person_users_id = ANY(%s))",
+                [list(users), list(users)],
+            )
+            self.conn.execute("DELETE FROM song WHERE artist_person_users_id = ANY(%s)", [list(users)])
+            self.conn.execute("DELETE FROM consumer WHERE person_users_id = ANY(%s)", [list(users)])
+            self.conn.execute("DELETE FROM artist WHERE person_users_id = ANY(%s)", [list(users)])
+            self.conn.execute("DELETE FROM person WHERE users_id = ANY(%s)", [list(users)])
+            self.conn.execute("DELETE FROM users WHERE id = ANY(%s)", [list(users)])
+
+        for user_id in users:
+            main.invalidate_principal(user_id)
+
+
+@pytest.fixture
+def fixtures(db):
+    db.autocommit = True
+    rows = Fixtures(db)
+    yield rows
+    rows.delete()
@@ -0,0 +1,99 @@
+# Albums whose ids come as numbers, strings or a mix of both
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def labels(db):
+    rows = [row[0] for row in db.execute("SELECT id FROM label ORDER BY id LIMIT 2")]
+
+    if len(rows) < 2:
+        pytest.skip("needs two labels")
+
+    return rows
+
+
+def add_album(app, artist_id, payload):
+    payload = {
+        "token": main.issue_access_token(artist_id),
+        "album_name": "album",
+        "release_date": "2023-01-01",
+        **payload,
+    }
+
+    with app.test_client() as client:
+        return client.post("/dbproj/album", json=payload).json
+
+
+def new_song(publisher_id, other_artists=()):
+    return {
+        "song_name": "song",
+        "duration": "3:00",
+        "genre": "pop",
+        "release_date": "2023-01-01",
+        "publisher_id": publisher_id,
+        "other_artists": list(other_artists),
+    }
+
+
+def album_songs(db, response):
+    album_id = int(response["results"].removeprefix("Inserted album "))
+
+    return [
+        row[0] for row in db.execute(
+            "SELECT song_ismn FROM song_album WHERE album_id = %s ORDER BY song_ismn", [album_id])
+    ]
+
+
+@pytest.mark.parametrize("as_id", [int, str], ids=["numbers", "strings"])
+def test_album_ids(app, db, fixtures, labels, as_id):
+    artist_id = fixtures.artist("album", labels[0])
+    other_id = fixtures.artist("featured", labels[0])
+
+    response = add_album(app, artist_id, {
+        "publisher_id": as_id(labels[0]),
+        "songs": [new_song(as_id(labels[1]), [as_id(other_id)])],
+    })
+    assert response["status"] == main.StatusCodes["success"], response
+    [song_id] = album_songs(db, response)
+
+    # the song is now one of the artist's, it can go in another album by id
+    response = add_album(app, artist_id, {
+        "publisher_id": as_id(labels[0]),
+        "songs": [as_id(song_id)],
+    })
+    assert response["status"] == main.StatusCodes["success"], response
+    assert album_songs(db, response) == [song_id]
+
+
+def test_album_mixed_ids(app, db, fixtures, labels):
+    artist_id = fixtures.artist("album", labels[0])
+    other_id = fixtures.artist("featured", labels[0])
+
+    response = add_album(app, artist_id, {
+        "publisher_id": labels[0],
+        "songs": [new_song(str(labels[1]), [str(other_id)]), new_song(labels[0], [other_id])],
+    })
+    assert response["status"] == main.StatusCodes["success"], response
+    song_ids = album_songs(db, response)
+
+    response = add_album(app, artist_id, {
+        "publisher_id": str(labels[0]),
+        "songs": [song_ids[0], str(song_ids[1]), new_song(labels[1])],
+    })
+    assert response["status"] == main.StatusCodes["success"], response
+    assert album_songs(db, response)[:2] == song_ids
+
+
+def test_album_unknown_ids(app, db, fixtures, labels):
+    artist_id = fixtures.artist("album", labels[0])
+    missing = db.execute("SELECT MAX(id) + 1 FROM label").fetchone()[0]
+
+    response = add_album(app, artist_id, {"publisher_id": str(missing), "songs": [new_song(labels[0])]})
+    assert response == {"status": main.StatusCodes["api_error"], "results": "label invalida."}
+
+    response = add_album(app, artist_id, {"publisher_id": labels[0], "songs": ["1", 2]})
+    assert response["status"] == main.StatusCodes["api_error"]
+    assert response["errors"].startswith("You are not associated with song")
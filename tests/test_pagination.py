@@ -0,0 +1,38 @@
+# Malformed page limits and cursors are rejected as api errors
+
+import pytest
+
+import main
+
+routes = ["/dbproj/song/a", "/dbproj/artist_info/1"]
+
+
+@pytest.fixture
+def token(fixtures):
+    return main.issue_access_token(fixtures.consumer("pagination"))
+
+
+@pytest.mark.parametrize("route", routes)
+@pytest.mark.parametrize("limit", ["abc", "", 1.5, None, True, [10], {"n": 10}])
+def test_invalid_limit(app, token, route, limit):
+    with app.test_client() as client:
+        response = client.get(route, json={"token": token, "limit": limit}).json
+
+    assert response == {"status": main.StatusCodes["api_error"], "results": "invalid limit"}
+
+
+@pytest.mark.parametrize("route", routes)
+@pytest.mark.parametrize("after", [None, 1, [1, 2], {"a": 1}, "!!!", "MWU0MDA=", "WzEsMWU0MDBd"])
+def test_invalid_cursor(app, token, route, after):
+    with app.test_client() as client:
+        response = client.get(route, json={"token": token, "after": after}).json
+
+    assert response == {"status": main.StatusCodes["api_error"], "results": "invalid after cursor"}
+
+
+@pytest.mark.parametrize("route", routes)
+def test_numeric_limit(app, token, route):
+    with app.test_client() as client:
+        response = client.get(route, json={"token": token, "limit": "5"}).json
+
+    assert response["status"] != main.StatusCodes["internal_error"]
@@ -0,0 +1,104 @@
+# Refresh tokens are used once, replaced on use and pruned when reissued
+
+import datetime
+import threading
+
+import main
+
+
+def refresh(app, token):
+    with app.test_client() as client:
+        return client.put("/dbproj/token", json={"refresh_token": token}).json
+
+
+def user_tokens(db, user_id):
+    return db.execute(
+        "SELECT revoked, expires < now() FROM refresh_token WHERE users_id = %s ORDER BY expires",
+        [user_id],
+    ).fetchall()
+
+
+def test_refresh_rotates_the_token(app, db, fixtures):
+    user_id = fixtures.consumer("rotate")
+    token = main.issue_refresh_token(db.cursor(), user_id)
+
+    response = refresh(app, token)
+
+    assert response["status"] == main.StatusCodes["success"]
+    assert main.decode_token(response["results"]) == user_id
+    assert response["refresh_token"] != token
+
+    # the old token is gone, the new one works once
+    assert refresh(app, token)["status"] == main.StatusCodes["api_error"]
+    assert refresh(app, response["refresh_token"])["status"] == main.StatusCodes["success"]
+    assert user_tokens(db, user_id) == [(False, False)]
+
+
+def test_refresh_rejects_revoked_and_expired_tokens(app, db, fixtures):
+    user_id = fixtures.consumer("rejected")
+    revoked = main.issue_refresh_token(db.cursor(), user_id)
+    expired = main.issue_refresh_token(db.cursor(), user_id)
+
+    db.execute("UPDATE refresh_token SET revoked = TRUE WHERE token_hash = %s",
+               [main.refresh_token_hash(revoked)])
+    db.execute("UPDATE refresh_token SET expires = now() - INTERVAL '1 day' WHERE token_hash = %s",
+               [main.refresh_token_hash(expired)])
+
+    for token in (revoked, expired, "unknown"):
+        response = refresh(app, token)
+        assert response == {
+            "status": main.StatusCodes["api_error"],
+            "results": "refresh token invalido. tente autenticar novamente",
+        }
+
+    # neither was replaced, and both are deleted
+    assert user_tokens(db, user_id) == []
+
+
+def test_issue_prunes_revoked_and_expired_tokens(db, fixtures):
+    user_id = fixtures.consumer("prune")
+    other_id = fixtures.consumer("other")
+    cur = db.cursor()
+
+    valid = main.issue_refresh_token(cur, user_id)
+    for _ in range(3):
+        main.issue_refresh_token(cur, user_id)
+    main.issue_refresh_token(cur, other_id)
+
+    db.execute(
+        "UPDATE refresh_token SET revoked = TRUE WHERE users_id = ANY(%s) AND token_hash <> %s",
+        [[user_id, other_id], main.refresh_token_hash(valid)])
+    db.execute(
+        "UPDATE refresh_token SET revoked = FALSE, expires = %s WHERE token_hash IN "
+        "(SELECT token_hash FROM refresh_token WHERE users_id = %s AND revoked LIMIT 1)",
+        [datetime.datetime.now() - datetime.timedelta(days=1), user_id])
+
+    main.issue_refresh_token(cur, user_id)
+
+    # the valid token and the new one are left, other users are not touched
+    assert user_tokens(db, user_id) == [(False, False), (False, False)]
+    assert user_tokens(db, other_id) == [(True, False)]
+
+
+def test_concurrent_refreshes_use_the_token_once(app, db, fixtures):
+    user_id = fixtures.consumer("concurrent")
+    token = main.issue_refresh_token(db.cursor(), user_id)
+
+    refreshes = 8
+    barrier = threading.Barrier(refreshes)
+    responses = [None] * refreshes
+
+    def use(index):
+        barrier.wait()
+        responses[index] = refresh(app, token)
+
+    threads = [threading.Thread(target=use, args=(index,)) for index in range(refreshes)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    statuses = sorted(response["status"] for response in responses)
+    assert statuses == [main.StatusCodes["success"]] + [main.StatusCodes["api_error"]] * (refreshes - 1)
+    assert user_tokens(db, user_id) == [(False, False)]
@@ -0,0 +1,93 @@
+# Concurrent signups racing for the same username or artistic name
+
+import threading
+
+import pytest
+
+import main
+
+signups = 8
+
+
+def sign_up_all(app, payloads):
+    # posts the signups at the same time, returns the responses in order
+    barrier = threading.Barrier(len(payloads))
+    responses = [None] * len(payloads)
+
+    def sign_up(index, payload):
+        with app.test_client() as client:
+            barrier.wait()
+            responses[index] = client.post("/dbproj/user", json=payload).json
+
+    threads = [
+        threading.Thread(target=sign_up, args=(index, payload))
+        for index, payload in enumerate(payloads)
+    ]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return responses
+
+
+def signup_payload(fixtures, username, index):
+    return {
+        "username": f"{username}-{fixtures.tag}",
+        "email": f"{username}{index}-{fixtures.tag}@example.com",
+        "password": "password",
+        "address": "rua",
+        "contact": "9",
+        "name": username,
+    }
+
+
+def assert_one_wins(responses, message):
+    succeeded = [response for response in responses if response["status"] == main.StatusCodes["success"]]
+    rejected = [response for response in responses if response["status"] != main.StatusCodes["success"]]
+
+    assert len(succeeded) == 1
+    assert rejected == [{"status": main.StatusCodes["api_error"], "results": message}] * (len(responses) - 1)
+
+
+def test_concurrent_signups_same_username(app, db, fixtures):
+    payloads = [signup_payload(fixtures, "signup", index) for index in range(signups)]
+
+    responses = sign_up_all(app, payloads)
+
+    assert_one_wins(responses, "Usuario com esse username já existe. Escolha outro")
+
+    users = fixtures.signups()
+    assert len(users) == 1
+    assert db.execute("SELECT count(*) FROM consumer WHERE person_users_id = %s", users).fetchone()[0] == 1
+
+
+def test_concurrent_signups_same_artistic_name(app, db, fixtures):
+    administrator, label = db.execute(
+        "SELECT (SELECT MIN(users_id) FROM administrator), (SELECT MIN(id) FROM label)"
+    ).fetchone()
+
+    if administrator is None or label is None:
+        pytest.skip("needs an administrator and a label")
+
+    token = main.issue_access_token(administrator)
+    payloads = [
+        {
+            **signup_payload(fixtures, f"artist{index}", index),
+            "token": token,
+            "label_id": label,
+            "artistic_name": f"artist-{fixtures.tag}",
+        }
+        for index in range(signups)
+    ]
+
+    responses = sign_up_all(app, payloads)
+
+    assert_one_wins(responses, "Usuario com esse nome artistico já existe. Escolha outro")
+
+    # the losers' users rows were rolled back together with their artist row
+    assert len(fixtures.signups()) == 1
+    assert db.execute(
+        "SELECT count(*) FROM artist WHERE artistic_name = %s", [f"artist-{fixtures.tag}"]
+    ).fetchone()[0] == 1
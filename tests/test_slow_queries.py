@@ -0,0 +1,78 @@
+# Sampled EXPLAIN ANALYZE of slow queries never runs writes or locks again
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def explain_all(app, monkeypatch):
+    # every statement is slow and explained
+    monkeypatch.setattr(main.slow_query_log, "threshold", 0)
+    monkeypatch.setattr(main.slow_query_log, "explain_rate", 1)
+
+
+def logged_plan(statement, values=None, transaction=False):
+    conn = main.db_connection()
+    cur = conn.cursor()
+
+    try:
+        if transaction:
+            cur.execute("BEGIN TRANSACTION;")
+
+        cur.execute(statement, values)
+
+        if transaction:
+            # the transaction of the endpoint can still write
+            cur.execute("CREATE TEMP TABLE explained (id BIGINT) ON COMMIT DROP;")
+            cur.execute("COMMIT;")
+    finally:
+        main.release_connection(conn)
+
+    # the statements run after it are not explained
+    return next(entry["plan"] for entry in main.slow_query_log.recent() if entry["plan"] is not None)
+
+
+@pytest.mark.parametrize("statement", [
+    "SELECT id FROM label FOR UPDATE",
+    "SELECT id FROM label FOR NO KEY UPDATE",
+    "SELECT id FROM label FOR SHARE",
+    "SELECT refresh_top10s()",
+    "SELECT pg_try_advisory_xact_lock(1)",
+])
+def test_locking_reads_and_calls_are_not_analyzed(statement):
+    assert main.slow_query_log.explain_statements(statement) == ["EXPLAIN " + statement]
+
+
+def test_reads_are_analyzed_read_only():
+    statement = "SELECT id FROM label WHERE id = %s"
+
+    assert main.slow_query_log.explain_statements(statement) == [
+        "SET LOCAL transaction_read_only = on",
+        "EXPLAIN (ANALYZE, BUFFERS) " + statement,
+    ]
+
+
+@pytest.mark.parametrize("transaction", [False, True])
+def test_locking_read_gets_its_plan(explain_all, transaction):
+    plan = logged_plan("SELECT id FROM label FOR UPDATE", transaction=transaction)
+
+    assert any("LockRows" in line for line in plan)
+    assert not any("actual time" in line for line in plan)
+
+
+@pytest.mark.parametrize("transaction", [False, True])
+def test_read_is_analyzed(explain_all, transaction):
+    plan = logged_plan("SELECT id FROM label WHERE id > %s", [0], transaction=transaction)
+
+    assert any("actual time" in line for line in plan)
+
+
+def test_writing_function_is_not_run_again(explain_all, db):
+    before = db.execute("SELECT last_value FROM label_id_seq").fetchone()[0]
+
+    plan = logged_plan("SELECT nextval('label_id_seq') FROM label LIMIT 1")
+
+    # the query ran once, its EXPLAIN ANALYZE was stopped by the read only mode
+    assert db.execute("SELECT last_value FROM label_id_seq").fetchone()[0] == before + 1
+    assert plan.startswith("EXPLAIN failed")
@@ -0,0 +1,33 @@
+# /dbproj/stats is only served to administrators
+
+import main
+
+
+def stats(app, payload):
+    with app.test_client() as client:
+        return client.get("/dbproj/stats", json=payload).json
+
+
+def test_stats_needs_a_token(app):
+    assert stats(app, {}) == {
+        "status": main.StatusCodes["api_error"],
+        "results": "token value not in payload",
+    }
+
+
+def test_stats_denied_to_consumers(app, fixtures):
+    token = main.issue_access_token(fixtures.consumer("stats"))
+
+    assert stats(app, {"token": token}) == {
+        "status": main.StatusCodes["api_error"],
+        "results": "Token inválido.",
+    }
+
+
+def test_stats_served_to_administrators(app, db):
+    administrator = db.execute("SELECT MIN(users_id) FROM administrator").fetchone()[0]
+
+    response = stats(app, {"token": main.issue_access_token(administrator)})
+
+    assert response["status"] == main.StatusCodes["success"]
+    assert "pool" in response["results"]
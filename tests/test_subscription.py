@@ -0,0 +1,104 @@
+# Concurrent premium purchases redeeming the same cards
+
+import threading
+
+import psycopg
+import pytest
+
+import main
+
+
+def subscribe_all(app, plan, purchases):
+    # runs the purchases (consumer id, card codes) of a plan at the same time,
+    # returns the responses in the same order
+    barrier = threading.Barrier(len(purchases))
+    responses = [None] * len(purchases)
+
+    def subscribe(index, consumer_id, cards):
+        payload = {
+            "token": main.issue_access_token(consumer_id),
+            "period": plan,
+            "cards": cards,
+        }
+
+        with app.test_client() as client:
+            barrier.wait()
+            responses[index] = client.post("/dbproj/subcription", json=payload).json
+
+    threads = [
+        threading.Thread(target=subscribe, args=(index, consumer_id, cards))
+        for index, (consumer_id, cards) in enumerate(purchases)
+    ]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return responses
+
+
+def assert_balances(db, cards, amount):
+    # every unit spent from a card is in its history, and no card went below
+    # zero or was spent twice
+    rows = db.execute(
+        """
+        SELECT c.amount, COALESCE(SUM(h.cost), 0)
+        FROM card c
+        LEFT JOIN history_card h ON h.card_id = c.id
+        WHERE c.code = ANY(%s)
+        GROUP BY c.id, c.amount
+        """,
+        [cards],
+    ).fetchall()
+
+    assert len(rows) == len(cards)
+
+    for balance, spent in rows:
+        assert balance >= 0
+        assert balance + spent == amount
+
+
+@pytest.mark.parametrize("same_consumer", [True, False])
+def test_concurrent_purchases_never_overdraw_cards(app, db, fixtures, same_consumer):
+    # 2 cards of 10 pay for 2 plans of 7, never 3
+    plan = fixtures.plan(price=7, days_period=30)
+    cards = [fixtures.card(10), fixtures.card(10)]
+
+    if same_consumer:
+        consumers = [fixtures.consumer("buyer")] * 8
+    else:
+        consumers = [fixtures.consumer(f"buyer{index}") for index in range(8)]
+
+    responses = subscribe_all(app, plan, [(consumer_id, cards) for consumer_id in consumers])
+
+    assert all(response["status"] in (200, 400) for response in responses)
+    succeeded = [response for response in responses if response["status"] == 200]
+    rejected = [response for response in responses if response["status"] == 400]
+
+    assert all(response["results"] == "Saldo indisponivel" for response in rejected)
+
+    assert len(succeeded) == 2
+
+    assert_balances(db, cards, 10)
+
+    spent = db.execute(
+        """
+        SELECT COUNT(DISTINCT s.id), SUM(h.cost)
+        FROM subscription s
+        JOIN history_card h ON h.subscription_id = s.id
+        JOIN card c ON c.id = h.card_id
+        WHERE c.code = ANY(%s)
+        """,
+        [cards],
+    ).fetchone()
+
+    assert spent[0] == len(succeeded)
+    assert spent[1] == 7 * len(succeeded)
+
+
+def test_card_amount_cannot_go_negative(db, fixtures):
+    code = fixtures.card(10)
+
+    with pytest.raises(psycopg.errors.CheckViolation):
+        db.execute("UPDATE card SET amount = amount - 11 WHERE code = %s", [code])
@@ -0,0 +1,151 @@
+# Failed flushes of the view buffer keep their views
+
+import datetime
+
+import psycopg
+import pytest
+
+import main
+
+
+@pytest.fixture
+def buffer(tmp_path, monkeypatch):
+    monkeypatch.setattr(main.ViewBuffer, "retry_delay", 0.01)
+    return main.ViewBuffer(100, 10, 0.1, str(tmp_path / "view_spill.tsv"))
+
+
+def plays(db, fixtures, count):
+    consumer_id = fixtures.consumer("listener")
+    song = db.execute("SELECT MIN(ismn) FROM song").fetchone()[0]
+    now = datetime.datetime.now().replace(microsecond=0)
+
+    return consumer_id, [(now, song, consumer_id)] * count
+
+
+def count_views(db, consumer_id):
+    return db.execute(
+        "SELECT COUNT(*) FROM view WHERE consumer_person_users_id = %s", [consumer_id]
+    ).fetchone()[0]
+
+
+def test_deadlocked_batch_is_written_again(db, fixtures, buffer, monkeypatch):
+    consumer_id, batch = plays(db, fixtures, 5)
+    write = buffer.write
+    failures = []
+
+    def deadlocking_write(views):
+        if len(failures) < 4:
+            failures.append(views)
+            raise psycopg.errors.DeadlockDetected("deadlock detected")
+        return write(views)
+
+    monkeypatch.setattr(buffer, "write", deadlocking_write)
+    buffer.flush(batch)
+
+    # more failures than flush_attempts, the batch is still written
+    assert count_views(db, consumer_id) == 5
+    assert buffer.stats["retries"] == 4
+    assert buffer.stats["spilled"] == 0
+
+
+def test_failed_batch_is_spilled_and_replayed(db, fixtures, buffer, monkeypatch):
+    consumer_id, batch = plays(db, fixtures, 5)
+    write = buffer.write
+
+    def failing_write(views):
+        raise psycopg.errors.InsufficientPrivilege("permission denied for table view")
+
+    monkeypatch.setattr(buffer, "write", failing_write)
+    buffer.flush(batch)
+
+    assert count_views(db, consumer_id) == 0
+    assert buffer.stats["spilled"] == 5
+
+    with open(buffer.spill_file, encoding="utf-8") as file:
+        assert len(file.readlines()) == 5
+
+    # while the database still fails, the views go back to the spill file
+    buffer.replay()
+    assert count_views(db, consumer_id) == 0
+
+    monkeypatch.setattr(buffer, "write", write)
+    buffer.replay()
+
+    assert count_views(db, consumer_id) == 5
+    assert buffer.stats["replayed"] == 5
+
+    with pytest.raises(FileNotFoundError):
+        open(buffer.spill_file)
+
+
+def test_invalid_view_does_not_hold_back_its_batch(db, fixtures, buffer):
+    consumer_id, batch = plays(db, fixtures, 4)
+    out_of_range = (batch[0][0], 10**20, consumer_id)
+
+    buffer.flush(batch[:2] + [out_of_range] + batch[2:])
+
+    assert count_views(db, consumer_id) == 4
+    assert buffer.stats["quarantined"] == 1
+    assert buffer.stats["spilled"] == 0
+    assert buffer.stats["dropped"] == 0
+
+    with open(f"{buffer.spill_file}.rejected", encoding="utf-8") as file:
+        assert file.readlines() == [f"{out_of_range[0].isoformat()}\t{10**20}\t{consumer_id}\n"]
+
+
+def test_replay_skips_unreadable_lines(db, fixtures, buffer):
+    consumer_id, batch = plays(db, fixtures, 3)
+    buffer.spill(batch[:2])
+
+    # a line that is not a view, and one cut short by a crash at the end
+    with open(buffer.spill_file, "a", encoding="utf-8") as file:
+        file.write("not a view\n")
+    buffer.spill(batch[2:])
+    with open(buffer.spill_file, "a", encoding="utf-8") as file:
+        file.write(f"{batch[0][0].isoformat()}\t{batch[0][1]}")
+
+    buffer.replay()
+
+    assert count_views(db, consumer_id) == 3
+    assert buffer.stats["replayed"] == 3
+    assert buffer.stats["quarantined"] == 2
+
+    with open(f"{buffer.spill_file}.rejected", encoding="utf-8") as file:
+        assert len(file.readlines()) == 2
+
+
+@pytest.mark.parametrize("song_id", [str(2**63), "100000000000000000000", "²"])
+def test_play_of_an_impossible_song_id_is_not_queued(app, fixtures, monkeypatch, song_id):
+    consumer_id = fixtures.consumer("listener")
+    queued = []
+
+    monkeypatch.setattr(main, "view_ingestion", "buffered")
+    monkeypatch.setattr(main.view_buffer, "put", lambda view, timeout: queued.append(view) or True)
+
+    with app.test_client() as client:
+        response = client.put(f"/dbproj/{song_id}", json={"token": main.issue_access_token(consumer_id)}).json
+
+    assert response == {"status": main.StatusCodes["api_error"], "results": "Song is not in database"}
+    assert queued == []
+
+
+def test_buffered_play_does_not_take_a_connection(app, fixtures, monkeypatch):
+    consumer_id = fixtures.consumer("listener")
+    queued = []
+
+    # the principal comes from the role cache
+    main.resolve_principal(consumer_id)
+
+    def no_connection():
+        raise AssertionError("buffered plays must not check out a connection")
+
+    monkeypatch.setattr(main, "view_ingestion", "buffered")
+    monkeypatch.setattr(main, "db_connection", no_connection)
+    monkeypatch.setattr(main.view_buffer, "put", lambda view, timeout: queued.append(view) or True)
+
+    with app.test_client() as client:
+        response = client.put("/dbproj/1", json={"token": main.issue_access_token(consumer_id)}).json
+
+    assert response["status"] == 200
+    assert len(queued) == 1
+    assert queued[0][1:] == (1, consumer_id)
@@ -0,0 +1,58 @@
+# Concurrent batches of plays and the counters kept by the view trigger
+
+import datetime
+import random
+import threading
+
+import psycopg
+
+import main
+
+
+def test_concurrent_batches_sharing_consumers_do_not_deadlock(db, fixtures):
+    consumers = [fixtures.consumer(f"listener{index}") for index in range(20)]
+    songs = [row[0] for row in db.execute("SELECT ismn FROM song ORDER BY ismn LIMIT 20")]
+    errors = []
+
+    def insert_batches(seed):
+        # every batch has most of the consumers, in a different order
+        rng = random.Random(seed)
+        now = datetime.datetime.now()
+
+        with psycopg.connect(**main.db_connect_kwargs) as conn:
+            for _ in range(20):
+                batch = [(now, rng.choice(songs), consumer_id)
+                         for consumer_id in rng.sample(consumers, 15)]
+
+                try:
+                    with conn.transaction():
+                        conn.execute(
+                            """
+                            INSERT INTO view (date_view, song_ismn, consumer_person_users_id)
+                            SELECT * FROM unnest(%s::timestamp[], %s::bigint[], %s::bigint[])
+                            """,
+                            [list(column) for column in zip(*batch)],
+                        )
+                except psycopg.Error as error:
+                    errors.append(error)
+
+    threads = [threading.Thread(target=insert_batches, args=(seed,)) for seed in range(8)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+    views, counted = db.execute(
+        """
+        SELECT
+        (SELECT COUNT(*) FROM view WHERE consumer_person_users_id = ANY(%(consumers)s)),
+        (SELECT SUM(views) FROM view_daily_count WHERE consumer_person_users_id = ANY(%(consumers)s))
+        """,
+        {"consumers": consumers},
+    ).fetchone()
+
+    assert views == 8 * 20 * 15
+    assert counted == views